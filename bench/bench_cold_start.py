@@ -0,0 +1,82 @@
+# Measure how long a restart takes with a big snapshot on disk: how
+# long until the database is usable, and how long the first requests
+# for a single user and a page of users take after that.  For
+# comparison it also times rebuilding the whole database from the same
+# records with addUser, which is what loading a snapshot used to cost.
+#
+#     python bench/bench_cold_start.py [--users 1000000]
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Run in a fresh interpreter so that nothing is warm
+RESTART = '''
+import time
+start = time.perf_counter()
+import database.fake_db as db
+loaded = time.perf_counter()
+db.getUserByUserid("bench{:07d}".format(USERS // 2))
+first_user = time.perf_counter()
+db.pageUsers(100, "bench{:07d}".format(USERS // 3))
+first_page = time.perf_counter()
+print(json.dumps({
+    "startup_seconds": loaded - start,
+    "first_user_seconds": first_user - loaded,
+    "first_page_seconds": first_page - first_user
+}))
+'''
+
+def addUsers(db, count):
+    groups = [db.getGroupByName(name) for name in ["users", "admins", "execs", "pirates"]]
+
+    for i in range(count):
+        db.addUser(db.User("bench{:07d}".format(i), "First{}".format(i), "Last{}".format(i), groups[:1 + i % 4]))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000000)
+    args = parser.parse_args()
+
+    import database.fake_db as db
+
+    data_dir = tempfile.mkdtemp()
+
+    try:
+        addUsers(db, args.users)
+        db.enablePersistence(data_dir)
+        db.disablePersistence()
+
+        records = list(db._captureUserRecords())
+        db._reset()
+        start = time.perf_counter()
+        for name in ["users", "admins", "execs", "pirates"]:
+            db.addGroupByName(name)
+        for userid, first_name, last_name, group_names in records:
+            db.addUser(db.User(userid, first_name, last_name, [db.getGroupByName(name) for name in group_names]))
+        eager_seconds = time.perf_counter() - start
+
+        environment = dict(os.environ, FAKE_DB_DATA_DIR=data_dir, PYTHONPATH=ROOT)
+        output = subprocess.check_output(
+            [sys.executable, '-c', 'import json\nUSERS = {}\n'.format(args.users) + RESTART], env=environment)
+
+        results = json.loads(output.decode('utf-8'))
+        results['users'] = args.users
+        results['snapshot_bytes'] = sum(os.path.getsize(os.path.join(data_dir, name)) for name in os.listdir(data_dir))
+        results['eager_rebuild_seconds'] = eager_seconds
+
+        print(json.dumps(results, indent=2))
+
+    finally:
+        shutil.rmtree(data_dir)
+
+if __name__ == '__main__':
+    main()
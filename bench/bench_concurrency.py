@@ -0,0 +1,84 @@
+# Throughput against the in-memory database with 1, 2, 4 and 8 threads
+# for a fixed time: reader threads looking up users and reading pages
+# of them, with and without a thread doing updates alongside, and
+# writer threads updating random users.  Readers share the locks and
+# writers to different shards don't wait for each other, so adding
+# threads shouldn't cost anything beyond what the interpreter itself
+# charges for them.  Set FAKE_DB_SHARDS=1 to compare with one shard.
+#
+#     python bench/bench_concurrency.py [--users 100000] [--seconds 2]
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import database.fake_db as db
+
+def addUsers(count):
+    groups = [db.getGroupByName(name) for name in ["users", "admins", "execs", "pirates"]]
+
+    for i in range(count):
+        db.addUser(db.User("bench{:07d}".format(i), "First{}".format(i), "Last{}".format(i), groups[:1 + i % 4]))
+
+def run(users, threads, seconds, readers, writers):
+    stop = threading.Event()
+    reads = [0] * threads
+    writes = [0] * threads
+
+    def read(slot):
+        chooser = random.Random(slot)
+
+        while not stop.is_set():
+            userid = "bench{:07d}".format(chooser.randrange(users))
+            db.getUserByUserid(userid)
+            db.pageUsers(20, userid)
+            reads[slot] += 1
+
+    def write(slot):
+        chooser = random.Random(-1 - slot)
+
+        while not stop.is_set():
+            userid = "bench{:07d}".format(chooser.randrange(users))
+            user = db.getUserByUserid(userid)
+            db.updateUser(db.User(userid, user.first_name, user.last_name, list(user.groups)))
+            writes[slot] += 1
+
+    workers = [threading.Thread(target=read, args=(slot,)) for slot in range(readers)]
+    workers += [threading.Thread(target=write, args=(slot,)) for slot in range(writers)]
+
+    for worker in workers:
+        worker.start()
+
+    time.sleep(seconds)
+    stop.set()
+
+    for worker in workers:
+        worker.join()
+
+    return {'reads_per_second': round(sum(reads) / seconds), 'writes_per_second': round(sum(writes) / seconds)}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--seconds', type=float, default=2)
+    args = parser.parse_args()
+
+    addUsers(args.users)
+    results = {'users': args.users, 'shards': len(db.all_shards), 'readers_only': {}, 'with_writer': {}, 'writers_only': {}}
+
+    for threads in [1, 2, 4, 8]:
+        results['readers_only'][threads] = run(args.users, threads, args.seconds, threads, 0)
+        results['with_writer'][threads] = run(args.users, threads, args.seconds, threads, 1)
+        results['writers_only'][threads] = run(args.users, threads, args.seconds, 0, threads)
+
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# Answer "admins AND execs AND NOT pirates" against the in-memory
+# database the way a client had to before group queries, by fetching
+# each group's member list and combining them, and with countGroupQuery
+# and pageGroupQuery working on the groups' bitmaps.  Users are put in
+# each group at random, so the groups overlap like real ones do.
+#
+#     python bench/bench_group_query.py [--users 100000] [--repeat 20]
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import database.fake_db as db
+
+QUERY = "admins AND execs AND NOT pirates"
+
+def addUsers(count):
+    groups = [db.getGroupByName(name) for name in ["admins", "execs", "pirates"]]
+    chooser = random.Random(42)
+
+    for i in range(count):
+        user_groups = [db.getGroupByName("users")] + [group for group in groups if chooser.random() < 0.4]
+        db.addUser(db.User("bench{:07d}".format(i), "First{}".format(i), "Last{}".format(i), user_groups))
+
+# What a client had to do: three member lists, combined client side
+def combineMemberLists():
+    admins, execs, pirates = [set(db.getUserIdsForGroup(db.getGroupByName(name)))
+                              for name in ["admins", "execs", "pirates"]]
+    return sorted((admins & execs) - pirates)
+
+def timeQuery(query, repeat):
+    start = time.perf_counter()
+
+    for _ in range(repeat):
+        result = query()
+
+    return (time.perf_counter() - start) / repeat, result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    addUsers(args.users)
+
+    member_lists, expected = timeQuery(combineMemberLists, args.repeat)
+    count, matches = timeQuery(lambda: db.countGroupQuery(QUERY), args.repeat)
+    page, _ = timeQuery(lambda: db.pageGroupQuery(QUERY, 100), args.repeat)
+    everything, (userids, _) = timeQuery(lambda: db.pageGroupQuery(QUERY), args.repeat)
+
+    assert matches == len(expected) and sorted(userids) == expected
+
+    print(json.dumps({
+        'users': args.users,
+        'matches': matches,
+        'ms': {
+            'member_lists_combined': member_lists * 1e3,
+            'countGroupQuery': count * 1e3,
+            'pageGroupQuery_100': page * 1e3,
+            'pageGroupQuery_all': everything * 1e3
+        }
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# Bytes per user held by the in-memory database, as traced by
+# tracemalloc: the user records on their own, and everything the
+# database holds for a user (its record plus its entries in the
+# indexes, group bitmaps and the like).  Names are drawn from pools,
+# so they repeat the way they do in a real directory.
+#
+#     python bench/bench_memory.py [--users 200000]
+
+import argparse
+import json
+import os
+import random
+import sys
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import database.fake_db as db
+
+# Users as records, freshly decoded the way they'd arrive in requests
+def makeUsers(count):
+    groups = [db.getGroupByName(name) for name in ["users", "admins", "execs", "pirates"]]
+    chooser = random.Random(42)
+
+    return [db.User("user{:08d}".format(i),
+                    "first{}".format(chooser.randrange(500)),
+                    "last{}".format(chooser.randrange(2000)),
+                    groups[:1 + chooser.randrange(4)]) for i in range(count)]
+
+def tracedBytes(build):
+    tracemalloc.start()
+
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        kept = build()
+        return tracemalloc.get_traced_memory()[0] - before, kept
+    finally:
+        tracemalloc.stop()
+
+def addAll(users):
+    for user in users:
+        db.addUser(user)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200000)
+    args = parser.parse_args()
+
+    records, users = tracedBytes(lambda: makeUsers(args.users))
+    indexes, _ = tracedBytes(lambda: addAll(users))
+
+    print(json.dumps({
+        'users': args.users,
+        'bytes_per_user': {
+            'records': records / args.users,
+            'indexes': indexes / args.users,
+            'total': (records + indexes) / args.users
+        }
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
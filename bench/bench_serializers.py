@@ -0,0 +1,86 @@
+# Compare the compiled serializers with marshal() on a directory of
+# synthetic users: rendering every user record on its own, and end to
+# end through GET /users/.  The response cache is switched off so that
+# every request renders every user.
+#
+#     python bench/bench_serializers.py [--users 100000] [--repeat 3]
+
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ['FRAGMENT_CACHE_SIZE'] = '0'
+
+def loadApp():
+    spec = importlib.util.spec_from_file_location('python_eval', os.path.join(ROOT, 'python-eval.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def addUsers(db, count):
+    groups = [db.getGroupByName(name) for name in ["users", "admins", "execs", "pirates"]]
+
+    for i in range(count):
+        db.addUser(db.User("bench{:07d}".format(i), "First{}".format(i), "Last{}".format(i), groups[:1 + i % 4]))
+
+def timeSerializer(serialize, users, repeat):
+    best = None
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for user in users:
+            serialize(user)
+        elapsed = time.perf_counter() - start
+
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+def timeRequest(client, url, repeat):
+    best = None
+    body = None
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.get(url)
+        elapsed = time.perf_counter() - start
+
+        assert response.status_code == 200
+        body = response.data
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, body
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    app = loadApp()
+    addUsers(app.db, args.users)
+    client = app.app.test_client()
+
+    users = app.db.allUsers()
+    results = {'users': len(users), 'serialize_user': {}, 'get_users': {}}
+    bodies = {}
+
+    for name, compiled in [('marshal', False), ('compiled', True)]:
+        app.useSerializers(compiled)
+        results['serialize_user'][name + '_seconds'] = timeSerializer(app.serialize_user, users, args.repeat)
+        results['get_users'][name + '_seconds'], bodies[name] = timeRequest(client, '/users/', args.repeat)
+
+    for result in [results['serialize_user'], results['get_users']]:
+        result['speedup'] = round(result['marshal_seconds'] / result['compiled_seconds'], 2)
+
+    results['get_users']['identical'] = bodies['marshal'] == bodies['compiled']
+
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# Group statistics for a dashboard against the in-memory database: the
+# counts groupStats keeps up to date as users change, versus fetching
+# every group's member list and scanning every user, as a client had to.
+# Also the cost the counting adds to updating users.
+#
+#     python bench/bench_stats.py [--users 100000] [--groups 20]
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import database.fake_db as db
+
+def addUsers(count, group_count):
+    for i in range(group_count):
+        db.addGroupByName("group{:02d}".format(i))
+
+    groups = [db.getGroupByName("group{:02d}".format(i)) for i in range(group_count)]
+    chooser = random.Random(42)
+
+    for i in range(count):
+        db.addUser(db.User("bench{:07d}".format(i), "First{}".format(i), "Last{}".format(i),
+                           chooser.sample(groups, chooser.randrange(4))))
+
+def scanStats():
+    users = db.allUsers()
+    return {
+        "users": len(users),
+        "members": [(group.name, len(db.getUserIdsForGroup(group))) for group in db.allGroups()],
+        "groups_per_user": sorted(Counter(len(user.groups) for user in users).items())
+    }
+
+def timeCalls(call, repeat):
+    start = time.perf_counter()
+
+    for _ in range(repeat):
+        call()
+
+    return (time.perf_counter() - start) / repeat
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--groups', type=int, default=20)
+    args = parser.parse_args()
+
+    addUsers(args.users, args.groups)
+    user = db.getUserByUserid("bench0000000")
+
+    print(json.dumps({
+        'users': args.users,
+        'groups': args.groups,
+        'ms': {
+            'scan': timeCalls(scanStats, 3) * 1e3,
+            'groupStats': timeCalls(db.groupStats, 1000) * 1e3
+        },
+        'updateUser_us': timeCalls(lambda: db.updateUser(db.User(user.userid, "First", "Last", list(user.groups))),
+                                   10000) * 1e6
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,380 @@
+# The benchmark suite: a microbenchmark for every public fake_db
+# function and an end to end benchmark for every route of the web
+# service, through Flask's test client, against a synthetic directory
+# (see dataset.py).  Each benchmark is run for several rounds of a fixed
+# number of calls and the results, the median and best time per call
+# over the rounds, are written out as JSON along with the commit they
+# were measured on, so that runs on different commits can be compared:
+#
+#     python bench/bench_suite.py [--users 100000] [--groups 50] [--output results.json]
+#     python bench/bench_suite.py --compare before.json after.json [--threshold 1.2]
+#
+# --compare prints each benchmark's time after over its time before,
+# slowest first, and exits with status 1 if any of them got slower by
+# more than the threshold.  --only runs just the benchmarks whose names
+# contain the given text.
+#
+# Benchmarks that change the directory undo their changes: the ones
+# that add users, groups or memberships are paired with the ones that
+# take them away again, call for call, or clean up once they're done.
+
+import argparse
+import importlib.util
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from dataset import Dataset
+
+# Public fake_db functions that requests never call, so they aren't
+# benchmarked: setting up persistence and change listeners.
+NOT_BENCHMARKED = ['enablePersistence', 'disablePersistence', 'addChangeListener']
+
+QUERY = 'group0000 AND group0001 AND NOT group0002'
+
+# call(i) is called for i from 0 up, setup() before the first call and
+# cleanup(calls) after the last one
+class Benchmark:
+    def __init__(self, name, call, number, setup = None, cleanup = None):
+        self.name = name
+        self.call = call
+        self.number = number
+        self.setup = setup
+        self.cleanup = cleanup
+
+def loadApp():
+    spec = importlib.util.spec_from_file_location('python_eval', os.path.join(ROOT, 'python-eval.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def commit():
+    try:
+        head = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL)
+        status = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT)
+        return {'sha': head.decode('ascii').strip(), 'dirty': bool(status.strip())}
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Everything the benchmarks pick from: users in a random order (call i
+# gets the i'th, so calls that change users each get a different one),
+# a few users' records and two disjoint lists of members
+class Picks:
+    def __init__(self, db, dataset):
+        chooser = random.Random(7)
+        self.userids = list(dataset.userids)
+        chooser.shuffle(self.userids)
+
+        self.records = []
+        for userid in self.userids[:1000]:
+            user = db.getUserByUserid(userid)
+            self.records.append((user.userid, user.first_name, user.last_name, [group.name for group in user.groups]))
+
+        self.members = self.userids[-200:-100]
+        self.more_members = self.userids[-100:]
+
+    def userid(self, i):
+        return self.userids[i % len(self.userids)]
+
+    def record(self, i):
+        return self.records[i % len(self.records)]
+
+# A benchmark for each public fake_db function, with a few variations
+def dbBenchmarks(db, picks):
+    group = db.getGroupByName('group0001')
+    largest_group = db.getGroupByName('group0000')
+
+    def user(i):
+        userid, first_name, last_name, group_names = picks.record(i)
+        return db.User(userid, first_name, last_name, [db.getGroupByName(name) for name in group_names])
+
+    def newUser(i):
+        return db.User('bench-add-{:08d}'.format(i), 'First', 'Last', [group])
+
+    def batch(i):
+        return [db.User('bench-batch-{:08d}-{:03d}'.format(i, j), 'First', 'Last', [group]) for j in range(100)]
+
+    def deleteBatches(calls):
+        for i in range(calls):
+            for user in batch(i):
+                db.deleteUserByUserId(user.userid)
+
+    def addToggleGroup():
+        db.addGroupByName('bench-toggle')
+
+    def addMembersGroup():
+        db.addGroupByName('bench-members')
+        db.updateGroupMembership(db.getGroupByName('bench-members'), picks.members)
+
+    def removeGroup(name):
+        return lambda calls: db.removeGroupByName(name)
+
+    def removeGroupBatches(calls):
+        for i in range(calls):
+            for j in range(10):
+                db.removeGroupByName('bench-groups-{:06d}-{}'.format(i, j))
+
+    def toggle(i, add):
+        user = db.getUserByUserid(picks.userid(i))
+        (db.addGroupToUser if add else db.removeGroupFromUser)(user, db.getGroupByName('bench-toggle'))
+
+    def changeMembers(i):
+        members, more_members = (picks.members, picks.more_members) if i % 2 else (picks.more_members, picks.members)
+        db.changeGroupMembership(db.getGroupByName('bench-members'), members[:10], more_members[:10])
+
+    def updateMembers(i):
+        db.updateGroupMembership(db.getGroupByName('bench-members'), picks.members if i % 2 else picks.more_members)
+
+    # changesSince is asked for the last hundred changes
+    since = []
+
+    def makeChanges():
+        since.append(db.tableVersion())
+
+        for i in range(100):
+            db.updateUser(user(i))
+
+    return [
+        Benchmark('userExistsByUserid', lambda i: db.userExistsByUserid(picks.userid(i)), 10000),
+        Benchmark('getUserByUserid', lambda i: db.getUserByUserid(picks.userid(i)), 10000),
+        Benchmark('addUser', lambda i: db.addUser(newUser(i)), 1000),
+        Benchmark('deleteUserByUserId', lambda i: db.deleteUserByUserId(newUser(i).userid), 1000),
+        Benchmark('addUsers', lambda i: db.addUsers(batch(i)), 10, cleanup=deleteBatches),
+        Benchmark('updateUser', lambda i: db.updateUser(user(i)), 1000),
+        Benchmark('userHasGroup', lambda i: db.userHasGroup(db.getUserByUserid(picks.userid(i)), group), 10000),
+        Benchmark('addGroupToUser', lambda i: toggle(i, True), 1000, setup=addToggleGroup),
+        Benchmark('removeGroupFromUser', lambda i: toggle(i, False), 1000, cleanup=removeGroup('bench-toggle')),
+        Benchmark('pageUsers', lambda i: db.pageUsers(100), 1000),
+        Benchmark('pageUsers (after)', lambda i: db.pageUsers(100, picks.userid(i)), 1000),
+        Benchmark('pageUsers (group)', lambda i: db.pageUsers(100, picks.userid(i), group=group), 1000),
+        Benchmark('pageUsers (last_name_prefix)', lambda i: db.pageUsers(100, last_name_prefix='Last1'), 1000),
+        Benchmark('iterUserBatches', lambda i: sum(1 for _ in db.iterUserBatches()), 1),
+        Benchmark('iterUsers', lambda i: sum(1 for _ in db.iterUsers()), 1),
+        Benchmark('allUsers', lambda i: db.allUsers(), 1),
+        Benchmark('allGroups', lambda i: db.allGroups(), 10000),
+        Benchmark('groupNameExists', lambda i: db.groupNameExists('group0001'), 10000),
+        Benchmark('groupExists', lambda i: db.groupExists(group), 10000),
+        Benchmark('getGroupByName', lambda i: db.getGroupByName('group0001'), 10000),
+        Benchmark('pageGroups', lambda i: db.pageGroups(20), 10000),
+        Benchmark('addGroupByName', lambda i: db.addGroupByName('bench-group-{:06d}'.format(i)), 100),
+        Benchmark('removeGroupByName', lambda i: db.removeGroupByName('bench-group-{:06d}'.format(i)), 100),
+        Benchmark('addGroup', lambda i: db.addGroup(db.Group('bench-group-object-{:06d}'.format(i))), 100),
+        Benchmark('removeGroup', lambda i: db.removeGroup(db.getGroupByName('bench-group-object-{:06d}'.format(i))), 100),
+        Benchmark('addGroups', lambda i: db.addGroups([db.Group('bench-groups-{:06d}-{}'.format(i, j)) for j in range(10)]),
+                  10, cleanup=removeGroupBatches),
+        Benchmark('getUserIdsForGroup', lambda i: db.getUserIdsForGroup(largest_group), 10),
+        Benchmark('updateGroupMembership', updateMembers, 100, setup=addMembersGroup),
+        Benchmark('changeGroupMembership', changeMembers, 1000, cleanup=removeGroup('bench-members')),
+        Benchmark('countGroupQuery', lambda i: db.countGroupQuery(QUERY), 100),
+        Benchmark('pageGroupQuery', lambda i: db.pageGroupQuery(QUERY, 100), 100),
+        Benchmark('groupStats', lambda i: db.groupStats(), 10000),
+        Benchmark('tableVersion', lambda i: db.tableVersion(), 10000),
+        Benchmark('userVersion', lambda i: db.userVersion(picks.userid(i)), 10000),
+        Benchmark('groupVersion', lambda i: db.groupVersion('group0001'), 10000),
+        Benchmark('changesSince', lambda i: db.changesSince(since[0]), 1000, setup=makeChanges)
+    ]
+
+# A benchmark for each route and method of the web service, named after
+# them, with a few variations
+def routeBenchmarks(client, picks):
+    def check(response, status = 200):
+        assert response.status_code == status, (response.status_code, response.data)
+        return response
+
+    def newUser(i):
+        return {'userid': 'bench-post-{:08d}'.format(i), 'first_name': 'First', 'last_name': 'Last',
+                'groups': ['group0001']}
+
+    def putBody(i):
+        userid, first_name, last_name, group_names = picks.record(i)
+        return userid, {'first_name': first_name, 'last_name': last_name, 'groups': group_names}
+
+    def bulkUsers(i):
+        return [dict(newUser(i), userid='bench-bulk-{:08d}-{:03d}'.format(i, j)) for j in range(100)]
+
+    def deleteBulkUsers(calls):
+        for i in range(calls):
+            for user in bulkUsers(i):
+                check(client.delete('/users/' + user['userid']))
+
+    def removeBulkGroups(calls):
+        for i in range(calls):
+            for j in range(10):
+                check(client.delete('/groups/bench-bulk-group-{:06d}-{}'.format(i, j)))
+
+    def put(i):
+        userid, body = putBody(i)
+        check(client.put('/users/' + userid, json=body))
+
+    def addMembersGroup():
+        check(client.post('/groups/', json={'name': 'bench-route-members'}))
+
+    def putMembers(i):
+        check(client.put('/groups/bench-route-members', json={'userids': picks.members if i % 2 else picks.more_members}))
+
+    def patchMembers(i):
+        members, more_members = (picks.members, picks.more_members) if i % 2 else (picks.more_members, picks.members)
+        check(client.patch('/groups/bench-route-members', json={'add': members[:10], 'remove': more_members[:10]}))
+
+    def removeMembersGroup(calls):
+        check(client.delete('/groups/bench-route-members'))
+
+    since = []
+
+    def makeChanges():
+        since.append(client.get('/changes').get_json()['next_since'])
+
+        for i in range(100):
+            put(i)
+
+    return [
+        Benchmark('GET /', lambda i: check(client.get('/')), 1000),
+        Benchmark('GET /users/', lambda i: check(client.get('/users/?limit=100')), 300),
+        Benchmark('GET /users/ (group)', lambda i: check(client.get('/users/?limit=100&group=group0001')), 300),
+        Benchmark('GET /users/ (last_name_prefix)',
+                  lambda i: check(client.get('/users/?limit=100&last_name_prefix=Last1')), 300),
+        Benchmark('POST /users/', lambda i: check(client.post('/users/', json=newUser(i)), 201), 500),
+        Benchmark('DELETE /users/<userid>', lambda i: check(client.delete('/users/' + newUser(i)['userid'])), 500),
+        Benchmark('GET /users/<userid>', lambda i: check(client.get('/users/' + picks.userid(i))), 3000),
+        Benchmark('PUT /users/<userid>', put, 1000),
+        Benchmark('POST /users/:bulk', lambda i: check(client.post('/users/:bulk', json=bulkUsers(i)), 201), 10,
+                  cleanup=deleteBulkUsers),
+        Benchmark('GET /users/export', lambda i: check(client.get('/users/export')).data, 1),
+        Benchmark('GET /groups/', lambda i: check(client.get('/groups/?limit=20')), 1000),
+        Benchmark('POST /groups/', lambda i: check(client.post('/groups/', json={'name': 'bench-post-{:06d}'.format(i)})), 100),
+        Benchmark('DELETE /groups/<groupname>', lambda i: check(client.delete('/groups/bench-post-{:06d}'.format(i))), 100),
+        Benchmark('POST /groups/:bulk',
+                  lambda i: check(client.post('/groups/:bulk', json=[{'name': 'bench-bulk-group-{:06d}-{}'.format(i, j)}
+                                                                    for j in range(10)]), 201),
+                  10, cleanup=removeBulkGroups),
+        Benchmark('GET /groups/:query', lambda i: check(client.get('/groups/:query', query_string={'q': QUERY, 'limit': 100})), 100),
+        Benchmark('GET /groups/<groupname>', lambda i: check(client.get('/groups/group0001')), 100),
+        Benchmark('PUT /groups/<groupname>', putMembers, 100, setup=addMembersGroup),
+        Benchmark('PATCH /groups/<groupname>', patchMembers, 1000, cleanup=removeMembersGroup),
+        Benchmark('GET /stats', lambda i: check(client.get('/stats')), 1000),
+        Benchmark('GET /metrics', lambda i: check(client.get('/metrics')), 100),
+        Benchmark('GET /changes', lambda i: check(client.get('/changes', query_string={'since': since[0]})), 1000,
+                  setup=makeChanges)
+    ]
+
+# Run a benchmark for `repeat` rounds of its number of calls
+def run(benchmark, repeat):
+    if benchmark.setup is not None:
+        benchmark.setup()
+
+    call = benchmark.call
+    number = benchmark.number
+    times = []
+
+    for round_number in range(repeat):
+        first = round_number * number
+        start = time.perf_counter()
+
+        for i in range(first, first + number):
+            call(i)
+
+        times.append((time.perf_counter() - start) / number)
+
+    if benchmark.cleanup is not None:
+        benchmark.cleanup(number * repeat)
+
+    return {
+        'median_us': statistics.median(times) * 1e6,
+        'best_us': min(times) * 1e6,
+        'calls': benchmark.number * repeat
+    }
+
+# The public functions and routes that have no benchmark
+def uncovered(db, app, names):
+    covered = set(name.split(' (')[0] for name in names)
+    functions = ['fake_db.' + name for name, value in vars(db).items()
+                 if not name.startswith('_') and callable(value) and getattr(value, '__module__', None) == db.__name__
+                 and not isinstance(value, type) and name not in NOT_BENCHMARKED]
+    routes = ['{} {}'.format(method, rule.rule) for rule in app.url_map.iter_rules() if rule.endpoint != 'static'
+              for method in sorted(rule.methods - {'HEAD', 'OPTIONS'})]
+
+    return sorted(name for name in functions + routes if name not in covered)
+
+def benchmark(args):
+    os.environ['FAKE_DB_BACKEND'] = 'memory'
+    module = loadApp()
+    db = module.fake_db
+
+    dataset = Dataset(args.users, args.groups, args.skew, args.groups_per_user)
+    start = time.perf_counter()
+    dataset.load(db)
+    load_seconds = time.perf_counter() - start
+
+    picks = Picks(db, dataset)
+    benchmarks = [Benchmark('fake_db.' + each.name, each.call, each.number, each.setup, each.cleanup)
+                  for each in dbBenchmarks(db, picks)]
+    benchmarks += routeBenchmarks(module.app.test_client(), picks)
+
+    missing = uncovered(db, module.app, [each.name for each in benchmarks])
+    if missing:
+        print('no benchmark for: {}'.format(', '.join(missing)), file=sys.stderr)
+
+    results = {}
+
+    for each in benchmarks:
+        if args.only is None or args.only in each.name:
+            results[each.name] = run(each, args.repeat)
+            print('{:45} {:12.2f} us'.format(each.name, results[each.name]['median_us']), file=sys.stderr)
+
+    output = json.dumps({
+        'commit': commit(),
+        'python': sys.version.split()[0],
+        'dataset': dict(dataset.describe(), load_seconds=load_seconds),
+        'repeat': args.repeat,
+        'results': results
+    }, indent=2)
+
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+
+# Compare two sets of results, returning the benchmarks that got slower
+# by more than the threshold
+def compare(before_path, after_path, threshold):
+    with open(before_path) as before_file, open(after_path) as after_file:
+        before = json.load(before_file)['results']
+        after = json.load(after_file)['results']
+
+    ratios = sorted(((after[name]['median_us'] / before[name]['median_us'], name) for name in before if name in after),
+                    reverse=True)
+
+    for ratio, name in ratios:
+        print('{:45} {:12.2f} {:12.2f} us {:8.2f}x{}'.format(
+            name, before[name]['median_us'], after[name]['median_us'], ratio, '  SLOWER' if ratio > threshold else ''))
+
+    return [name for ratio, name in ratios if ratio > threshold]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--groups', type=int, default=50)
+    parser.add_argument('--skew', type=float, default=1.0)
+    parser.add_argument('--groups-per-user', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only')
+    parser.add_argument('--output')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'))
+    parser.add_argument('--threshold', type=float, default=1.2)
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.threshold) else 0)
+
+    benchmark(args)
+
+if __name__ == '__main__':
+    main()
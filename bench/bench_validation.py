@@ -0,0 +1,91 @@
+# Compare the request parsers built once by validation.parser() with
+# building a reqparse.RequestParser per request, as the endpoints used
+# to, on the body of a POST /users/: the parsing on its own, inside a
+# request context, and end to end through POST and PUT requests.
+#
+#     python bench/bench_validation.py [--requests 20000]
+
+import argparse
+import ast
+import importlib.util
+import json
+import os
+import sys
+import time
+
+from flask_restful import reqparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import validation
+from validation import Argument, STRING_LIST
+
+BODY = {'userid': 'hsolo', 'first_name': 'Han', 'last_name': 'Solo', 'groups': ['users', 'pirates']}
+
+def loadApp():
+    spec = importlib.util.spec_from_file_location('python_eval', os.path.join(ROOT, 'python-eval.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# What UsersEndpoint did for every POST
+def parseWithReqparse():
+    request_parser = reqparse.RequestParser()
+    request_parser.add_argument('userid', type=str, required=True, help='No userid provided', location='json')
+    request_parser.add_argument('first_name', type=str, required=True, help='No first name provided', location='json')
+    request_parser.add_argument('last_name', type=str, required=True, help='No last name provided', location='json')
+    request_parser.add_argument('groups', type=str, required=True, help='No groups defined', location='json')
+
+    args = request_parser.parse_args()
+    args['groups'] = ast.literal_eval(args['groups'])
+    return args
+
+parseCompiled = validation.parser([
+    Argument('userid', required=True, help='No userid provided'),
+    Argument('first_name', required=True, help='No first name provided'),
+    Argument('last_name', required=True, help='No last name provided'),
+    Argument('groups', type=STRING_LIST, required=True, help='No groups defined')
+], 'json')
+
+def timeParse(app, parse, requests):
+    with app.test_request_context('/users/', method='POST', json=BODY):
+        start = time.perf_counter()
+
+        for _ in range(requests):
+            parse()
+
+        return (time.perf_counter() - start) / requests
+
+def timeRequests(client, requests):
+    start = time.perf_counter()
+
+    for i in range(requests):
+        userid = 'bench{:07d}'.format(i)
+        response = client.post('/users/', json=dict(BODY, userid=userid))
+        assert response.status_code == 201
+
+        response = client.put('/users/' + userid, json=BODY)
+        assert response.status_code == 200
+
+    return (time.perf_counter() - start) / (2 * requests)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=20000)
+    args = parser.parse_args()
+
+    module = loadApp()
+    client = module.app.test_client()
+
+    print(json.dumps({
+        'requests': args.requests,
+        'parse_us': {
+            'reqparse': timeParse(module.app, parseWithReqparse, args.requests) * 1e6,
+            'compiled': timeParse(module.app, parseCompiled, args.requests) * 1e6
+        },
+        'post_put_request_us': timeRequests(client, args.requests) * 1e6
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+# Request throughput with 1, 2, 4 and 8 worker processes sharing one
+# store server (FAKE_DB_BACKEND=remote), against a single process
+# serving the in-memory database directly.  Each worker drives the
+# web service through Flask's test client with a read-heavy mix: 90%
+# single user lookups, 9% pages of users and 1% updates.  Workers can
+# only beat a single process when there are cores for them to run on.
+#
+#     python bench/bench_workers.py [--users 100000] [--seconds 5]
+
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import queue
+import random
+import secrets
+import subprocess
+import sys
+import tempfile
+import time
+
+# How long to wait on a worker, beyond the time it's meant to run for
+WORKER_TIMEOUT = 60
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def loadApp():
+    spec = importlib.util.spec_from_file_location('python_eval', os.path.join(ROOT, 'python-eval.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def addUsers(db, count):
+    groups = [db.getGroupByName(name) for name in ["users", "admins", "execs", "pirates"]]
+
+    for i in range(count):
+        db.addUser(db.User("bench{:07d}".format(i), "First{}".format(i), "Last{}".format(i), groups[:1 + i % 4]))
+
+# One worker: load the app, wait for the others, run the request mix
+# for `seconds` and then report how many requests it got through
+def work(slot, users, seconds, ready, go, results):
+    client = loadApp().app.test_client()
+    chooser = random.Random(slot)
+    requests = 0
+
+    ready.put(slot)
+    go.wait()
+    stop = time.time() + seconds
+
+    while time.time() < stop:
+        userid = "bench{:07d}".format(chooser.randrange(users))
+        dice = chooser.random()
+
+        if dice < 0.9:
+            response = client.get('/users/' + userid)
+        elif dice < 0.99:
+            response = client.get('/users/?limit=20')
+        else:
+            response = client.put('/users/' + userid, json={
+                'first_name': 'First', 'last_name': 'Last', 'groups': ['users']
+            })
+
+        assert response.status_code == 200
+        requests += 1
+
+    results.put(requests)
+
+# Workers for the in-memory database are forked, so that they start out
+# with the users already added, and workers for the store server are
+# started from scratch, so that they pick up FAKE_DB_BACKEND=remote
+def run(users, workers, seconds, start_method):
+    context = multiprocessing.get_context(start_method)
+    ready = context.Queue()
+    go = context.Event()
+    results = context.Queue()
+    processes = [context.Process(target=work, args=(slot, users, seconds, ready, go, results))
+                 for slot in range(workers)]
+
+    for process in processes:
+        process.start()
+
+    try:
+        # Start the clock once every worker has loaded the app
+        for process in processes:
+            ready.get(timeout=WORKER_TIMEOUT)
+
+        go.set()
+
+        total = sum(results.get(timeout=seconds + WORKER_TIMEOUT) for _ in processes)
+
+    # A worker that died (a failed request, say) never reports back
+    except queue.Empty:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+        sys.exit('a worker stopped without reporting; exit codes {}'.format([process.exitcode for process in processes]))
+
+    for process in processes:
+        process.join()
+
+    return round(total / seconds)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    os.environ['FAKE_DB_BACKEND'] = 'memory'
+    import database.fake_db as db
+    addUsers(db, args.users)
+
+    results = {'users': args.users, 'cpus': os.cpu_count(), 'memory_one_process': run(args.users, 1, args.seconds, 'fork'),
+               'remote': {}}
+
+    directory = tempfile.mkdtemp()
+    address = os.path.join(directory, 'fake_db.sock')
+
+    # Fill the server's database through a client of its own
+    os.environ.setdefault('FAKE_DB_AUTHKEY', secrets.token_hex(16))
+    server = subprocess.Popen([sys.executable, '-m', 'database.store_server', '--address', address], cwd=ROOT)
+
+    try:
+        while not os.path.exists(address):
+            time.sleep(0.05)
+
+        from database import remote_db
+        remote_db.openDatabase(address, os.environ['FAKE_DB_AUTHKEY'])
+        addUsers(remote_db, args.users)
+        remote_db.closeDatabase()
+
+        os.environ['FAKE_DB_BACKEND'] = 'remote'
+        os.environ['FAKE_DB_ADDRESS'] = address
+
+        for workers in [1, 2, 4, 8]:
+            results['remote'][workers] = run(args.users, workers, args.seconds, 'spawn')
+
+    finally:
+        server.terminate()
+        server.wait()
+        os.rmdir(directory)
+
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
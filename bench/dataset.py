@@ -0,0 +1,75 @@
+# Synthetic directories for the benchmarks: `users` users and `groups`
+# groups, with first and last names drawn from pools so that they repeat
+# the way real names do, and group sizes skewed the way real ones are.
+# Group k is picked with weight 1 / (k + 1) ** skew, so with the
+# default skew of 1 the first group is about twice the size of the
+# second and a hundred times the size of the hundredth.  Each user is
+# in anything from none to twice groups_per_user groups.  The same
+# arguments always generate the same directory.
+
+from bisect import bisect_right
+import random
+
+FIRST_NAMES = 500
+LAST_NAMES = 5000
+
+class Dataset:
+    def __init__(self, users = 100000, groups = 50, skew = 1.0, groups_per_user = 3, seed = 42):
+        self.users = users
+        self.groups = groups
+        self.skew = skew
+        self.groups_per_user = groups_per_user
+        self.seed = seed
+
+        self.group_names = ["group{:04d}".format(k) for k in range(groups)]
+        self.userids = ["user{:08d}".format(i) for i in range(users)]
+
+    # What the directory looks like, for the benchmark results
+    def describe(self):
+        return {
+            'users': self.users,
+            'groups': self.groups,
+            'skew': self.skew,
+            'groups_per_user': self.groups_per_user,
+            'seed': self.seed
+        }
+
+    # (userid, first_name, last_name, group names) for every user
+    def records(self):
+        chooser = random.Random(self.seed)
+        cumulative = []
+        total = 0.0
+
+        for k in range(self.groups):
+            total += 1.0 / (k + 1) ** self.skew
+            cumulative.append(total)
+
+        most = min(2 * self.groups_per_user, self.groups)
+
+        for userid in self.userids:
+            picked = set()
+
+            for _ in range(chooser.randint(0, most)):
+                picked.add(bisect_right(cumulative, chooser.random() * total))
+
+            yield (userid,
+                   "First{}".format(chooser.randrange(FIRST_NAMES)),
+                   "Last{}".format(chooser.randrange(LAST_NAMES)),
+                   [self.group_names[k] for k in sorted(picked)])
+
+    # Fill a database (anything with the fake_db API) with the directory,
+    # a batch of users at a time
+    def load(self, db, batch_size = 1000):
+        db.addGroups([db.Group(name) for name in self.group_names])
+        groups = dict((name, db.getGroupByName(name)) for name in self.group_names)
+        batch = []
+
+        for userid, first_name, last_name, group_names in self.records():
+            batch.append(db.User(userid, first_name, last_name, [groups[name] for name in group_names]))
+
+            if len(batch) == batch_size:
+                db.addUsers(batch)
+                batch = []
+
+        if batch:
+            db.addUsers(batch)
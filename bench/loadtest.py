@@ -0,0 +1,187 @@
+# Replay recorded traffic against a running web service, with a given
+# number of threads or processes, and report the throughput and the
+# 50th, 95th and 99th percentile latencies of each route.
+#
+# Record traffic by starting the service with RECORD_REQUESTS set to a
+# file (see recording.py), which gets a line of JSON per request, then
+# replay it:
+#
+#     RECORD_REQUESTS=traffic.jsonl python python-eval.py
+#     python bench/loadtest.py traffic.jsonl [--url http://localhost:5000] [--threads 8 | --processes 8]
+#                              [--repeat 1] [--timeout 30] [--output results.json]
+#
+# The recorded requests are dealt out to the workers in turn, so each
+# worker sends its share in the order it was recorded, and each worker
+# sends them one after another over its own keep-alive connection, as
+# fast as the service answers.  A request counts as an error if the
+# connection fails, if it gets a 5xx, or if its status differs from the
+# one it got when it was recorded (the directory has to be in the same
+# state for those to match; replay against the data it was recorded
+# against).  A recorded 304 that gets a 200 is a match: ETags carry an
+# epoch that's new every time the service starts, so a recorded
+# If-None-Match can't match on a fresh instance.  Nothing but the
+# service itself is needed.
+
+import argparse
+import http.client
+import json
+import multiprocessing
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+PERCENTILES = [50, 95, 99]
+
+def readRecording(path):
+    with open(path) as recording:
+        return [json.loads(line) for line in recording if line.strip()]
+
+# The route a recorded request is reported under: the route it matched
+# when it was recorded, or its path if it matched none
+def routeOf(entry):
+    return '{} {}'.format(entry['method'], entry['route'] or entry['path'])
+
+# Whether a replayed request got the status it was recorded with, where
+# a 200 for a recorded 304 is as good (see above)
+def statusMatches(recorded, status):
+    return status == recorded or (recorded == 304 and status == 200)
+
+# Send entries one at a time, returning (route, status, matched, seconds)
+# for each, where status is None if the request failed and matched
+# says whether it got the status it got when it was recorded
+def replay(url, entries, timeout):
+    parts = urlsplit(url)
+    connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+    connection = None
+    results = []
+
+    for entry in entries:
+        target = parts.path.rstrip('/') + entry['path'] + ('?' + entry['query'] if entry['query'] else '')
+        body = entry['body'].encode('utf-8', 'surrogateescape') if entry['body'] else None
+        start = time.perf_counter()
+
+        try:
+            if connection is None:
+                connection = connection_class(parts.netloc, timeout=timeout)
+
+            connection.request(entry['method'], target, body=body, headers=entry['headers'])
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+
+            if response.will_close:
+                connection.close()
+                connection = None
+        except (OSError, http.client.HTTPException) as e:
+            print(str(e), file=sys.stderr)
+            status = None
+
+            if connection is not None:
+                connection.close()
+                connection = None
+
+        results.append((routeOf(entry), status, statusMatches(entry.get('status'), status), time.perf_counter() - start))
+
+    if connection is not None:
+        connection.close()
+
+    return results
+
+# One worker's share of the entries, for a process pool
+def replayShare(arguments):
+    return replay(*arguments)
+
+# The value below which `percent` percent of the sorted values fall
+def percentile(values, percent):
+    return values[max(0, -(-len(values) * percent // 100) - 1)]
+
+def report(results, seconds):
+    routes = {}
+
+    for route, status, matched, latency in results:
+        routes.setdefault(route, []).append((status, matched, latency))
+
+    def summary(requests):
+        latencies = sorted(latency for _, _, latency in requests)
+        statuses = {}
+
+        for status, _, _ in requests:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+        row = {
+            'requests': len(requests),
+            'errors': sum(1 for status, matched, _ in requests if status is None or status >= 500 or not matched),
+            'statuses': statuses,
+            'requests_per_second': len(requests) / seconds,
+            'mean_ms': statistics.mean(latencies) * 1e3
+        }
+
+        for percent in PERCENTILES:
+            row['p{}_ms'.format(percent)] = percentile(latencies, percent) * 1e3
+
+        return row
+
+    return {
+        'seconds': seconds,
+        'total': summary([request for requests in routes.values() for request in requests]),
+        'routes': dict((route, summary(requests)) for route, requests in sorted(routes.items()))
+    }
+
+def printReport(results):
+    print('{:40} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9}'.format('route', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+                                                             'p99 ms'), file=sys.stderr)
+
+    for route, row in list(results['routes'].items()) + [('total', results['total'])]:
+        print('{:40} {:8} {:7} {:9.1f} {:9.2f} {:9.2f} {:9.2f}'.format(
+            route, row['requests'], row['errors'], row['requests_per_second'], row['p50_ms'], row['p95_ms'],
+            row['p99_ms']), file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('recording')
+    parser.add_argument('--url', default='http://localhost:5000')
+    workers = parser.add_mutually_exclusive_group()
+    workers.add_argument('--threads', type=int)
+    workers.add_argument('--processes', type=int)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    entries = readRecording(args.recording) * args.repeat
+
+    if not entries:
+        sys.exit('{} has no requests in it'.format(args.recording))
+
+    count = args.processes or args.threads or 1
+    shares = [(args.url, entries[i::count], args.timeout) for i in range(count)]
+    start = time.perf_counter()
+
+    if args.processes:
+        with multiprocessing.Pool(count) as pool:
+            shares = pool.map(replayShare, shares)
+    else:
+        with ThreadPoolExecutor(count) as pool:
+            shares = list(pool.map(replayShare, shares))
+
+    seconds = time.perf_counter() - start
+    results = report([result for share in shares for result in share], seconds)
+    results.update({
+        'url': args.url,
+        'workers': count,
+        'worker_kind': 'processes' if args.processes else 'threads'
+    })
+
+    printReport(results)
+    output = json.dumps(results, indent=2)
+
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# A set of non-negative integers stored as a bitmap cut into blocks of
+# 2 ** SHIFT bits.  Only blocks with a bit set are kept, each one a
+# Python int, so a sparse set takes up little room, adding or removing
+# a number only rebuilds its own block rather than the whole bitmap,
+# and set algebra only has to visit the blocks the operands have.
+
+class Bitmap:
+    __slots__ = ('_blocks',)
+
+    SHIFT = 12
+    LOW = (1 << SHIFT) - 1
+
+    def __init__(self, numbers = ()):
+        self._blocks = {}
+
+        for number in numbers:
+            self.add(number)
+
+    # A bitmap of every number from 0 up to (but not including) stop
+    @classmethod
+    def upTo(cls, stop):
+        bitmap = cls()
+        full, rest = stop >> cls.SHIFT, stop & cls.LOW
+
+        for block in range(full):
+            bitmap._blocks[block] = (1 << (cls.LOW + 1)) - 1
+
+        if rest:
+            bitmap._blocks[full] = (1 << rest) - 1
+
+        return bitmap
+
+    def add(self, number):
+        block = number >> self.SHIFT
+        self._blocks[block] = self._blocks.get(block, 0) | 1 << (number & self.LOW)
+
+    def discard(self, number):
+        block = number >> self.SHIFT
+        bits = self._blocks.get(block)
+
+        if bits is not None:
+            bits &= ~(1 << (number & self.LOW))
+
+            if bits:
+                self._blocks[block] = bits
+            else:
+                del self._blocks[block]
+
+    def clear(self):
+        self._blocks.clear()
+
+    def __contains__(self, number):
+        return (self._blocks.get(number >> self.SHIFT, 0) >> (number & self.LOW)) & 1 == 1
+
+    def __len__(self):
+        return sum(bin(bits).count("1") for bits in self._blocks.values())
+
+    def __and__(self, other):
+        small, large = sorted([self._blocks, other._blocks], key = len)
+        return self._fromBlocks((block, bits & large.get(block, 0)) for block, bits in small.items())
+
+    def __or__(self, other):
+        blocks = dict(self._blocks)
+
+        for block, bits in other._blocks.items():
+            blocks[block] = blocks.get(block, 0) | bits
+
+        return self._fromBlocks(blocks.items())
+
+    def __sub__(self, other):
+        return self._fromBlocks((block, bits & ~other._blocks.get(block, 0)) for block, bits in self._blocks.items())
+
+    def __iter__(self):
+        return self.iterFrom()
+
+    # Iterate in ascending order over the numbers after `after`, or over
+    # all of them if it's None
+    def iterFrom(self, after = None):
+        first = -1 if after is None else after >> self.SHIFT
+
+        for block in sorted(self._blocks):
+            if block < first:
+                continue
+
+            bits = self._blocks[block]
+            base = block << self.SHIFT
+
+            # Clear the bits up to and including `after`
+            if block == first:
+                bits &= ~((2 << (after & self.LOW)) - 1)
+
+            while bits:
+                low_bit = bits & -bits
+                yield base + low_bit.bit_length() - 1
+                bits ^= low_bit
+
+    @classmethod
+    def _fromBlocks(cls, blocks):
+        bitmap = cls()
+        bitmap._blocks = dict((block, bits) for block, bits in blocks if bits)
+        return bitmap
@@ -0,0 +1,112 @@
+import weakref
+
+# The pieces the backends share.  The SQLite and remote backends both
+# keep their records somewhere else, so both hand out User objects
+# through an identity map that they bring into line with whatever the
+# database says, and every backend pages through its users the same way.
+
+# Lazily iterate over every user in userid order, in lists of up to
+# batch_size users, getting each batch from pageUsers.  Each batch
+# restarts from the last userid seen rather than holding an iterator
+# open, so users can be added or deleted while an iteration is in
+# progress without it blowing up.
+def iterUserBatches(pageUsers, batch_size = 1000):
+    users, next_key = pageUsers(batch_size)
+
+    while users:
+        yield users
+
+        if next_key is None:
+            return
+
+        users, next_key = pageUsers(batch_size, next_key)
+
+# Lazily iterate over every user in userid order
+def iterUsers(pageUsers, batch_size = 1000):
+    for users in iterUserBatches(pageUsers, batch_size):
+        for user in users:
+            yield user
+
+# userid -> the User object last stored or handed out for it, for a
+# backend whose records live outside this process, along with the
+# listeners to tell about the changes this process makes.
+class IdentityMap(object):
+    def __init__(self):
+        self.users = weakref.WeakValueDictionary()
+        self.change_listeners = []
+
+    def addChangeListener(self, listener):
+        self.change_listeners.append(listener)
+
+    def changed(self, kind, key):
+        for listener in self.change_listeners:
+            listener(kind, key)
+
+    def userChanged(self, userid, group_names):
+        self.changed("user", userid)
+
+        for group_name in group_names:
+            self.changed("group", group_name)
+
+    # A user has been stored, replacing one in old_group_names if any
+    def stored(self, user, old_group_names = ()):
+        self.users[user.userid] = user
+        self.userChanged(user.userid, list(old_group_names) + [group.name for group in user.groups])
+
+    def deleted(self, userid, group_names):
+        self.users.pop(userid, None)
+        self.userChanged(userid, group_names)
+
+    def clear(self):
+        self.users.clear()
+
+    # True if this user object is the one the identity map hands out
+    # rather than a detached copy that happens to share its userid.
+    def isIndexed(self, user):
+        return self.users.get(user.userid) is user
+
+    # The User for a record and its group names: the one in the
+    # identity map if the database still agrees with it, otherwise a
+    # new one that replaces it there.
+    def user(self, userid, first_name, last_name, group_names):
+        user = self.users.get(userid)
+
+        if user is None or user.first_name != first_name or user.last_name != last_name or \
+                set(group.name for group in user.groups) != set(group_names):
+            user = self.users[userid] = fake_db.User(userid, first_name, last_name,
+                                                     [fake_db._internedGroup(name) for name in group_names])
+
+        return user
+
+    # Add a group to (or remove it from) a user.  Whether the stored
+    # user was already in it is up to the database, not the object,
+    # which another process may have made out of date: change(userid,
+    # group_name) makes the change there and says whether it did.
+    def changeMembership(self, user, group, add, change):
+        if self.isIndexed(user) and change(user.userid, group.name):
+            if add:
+                self.membershipChanged(group, [], [user.userid])
+            else:
+                self.membershipChanged(group, [user.userid], [])
+        elif add:
+            user.groups.add(group)
+        else:
+            user.groups.discard(group)
+
+    # Bring the user objects in the identity map into line with a
+    # membership change the database has made, and tell the listeners.
+    def membershipChanged(self, group, removed_userids, added_userids):
+        for userids, change in [(removed_userids, 'discard'), (added_userids, 'add')]:
+            for userid in userids:
+                user = self.users.get(userid)
+
+                if user is not None:
+                    getattr(user.groups, change)(group)
+
+                self.changed("user", userid)
+
+        self.changed("group", group.name)
+
+# Imported last, since fake_db switches over to the backends that use
+# IdentityMap as it loads
+from database import fake_db
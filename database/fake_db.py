@@ -1,78 +1,1057 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, deque
+from functools import wraps
+from itertools import islice, takewhile
+import heapq
+import os
+import sys
+import threading
+from database import common
+from database.bitmap import Bitmap
+from database.group_query import parseGroupQuery
+from database.rwlock import ReadWriteLock
+from database.sortedset import SortedSet
+
+# Users are split into shards by a hash of their userid.  Each shard
+# has its own indexes and its own readers/writer lock, and the groups
+# have one more lock, the catalog lock, to themselves.  A lookup or a
+# change that's about one user only locks that user's shard (plus the
+# catalog for reading, if it needs the groups to hold still), so
+# writes to users in different shards don't wait for each other.
+# Anything that spans users (paging, removeGroup, updateGroupMembership)
+# locks every shard, which gives it a consistent view of all of them.
+#
+# Locks are always taken in the same order, the catalog and then the
+# shards in shard order, and only ever re-taken (never upgraded) while
+# held, so no two threads can end up waiting on each other.
+#
+# A mutation's log record is appended while its locks are held, so
+# records for the same user or group are in the same order as the
+# changes, but it's only fsync'd once the locks have been released.
+# That keeps one slow disk write from holding up readers and lets
+# concurrent writers share an fsync; the mutation still doesn't return
+# until its record is durable.
+
+READ = "read"
+WRITE = "write"
+
+# Raised by addUsers and addGroups when any item in the batch is no
+# good.  errors holds an (index, message) pair for each one that isn't.
+class BatchError(ValueError):
+    def __init__(self, errors):
+        super(BatchError, self).__init__("{} of the items in the batch are invalid".format(len(errors)))
+        self.errors = errors
+
+class _Shard:
+    def __init__(self):
+        self.lock = ReadWriteLock()
+
+        # Primary index: userid -> User
+        self.users = {}
+
+        # Membership index: group name -> SortedSet of the userids of
+        # the group's members in this shard
+        self.group_members = {}
+
+        # Ordering indexes used for paging: userids and
+        # (last_name, userid) pairs, each kept in sorted order.
+        self.user_order = SortedSet()
+        self.last_name_index = SortedSet()
+
+        # Users in the base snapshot that have since been deleted
+        self.base_deleted = set()
+
+# The catalog lock taken for reading or writing (or not at all), and
+# the shards' locks likewise, for the duration of a with block.
+class _Locks:
+    __slots__ = ('catalog', 'shards', 'mode')
+
+    def __init__(self, catalog, shards, mode):
+        self.catalog = catalog
+        self.shards = shards
+        self.mode = mode
+
+    def __enter__(self):
+        if self.catalog is not None:
+            _acquire(catalog_lock, self.catalog)
+
+        taken = 0
+
+        try:
+            if self.mode == WRITE:
+                for shard in self.shards:
+                    shard.lock.acquireWrite()
+                    taken += 1
+            else:
+                for shard in self.shards:
+                    shard.lock.acquireRead()
+                    taken += 1
+
+        except:
+            self._release(taken)
+            raise
+
+        held.depth = getattr(held, 'depth', 0) + 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._release(len(self.shards))
+        held.depth -= 1
+
+        if held.depth == 0:
+            _afterLocks()
+
+    # Let go of the first `shards` shard locks and the catalog lock
+    def _release(self, shards):
+        if self.mode == WRITE:
+            for shard in reversed(self.shards[:shards]):
+                shard.lock.releaseWrite()
+        else:
+            for shard in reversed(self.shards[:shards]):
+                shard.lock.releaseRead()
+
+        if self.catalog is not None:
+            if self.catalog == WRITE:
+                catalog_lock.releaseWrite()
+            else:
+                catalog_lock.releaseRead()
+
+def _acquire(lock, mode):
+    if mode == WRITE:
+        lock.acquireWrite()
+    else:
+        lock.acquireRead()
+
+# Run the decorated function holding the catalog lock in one mode and
+# the shard locks in another.  With a user_key, only the shard of the
+# userid user_key(*args) returns is locked; otherwise all of them are.
+def _locked(catalog = None, shards = None, user_key = None):
+    def decorate(function):
+        @wraps(function)
+        def locked(*args, **kwargs):
+            if shards is None:
+                locked_shards = ()
+            elif user_key is None:
+                locked_shards = all_shards
+            else:
+                locked_shards = (_shardFor(user_key(*args)),)
+
+            with _Locks(catalog, locked_shards, shards):
+                return function(*args, **kwargs)
+
+        return locked
+
+    return decorate
+
+def _userid(userid, *args):
+    return userid
+
+def _useridOf(user, *args):
+    return user.userid
+
+def _shardIndex(userid):
+    return hash(userid) % len(all_shards)
+
+def _shardFor(userid):
+    return all_shards[_shardIndex(userid)]
 
 #  _   _ ___  ___ _ __ ___
 # | | | / __|/ _ \ '__/ __|
 # | |_| \__ \  __/ |  \__ \
 #  \__,_|___/\___|_|  |___/
 
+# Users are slotted, with their groups kept as a bitmask over interned
+# group ids (see GroupSet) rather than a collection of their own, and
+# their names interned, since names repeat a lot across a directory.
+# With tens of millions of users, the per-object overhead of a __dict__
+# and a separate groups object would be most of the memory they take.
+# (__weakref__ is for the identity maps of the other backends.)
+#
+# Group ids are never reused, so in a directory where groups come and
+# go a user's mask would grow with the newest group id rather than with
+# the number of groups the user is in.  A mask that's mostly zeros is
+# stored as a sorted array of the ids instead (see _packGroups), and
+# group_mask turns it back into a mask.
 class User:
+    __slots__ = ('userid', 'first_name', 'last_name', 'packed_groups', '__weakref__')
+
     def __init__(self, userid, first_name, last_name, groups = None):
         self.userid = userid
-        self.first_name = first_name
-        self.last_name = last_name
+        self.first_name = _intern(first_name)
+        self.last_name = _intern(last_name)
+        self.groups = groups
+
+    # Whatever iterable of groups gets assigned is stored as a mask
+    @property
+    def groups(self):
+        return GroupSet(self)
 
-        if groups == None:
-            self.groups = []
+    @groups.setter
+    def groups(self, groups):
+        if groups.__class__ is GroupSet:
+            self.packed_groups = groups.user.packed_groups
         else:
-            self.groups = groups
+            mask = 0
+
+            for group in groups if groups is not None else ():
+                mask |= 1 << _internGroup(group)
+
+            self.group_mask = mask
+
+    @property
+    def group_mask(self):
+        packed = self.packed_groups
+        return packed if packed.__class__ is int else _unpackGroups(packed)
+
+    @group_mask.setter
+    def group_mask(self, mask):
+        self.packed_groups = _packGroups(mask)
+
+def _intern(name):
+    return sys.intern(name) if name.__class__ is str else name
+
+# A mask stays a mask while it's no more than SPARSE_MASK_BITS long, or
+# no more than SPARSE_MASK_BITS bits per group in it; past that the
+# ids take less room as an array of 4 byte ids.
+SPARSE_MASK_BITS = 256
+
+def _packGroups(mask):
+    length = mask.bit_length()
+
+    if length <= SPARSE_MASK_BITS or length <= SPARSE_MASK_BITS * bin(mask).count("1"):
+        return mask
 
+    return _groupIdsOf(mask)
 
-# Return a list of all users.
+# The ids in a packed mask, in order
+def _groupIdsOf(packed):
+    if packed.__class__ is not int:
+        return packed
+
+    ids = array('I')
+
+    while packed:
+        low_bit = packed & -packed
+        ids.append(low_bit.bit_length() - 1)
+        packed ^= low_bit
+
+    return ids
+
+def _unpackGroups(ids):
+    mask = 0
+
+    for group_id in ids:
+        mask |= 1 << group_id
+
+    return mask
+
+
+# A view of a user's group memberships, a bitmask over interned group
+# ids (or their sorted array, for a sparse one).  Membership tests are a
+# single bit test (or a binary search) and iteration yields the Group
+# objects in group id (i.e. group creation) order.  Changes go straight
+# through to the user.
+class GroupSet:
+    __slots__ = ('user',)
+
+    def __init__(self, user):
+        self.user = user
+
+    @property
+    def mask(self):
+        return self.user.group_mask
+
+    # Snapshots being written out keep the groups the user had before
+    # the first change (see _captureUserRecords)
+    @mask.setter
+    def mask(self, mask):
+        user = self.user
+
+        for kept_groups in captured_groups:
+            if user not in kept_groups:
+                kept_groups[user] = user.packed_groups
+
+        user.group_mask = mask
+
+    def add(self, group):
+        self.mask |= 1 << _internGroup(group)
+
+    def discard(self, group):
+        group_id = group_ids.get(group.name)
+
+        if group_id is not None:
+            self.mask &= ~(1 << group_id)
+
+    def __contains__(self, group):
+        group_id = group_ids.get(group.name)
+
+        if group_id is None:
+            return False
+
+        packed = self.user.packed_groups
+
+        if packed.__class__ is int:
+            return (packed >> group_id) & 1 == 1
+
+        index = bisect_left(packed, group_id)
+        return index < len(packed) and packed[index] == group_id
+
+    def __iter__(self):
+        packed = self.user.packed_groups
+
+        if packed.__class__ is not int:
+            for group_id in packed:
+                yield interned_groups[group_id]
+
+            return
+
+        mask = packed
+
+        while mask:
+            low_bit = mask & -mask
+            yield interned_groups[low_bit.bit_length() - 1]
+            mask ^= low_bit
+
+    def __len__(self):
+        packed = self.user.packed_groups
+        return bin(packed).count("1") if packed.__class__ is int else len(packed)
+
+
+# Return a list of all users, in userid order.
+@_locked(catalog = READ, shards = READ)
 def allUsers():
-    return users
+    return list(iterUsers())
 
+@_locked(shards = READ, user_key = _userid)
 def userExistsByUserid(userid):
-    user_list = [user for user in users if user.userid == userid]
-    return len(user_list) >= 1
+    return _userExists(userid)
+
+def _userExists(userid):
+    shard = _shardFor(userid)
+    return userid in shard.users or (_baseOrdinal(userid) >= 0 and userid not in shard.base_deleted)
 
 # Return a particular user that matches the userid
+@_locked(shards = READ, user_key = _userid)
 def getUserByUserid(userid):
-    user_list = [user for user in users if user.userid == userid]
+    user = _user(userid)
 
-    if len(user_list) < 1:
+    if user is None:
         raise LookupError("user with userid '{}' does not exist".format(userid))
 
-    return user_list[0]
+    return user
 
 # Add a new user
+@_locked(catalog = READ, shards = WRITE, user_key = _useridOf)
 def addUser(user):
     if userExistsByUserid(user.userid):
-        raise ValueError("user with userid '{}' already exists")
+        raise ValueError("user with userid '{}' already exists".format(user.userid))
 
     # this'll raise an exception if group doesn't exist
-    for group in user.groups:
-        getGroupByName(group.name)
+    _checkGroupsExist(user.groups)
+
+    _insertUser(user)
+    _logged("addUser", user)
+
+# Add a batch of new users, all or nothing.  Every user is checked
+# first: a BatchError lists each one whose userid is taken (by an
+# existing user or an earlier one in the batch) or that names a group
+# that doesn't exist, and nothing is added.  The batch is logged as
+# one record.
+@_locked(catalog = READ, shards = WRITE)
+def addUsers(new_users):
+    errors = []
+    userids = set()
+
+    for index, user in enumerate(new_users):
+        if user.userid in userids:
+            errors.append((index, "user with userid '{}' is in the batch more than once".format(user.userid)))
+        elif _userExists(user.userid):
+            errors.append((index, "user with userid '{}' already exists".format(user.userid)))
+        else:
+            try:
+                _checkGroupsExist(user.groups)
+            except LookupError as le:
+                errors.append((index, str(le)))
 
-    users.append(user)
+        userids.add(user.userid)
 
-# Update an existing user.  Find the old user by id, make sure the new
-# user's group are legit, delete the old user object, append new one.
+    if errors:
+        raise BatchError(errors)
+
+    for user in new_users:
+        _insertUser(user)
+
+    _logged("addUsers", list(new_users))
+
+def _insertUser(user):
+    shard = _shardFor(user.userid)
+    shard.users[user.userid] = user
+    shard.base_deleted.discard(user.userid)
+    _indexUser(user)
+    _userChanged(user)
+
+# Update an existing user.  Make sure the user exists and that the new
+# user's groups are legit, then swap the new user object into the index.
+@_locked(catalog = READ, shards = WRITE, user_key = _useridOf)
 def updateUser(new_user):
     old_user = getUserByUserid(new_user.userid)
 
     # yep, make sure these groups are legit
-    for group in new_user.groups:
-        getGroupByName(group.name)
+    _checkGroupsExist(new_user.groups)
+
+    _unindexUser(old_user)
+    _shardFor(new_user.userid).users[new_user.userid] = new_user
+    _indexUser(new_user)
 
-    users.remove(old_user)
-    users.append(new_user)
+    _userChanged(old_user)
+    _userChanged(new_user)
+    _logged("updateUser", new_user)
 
 # Delete an existing user
+@_locked(shards = WRITE, user_key = _userid)
 def deleteUserByUserId(userid):
     user = getUserByUserid(userid)
-    users.remove(user)
+    _unindexUser(user)
+
+    shard = _shardFor(userid)
+    del shard.users[userid]
+
+    if _baseOrdinal(userid) >= 0:
+        shard.base_deleted.add(userid)
+
+    _userChanged(user)
+    _logged("deleteUserByUserId", userid)
 
 def userHasGroup(user, group):
-    return len( [user_group for user_group in user.groups if user_group.name == group.name] ) > 0
+    return group in user.groups
 
 # Add a group to a user
+@_locked(catalog = READ, shards = WRITE, user_key = _useridOf)
 def addGroupToUser(user, group):
-    if not userHasGroup(user, group):
-        user.groups.append(group)
+    if _addGroupToUser(user, group):
+        _logged("addGroupToUser", user.userid, group)
 
 # Remove a group from a user
+@_locked(catalog = READ, shards = WRITE, user_key = _useridOf)
 def removeGroupFromUser(user, group):
+    if _removeGroupFromUser(user, group):
+        _logged("removeGroupFromUser", user.userid, group)
+
+# Add a group to a user.  If this is the user object that's stored in
+# the user index, keep the membership index in step and return True.
+def _addGroupToUser(user, group):
+    if not userHasGroup(user, group):
+        user.groups.add(group)
+
+        if _isIndexed(user):
+            _addMember(_shardFor(user.userid), user.userid, group.name)
+            _movedGroupCount(len(user.groups) - 1, len(user.groups))
+            _changed("user", user.userid)
+            _changed("group", group.name)
+            return True
+
+    return False
+
+def _removeGroupFromUser(user, group):
     if userHasGroup(user, group):
-        user.groups.remove(group)
+        user.groups.discard(group)
+
+        if _isIndexed(user):
+            _removeMember(_shardFor(user.userid), user.userid, group.name)
+            _movedGroupCount(len(user.groups) + 1, len(user.groups))
+            _changed("user", user.userid)
+            _changed("group", group.name)
+            return True
+
+    return False
+
+# True if this user object is the one stored in the user index
+# rather than a detached copy that happens to share its userid.
+def _isIndexed(user):
+    return _shardFor(user.userid).users.get(user.userid) is user
+
+# Add a user to (or remove a user from) the ordering indexes and the
+# membership index of each of its groups.  Users in the base snapshot
+# are already in its userid ordering, and in its last name ordering
+# unless their last name has changed since.
+def _indexUser(user):
+    shard = _shardFor(user.userid)
+    ordinal = _baseOrdinal(user.userid)
+
+    if ordinal < 0:
+        shard.user_order.add(user.userid)
+
+    if ordinal < 0 or base.lastName(ordinal) != user.last_name:
+        shard.last_name_index.add((user.last_name, user.userid))
+
+    with bitmap_lock:
+        user_bits.add(_ordinal(user.userid))
+        _countUsers(len(user.groups), 1)
+
+    for group in user.groups:
+        _addMember(shard, user.userid, group.name)
+
+def _unindexUser(user):
+    shard = _shardFor(user.userid)
+    shard.user_order.discard(user.userid)
+    shard.last_name_index.discard((user.last_name, user.userid))
+
+    with bitmap_lock:
+        user_bits.discard(_ordinal(user.userid))
+        _countUsers(len(user.groups), -1)
+
+    for group in user.groups:
+        _removeMember(shard, user.userid, group.name)
+
+# Add a user to (or remove a user from) a group's member index in the
+# user's shard, the group's bitmap and its member count.  The bitmaps
+# and counts are shared by all the shards, so bitmap_lock keeps writers
+# to different shards from changing one at the same time.
+def _addMember(shard, userid, group_name):
+    _members(shard, group_name).add(userid)
+
+    with bitmap_lock:
+        bits = group_bits[group_name]
+        ordinal = _ordinal(userid)
+
+        if ordinal not in bits:
+            bits.add(ordinal)
+            member_counts[group_name] += 1
+
+def _removeMember(shard, userid, group_name):
+    _members(shard, group_name).discard(userid)
+
+    with bitmap_lock:
+        bits = group_bits[group_name]
+        ordinal = _ordinal(userid)
+
+        if ordinal in bits:
+            bits.discard(ordinal)
+            member_counts[group_name] -= 1
+
+# Count `step` more (or fewer) users, in group_count groups each.
+# Only call this with bitmap_lock held.
+def _countUsers(group_count, step):
+    global user_count
+    user_count += step
+    groups_per_user[group_count] += step
+
+# An indexed user went from being in `before` groups to `after` groups
+def _movedGroupCount(before, after):
+    with bitmap_lock:
+        groups_per_user[before] -= 1
+        groups_per_user[after] += 1
+
+# The bitmap ordinal of a userid: its position in the base snapshot, if
+# it's there, and otherwise the next ordinal after those the first time
+# the userid is seen.  Ordinals are never reused, so a userid keeps its
+# ordinal even if the user is deleted and added again.  Only call this
+# with bitmap_lock held (or every shard locked) if the userid might
+# be new.
+def _ordinal(userid):
+    ordinal = _baseOrdinal(userid)
+
+    if ordinal < 0:
+        ordinal = user_ordinals.get(userid)
+
+        if ordinal is None:
+            ordinal = user_ordinals[userid] = first_ordinal + len(ordinal_userids)
+            ordinal_userids.append(userid)
+
+    return ordinal
+
+def _useridAt(ordinal):
+    if ordinal < first_ordinal:
+        return base.userid(ordinal)
+
+    return ordinal_userids[ordinal - first_ordinal]
+
+# Return the user with this userid, or None.  A user that's only in the
+# base snapshot so far is materialized and kept in the user index.
+# That can happen under the read lock, so loading_lock makes sure two
+# readers don't each materialize (and hand out) their own copy.
+def _user(userid):
+    shard = _shardFor(userid)
+    user = shard.users.get(userid)
+
+    if user is None and userid not in shard.base_deleted:
+        ordinal = _baseOrdinal(userid)
+
+        if ordinal >= 0:
+            with loading_lock:
+                user = shard.users.get(userid)
+
+                if user is None:
+                    user = shard.users[userid] = _materialize(ordinal)
+
+    return user
+
+def _materialize(ordinal):
+    userid, first_name, last_name, group_ordinals = base.record(ordinal)
+    user = User(userid, first_name, last_name)
+    mask = 0
+
+    for group_ordinal in group_ordinals:
+        mask |= base_group_bits[group_ordinal]
+
+    user.group_mask = mask
+    return user
+
+# The ordinal of this userid in the base snapshot, or -1
+def _baseOrdinal(userid):
+    return -1 if base is None else base.find(userid)
+
+# A shard's member index for a group.  A group from the base snapshot
+# has its members loaded into every shard, and its bitmap, the first
+# time either is needed.  Only call this for groups that exist.
+def _members(shard, group_name):
+    members = shard.group_members.get(group_name)
+
+    if members is None:
+        with loading_lock:
+            members = shard.group_members.get(group_name)
+
+            if members is None:
+                loaded = [[] for _ in all_shards]
+                ordinals = base.groupMembers(base_groups.pop(group_name))
+
+                for ordinal in ordinals:
+                    userid = base.userid(ordinal)
+                    loaded[_shardIndex(userid)].append(userid)
+
+                # The bitmap goes in first: a writer that finds the
+                # member set in its shard goes on to the bitmap without
+                # waiting for loading_lock
+                with bitmap_lock:
+                    group_bits[group_name] = Bitmap(ordinals)
+
+                for each, userids in zip(all_shards, loaded):
+                    each.group_members[group_name] = SortedSet(userids)
+
+                members = shard.group_members[group_name]
+
+    return members
+
+# The userids of every member of a group, in order, across all shards
+def _groupMembers(group_name):
+    return heapq.merge(*[_members(shard, group_name) for shard in all_shards])
+
+# The userids of the members of a group after the `after` userid, in
+# order: all of them, or just the first `count` of them.
+def _groupUserids(group_name, after, count = None):
+    if count is None:
+        return heapq.merge(*[_members(shard, group_name).iterFrom(after, inclusive = False) for shard in all_shards])
+
+    return _firstKeys([_members(shard, group_name).sliceFrom(after, False, count) for shard in all_shards], count)
+
+# The first `count` keys out of several sorted sources, each holding
+# at most `count` keys.  If a source is full, nothing past its last key
+# can make the cut, so only what's left of the others needs sorting.
+def _firstKeys(sources, count):
+    sources = [source if isinstance(source, list) else list(source) for source in sources]
+    full = [source[-1] for source in sources if len(source) == count]
+    keys = []
+
+    if full:
+        cutoff = min(full)
+
+        for source in sources:
+            keys.extend(source[:bisect_right(source, cutoff)])
+    else:
+        for source in sources:
+            keys.extend(source)
+
+    keys.sort()
+    del keys[count:]
+    return keys
+
+# Serve users straight out of a memory mapped Snapshot, materializing
+# each one only when it's asked for.  The in-memory indexes then only
+# hold what has changed since the snapshot was taken, and the member
+# index for each group is loaded the first time it's needed.  Only
+# for an empty database, i.e. right after _reset().
+def _attachSnapshot(snapshot):
+    global base, first_ordinal, user_bits, user_count
+    base = snapshot
+    first_ordinal = snapshot.user_count
+    user_bits = Bitmap.upTo(snapshot.user_count)
+    user_count = snapshot.user_count
+
+    for group_ordinal, group_name in enumerate(snapshot.group_names):
+        addGroupByName(group_name)
+
+        # Member sets before the bitmap, the reverse of _members
+        for shard in all_shards:
+            del shard.group_members[group_name]
+
+        del group_bits[group_name]
+        member_counts[group_name] = snapshot.groupMemberCount(group_ordinal)
+
+        base_groups[group_name] = group_ordinal
+        base_group_bits.append(1 << group_ids[group_name])
+
+# (userid, ordinal in the base snapshot or -1) for every user after
+# the `after` userid, in userid order
+def _userKeys(after = None):
+    keys = [((userid, -1) for userid in shard.user_order.iterFrom(after, inclusive = False)) for shard in all_shards]
+
+    if base is not None:
+        keys.append(_baseUserKeys(after))
+
+    return heapq.merge(*keys)
+
+# The userids after the `after` userid, in order: all
+# of them, or just the first `count` of them.
+def _userids(after, count = None):
+    if count is None:
+        return (userid for userid, ordinal in _userKeys(after))
+
+    sources = [shard.user_order.sliceFrom(after, False, count) for shard in all_shards]
+
+    if base is not None:
+        sources.append(userid for userid, ordinal in islice(_baseUserKeys(after), count))
+
+    return _firstKeys(sources, count)
+
+def _baseUserKeys(after):
+    ordinal = 0
+
+    if after is not None:
+        ordinal = base.userPosition(after)
+
+        if ordinal < base.user_count and base.userid(ordinal) == after:
+            ordinal += 1
+
+    for ordinal in range(ordinal, base.user_count):
+        userid = base.userid(ordinal)
+
+        if userid not in _shardFor(userid).base_deleted:
+            yield userid, ordinal
+
+# (last_name, userid) keys from start onwards, in order: all
+# of them, or just the first `count` of them.
+def _lastNameKeys(start, inclusive, count = None):
+    if count is None:
+        sources = [shard.last_name_index.iterFrom(start, inclusive) for shard in all_shards]
+    else:
+        sources = [shard.last_name_index.sliceFrom(start, inclusive, count) for shard in all_shards]
+
+    if base is not None:
+        sources.append(islice(_baseLastNameKeys(start, inclusive), count))
+
+    if count is None:
+        return heapq.merge(*sources)
+
+    return _firstKeys(sources, count)
+
+# Keys from the base snapshot's last name ordering, skipping users that
+# have since been deleted or have a different last name now
+def _baseLastNameKeys(start, inclusive):
+    position = base.lastNamePosition(start)
+
+    if not inclusive and position < base.user_count and base.lastNameKey(position) == start:
+        position += 1
+
+    for position in range(position, base.user_count):
+        key = base.lastNameKey(position)
+        last_name, userid = key
+        shard = _shardFor(userid)
+
+        if userid in shard.base_deleted:
+            continue
+
+        user = shard.users.get(userid)
+
+        if user is None or user.last_name == last_name:
+            yield key
+
+# Capture every user record as it stands, for a snapshot, with every
+# lock held.  Only the user index is copied then, which is quick; the
+# records are read afterwards, with the database free to change, by the
+# generator this returns, which yields (userid, first_name, last_name,
+# group names) in userid order without materializing users that are
+# only in the base snapshot.  A stored user object is replaced rather
+# than changed, except for its groups, and those are kept aside the
+# first time they change until the generator is done.
+def _captureUserRecords():
+    global captured_groups
+    users = {}
+    deleted = set()
+
+    for shard in all_shards:
+        users.update(shard.users)
+        deleted.update(shard.base_deleted)
+
+    kept_groups = {}
+    captured_groups = captured_groups + (kept_groups,)
+
+    return _capturedUserRecords(users, deleted, base, kept_groups)
+
+def _capturedUserRecords(users, deleted, snapshot, kept_groups):
+    global captured_groups
+
+    try:
+        keys = [(userid, -1) for userid in sorted(users)]
+
+        if snapshot is not None:
+            keys = heapq.merge(keys, ((snapshot.userid(ordinal), ordinal) for ordinal in range(snapshot.user_count)))
+
+        last_userid = None
+
+        # A user in both comes from the index, which sorts first
+        for userid, ordinal in keys:
+            if userid == last_userid:
+                continue
+
+            last_userid = userid
+            user = users.get(userid)
+
+            if user is not None:
+                packed = kept_groups.get(user, user.packed_groups)
+                group_names = [interned_groups[group_id].name for group_id in _groupIdsOf(packed)]
+                yield userid, user.first_name, user.last_name, group_names
+            elif userid not in deleted:
+                userid, first_name, last_name, group_ordinals = snapshot.record(ordinal)
+                yield userid, first_name, last_name, [snapshot.group_names[group_ordinal] for group_ordinal in group_ordinals]
+
+    finally:
+        captured_groups = tuple(other for other in captured_groups if other is not kept_groups)
+
+# Register a function to be called as listener(kind, key) after every
+# change to the database: ("user", userid) when that user's record
+# changes and ("group", group_name) when a group is added or removed
+# or its member list changes.
+def addChangeListener(listener):
+    change_listeners.append(listener)
+
+def _changed(kind, key):
+    global version
+
+    with change_condition:
+        version += 1
+        versions[kind][key] = version
+        change_log.append((version, kind, key))
+        change_condition.notify_all()
+
+    for listener in change_listeners:
+        listener(kind, key)
+
+# Version tags for the whole database, a user and a group.  Every
+# change bumps a counter and stamps the user or group it was about with
+# the new count, so a tag moves on whenever what it covers changes and
+# is the same for as long as it doesn't.  Tags also carry a token that's
+# new every time the process starts, since the counts start over.
+# A tag read before reading the data it covers can only ever be older
+# than that data, never newer, so it's safe to hand out alongside it.
+def tableVersion():
+    return "{}.{}".format(version_epoch, version)
+
+def userVersion(userid):
+    return "{}.{}".format(version_epoch, versions["user"].get(userid, 0))
+
+def groupVersion(group_name):
+    return "{}.{}".format(version_epoch, versions["group"].get(group_name, 0))
+
+# Return the changes made after the database was at version `since` (a
+# tableVersion tag), oldest first, as (version, kind, key) triples, along
+# with the version they bring the database up to.  With a timeout, wait
+# up to that many seconds for there to be any.  Only the last
+# FAKE_DB_CHANGE_LOG_SIZE changes are kept, so if some of the ones
+# asked for have been dropped (or `since` is from before a restart) the
+# changes come back as None and the caller has to start over from
+# scratch, from the version returned.
+def changesSince(since, timeout = None):
+    epoch, _, count = since.partition(".")
+
+    if not count.isdigit():
+        raise ValueError("'{}' isn't a version".format(since))
+
+    since = int(count)
+
+    with change_condition:
+        if timeout and epoch == version_epoch and since == version:
+            change_condition.wait_for(lambda: version > since, timeout)
+
+        if epoch != version_epoch or since > version or \
+                (since < version and (not change_log or change_log[0][0] > since + 1)):
+            return None, tableVersion()
+
+        changes = list(islice(reversed(change_log), version - since))
+        changes.reverse()
+
+        return [("{}.{}".format(version_epoch, number), kind, key) for number, kind, key in changes], tableVersion()
+
+# A user was added, updated or deleted, which also
+# changes the member list of each of its groups.
+def _userChanged(user):
+    _changed("user", user.userid)
+
+    for group in user.groups:
+        _changed("group", group.name)
+
+# Record a successful mutation in the write-ahead log, if there is one.
+# The arguments are what it takes to repeat the mutation on recovery.
+# The record is only appended here; _syncLog waits for it to be on disk
+# once the write lock has been released.
+def _logged(op, *args):
+    if persistence is not None:
+        unsynced.record = persistence.log(op, args)
+
+# Called once a thread has let go of all its locks: wait until the
+# last record it logged is durable, then take a snapshot if one's due.
+# Only copying the database for the snapshot holds the locks; writing
+# it out doesn't.
+def _afterLocks():
+    record = getattr(unsynced, 'record', None)
+
+    if record is not None:
+        unsynced.record = None
+        wal, lsn = record
+        wal.sync(lsn)
+
+        if persistence is not None and persistence.snapshotDue():
+            write = _snapshot()
+
+            if write is not None:
+                write()
+
+# Nobody can be changing anything while every lock is held for reading
+@_locked(catalog = READ, shards = READ)
+def _snapshot():
+    if persistence is not None:
+        return persistence.snapshotIfDue()
+
+    return None
+
+# Turn on durable storage in data_dir.  If the directory already holds
+# a snapshot and/or log, the in-memory database is replaced with what
+# they recover to; otherwise the current contents become the first
+# snapshot.  From then on every mutation is written to the log before
+# it returns, and the log is compacted into a fresh snapshot once it
+# holds snapshot_every records.
+@_locked(catalog = WRITE, shards = WRITE)
+def enablePersistence(data_dir, snapshot_every = 100000):
+    global persistence
+    from database.persistence import Persistence
+
+    disablePersistence()
+
+    store = Persistence(sys.modules[__name__], data_dir, snapshot_every)
+    store.open()
+    persistence = store
+
+@_locked(catalog = WRITE, shards = WRITE)
+def disablePersistence():
+    global persistence
+
+    if persistence is not None:
+        persistence.close()
+        persistence = None
+
+# Drop every user and group.  Used when recovering from disk.
+def _reset():
+    global existing_groups_mask, base, first_ordinal, user_count, base_groups_per_user
+
+    for index in [groups, group_ids, interned_groups, group_order, base_group_bits, base_groups,
+                  user_ordinals, ordinal_userids, user_bits, group_bits, member_counts, groups_per_user]:
+        index.clear()
+
+    for shard in all_shards:
+        for index in [shard.users, shard.group_members, shard.user_order, shard.last_name_index, shard.base_deleted]:
+            index.clear()
+
+    existing_groups_mask = 0
+    first_ordinal = 0
+    user_count = 0
+    base_groups_per_user = None
+
+    if base is not None:
+        base.close()
+        base = None
+
+# Return a page of up to `limit` users (all of them if limit is None)
+# along with the key to pass back as `after` to get the next page, or
+# None if there are no more.  Users come back in userid order, or in
+# (last_name, userid) order when filtering on a last name prefix alone.
+# Each filter is served by walking an index from the `after` key, so a
+# page costs about the same no matter how big the user table gets.
+@_locked(catalog = READ, shards = READ)
+def pageUsers(limit = None, after = None, group = None, last_name_prefix = None):
+    if group is not None and not groupExists(group):
+        raise LookupError("group '{}' does not exist".format(group.name))
+
+    # Only this many keys from each shard can make it onto the page,
+    # unless users are going to be filtered out after merging
+    count = None if limit is None else limit + 1
+
+    if group is None and last_name_prefix is not None:
+        _checkPageKey(after, pair = True)
+        start = after if after is not None else (last_name_prefix,)
+        keys = takewhile(lambda key: key[0].startswith(last_name_prefix), _lastNameKeys(start, after is None, count))
+        keyed_users = ((key, _user(key[1])) for key in keys)
+    else:
+        _checkPageKey(after)
+
+        if last_name_prefix is not None:
+            count = None
+
+        if group is None:
+            userids = _userids(after, count)
+        else:
+            userids = _groupUserids(group.name, after, count)
+
+        keyed_users = ((userid, _user(userid)) for userid in userids)
+
+        if last_name_prefix is not None:
+            keyed_users = ((userid, user) for userid, user in keyed_users
+                           if user.last_name.startswith(last_name_prefix))
+
+    return _page(keyed_users, limit)
+
+# Lazily iterate over every user in userid order, in lists of up to
+# batch_size users.  See common.iterUserBatches.
+def iterUserBatches(batch_size = 1000):
+    return common.iterUserBatches(pageUsers, batch_size)
+
+# Lazily iterate over every user in userid order
+def iterUsers(batch_size = 1000):
+    return common.iterUsers(pageUsers, batch_size)
+
+# Pull up to limit + 1 (key, item) pairs to find out if there's another page
+def _page(keyed_items, limit):
+    page = list(islice(keyed_items, None if limit is None else limit + 1))
+
+    if limit is not None and len(page) > limit:
+        return [item for key, item in page[:limit]], page[limit - 1][0]
+
+    return [item for key, item in page], None
+
+# Make sure a page key is shaped like the keys of the index it's about
+# to be compared with: a plain string, or a (last_name, userid) pair.
+def _checkPageKey(after, pair = False):
+    if after is None:
+        return
+
+    if pair:
+        valid = isinstance(after, tuple) and len(after) == 2 and all(isinstance(part, str) for part in after)
+    else:
+        valid = isinstance(after, str)
+
+    if not valid:
+        raise ValueError("'{}' isn't a valid page key here".format(after))
+
+# Raise a LookupError naming the first group in this
+# GroupSet that isn't currently in the group index.
+def _checkGroupsExist(group_set):
+    unknown_mask = group_set.mask & ~existing_groups_mask
+
+    while unknown_mask:
+        low_bit = unknown_mask & -unknown_mask
+        group = getGroupByName(interned_groups[low_bit.bit_length() - 1].name)
+
+        # The group was removed and created again since the user got it
+        group_set.mask = group_set.mask & ~low_bit | 1 << group_ids[group.name]
+        unknown_mask ^= low_bit
 
 #   __ _ _ __ ___  _   _ _ __  ___
 #  / _` | '__/ _ \| | | | '_ \/ __|
@@ -82,16 +1061,19 @@ def removeGroupFromUser(user, group):
 #  |___/                |_|
 
 class Group:
+    __slots__ = ('name', '__weakref__')
+
     def __init__(self, name):
         self.name = name
 
+@_locked(catalog = READ)
 def allGroups():
-    return groups
+    return list(groups.values())
 
 # Return true if a group already exists with this group name
+@_locked(catalog = READ)
 def groupNameExists(group_name):
-    group_list = [group for group in groups if group.name == group_name]
-    return len(group_list) >= 1
+    return group_name in groups
 
 def groupExists(group):
     return groupNameExists(group.name)
@@ -100,52 +1082,288 @@ def addGroupByName(new_group_name):
     new_group = Group(new_group_name)
     addGroup(new_group)
 
+@_locked(catalog = WRITE, shards = WRITE)
 def addGroup(new_group):
     if groupNameExists(new_group.name):
         raise ValueError("group with name '{}' already exists".format(new_group.name))
 
-    groups.append(new_group)
+    _insertGroup(new_group)
+    _logged("addGroup", new_group)
+
+# Add a batch of new groups, all or nothing.  A BatchError lists each
+# one whose name is taken, by an existing group or an earlier one in
+# the batch, and nothing is added.
+@_locked(catalog = WRITE, shards = WRITE)
+def addGroups(new_groups):
+    errors = []
+    names = set()
+
+    for index, group in enumerate(new_groups):
+        if group.name in names:
+            errors.append((index, "group with name '{}' is in the batch more than once".format(group.name)))
+        elif group.name in groups:
+            errors.append((index, "group with name '{}' already exists".format(group.name)))
+
+        names.add(group.name)
+
+    if errors:
+        raise BatchError(errors)
+
+    for group in new_groups:
+        _insertGroup(group)
+
+    _logged("addGroups", list(new_groups))
+
+def _insertGroup(new_group):
+    groups[new_group.name] = new_group
+    group_order.add(new_group.name)
+
+    for shard in all_shards:
+        shard.group_members[new_group.name] = SortedSet()
+
+    group_bits[new_group.name] = Bitmap()
+    member_counts[new_group.name] = 0
 
+    global existing_groups_mask
+    existing_groups_mask |= 1 << _adoptGroup(new_group)
+
+    _changed("group", new_group.name)
+
+@_locked(catalog = READ)
 def getGroupByName(group_name):
-    group_list = [group for group in groups if group.name == group_name]
+    group = groups.get(group_name)
 
-    if len(group_list) < 1:
+    if group is None:
         raise LookupError("group '{}' does not exist".format(group_name))
     else:
-        return group_list[0]
+        return group
+
+# Return a page of up to `limit` groups in group name order, along
+# with the key for the next page.  See pageUsers.
+@_locked(catalog = READ)
+def pageGroups(limit = None, after = None):
+    _checkPageKey(after)
+    names = group_order.iterFrom(after, inclusive = False)
+    return _page(((name, groups[name]) for name in names), limit)
 
+@_locked(catalog = WRITE, shards = WRITE)
 def removeGroupByName(group_name):
     removeGroup(getGroupByName(group_name))
 
-# Remove group from group list and from
-# users that are members of that group.
+# Remove group from group list and from users that are members
+# of that group.  Only the group's members need to be visited.
+@_locked(catalog = WRITE, shards = WRITE)
 def removeGroup(group):
     if not groupExists(group):
         raise LookupError("group '{}' does not exist".format(group.name))
 
-    groups.remove(group)
-    [removeGroupFromUser(user, group) for user in users]
+    for userid in list(_groupMembers(group.name)):
+        _removeGroupFromUser(_user(userid), group)
+
+    del groups[group.name]
+    group_order.discard(group.name)
+
+    for shard in all_shards:
+        del shard.group_members[group.name]
+
+    del group_bits[group.name]
+    del member_counts[group.name]
+
+    global existing_groups_mask
+    existing_groups_mask &= ~(1 << group_ids[group.name])
+    _retireGroup(group)
+
+    _changed("group", group.name)
+    _logged("removeGroup", group)
 
 # Return a list of userids for all users
 # that are members of this group.
+@_locked(catalog = READ, shards = READ)
 def getUserIdsForGroup(group):
-    return [user.userid for user in users if group in user.groups]
+    if not groupExists(group):
+        return []
+
+    return list(_groupMembers(group.name))
+
+# Count the users matching a group query (see database.group_query),
+# such as "admins AND execs AND NOT pirates".  Raises a ValueError if
+# the query doesn't parse and a LookupError for a group that doesn't
+# exist.  The query is worked out on the groups' bitmaps, so it costs
+# about the same whatever mix of groups it asks for.
+@_locked(catalog = READ, shards = READ)
+def countGroupQuery(expression):
+    return len(_evaluate(parseGroupQuery(expression)))
+
+# Return a page of up to `limit` userids of users matching a group query,
+# along with the key for the next page (see pageUsers).  The userids
+# come in the order the users were first added, not in userid order.
+@_locked(catalog = READ, shards = READ)
+def pageGroupQuery(expression, limit = None, after = None):
+    _checkPageKey(after)
+    matches = _evaluate(parseGroupQuery(expression))
+    start = None
+
+    if after is not None:
+        start = _baseOrdinal(after)
+
+        if start < 0:
+            start = user_ordinals.get(after)
+
+        if start is None:
+            raise ValueError("'{}' isn't a valid page key here".format(after))
+
+    userids = (_useridAt(ordinal) for ordinal in matches.iterFrom(start))
+    return _page(((userid, userid) for userid in userids), limit)
+
+# The bitmap of the users a group query tree matches.  NOT is the
+# difference from every user, but NOTs under an AND are subtracted
+# from the rest of its operands instead.
+def _evaluate(tree):
+    if tree[0] == 'group':
+        if tree[1] not in groups:
+            raise LookupError("group '{}' does not exist".format(tree[1]))
+
+        _members(all_shards[0], tree[1])
+        return group_bits[tree[1]]
+
+    if tree[0] == 'not':
+        return user_bits - _evaluate(tree[1])
+
+    if tree[0] == 'or':
+        matches = _evaluate(tree[1][0])
+
+        for operand in tree[1][1:]:
+            matches = matches | _evaluate(operand)
+
+        return matches
+
+    included = [operand for operand in tree[1] if operand[0] != 'not']
+    excluded = [operand[1] for operand in tree[1] if operand[0] == 'not']
+    matches = _evaluate(included[0]) if included else user_bits
+
+    for operand in included[1:]:
+        matches = matches & _evaluate(operand)
+
+    for operand in excluded:
+        matches = matches - _evaluate(operand)
+
+    return matches
+
+# Return statistics about the groups: how many users there are, how many
+# members each group has (in group name order) and how many users are in
+# each number of groups.  They're kept up to date as users and
+# memberships change, so this costs about as much as there are groups.
+@_locked(catalog = READ, shards = READ)
+def groupStats():
+    groups_per_user_total = Counter(groups_per_user)
+
+    if base is not None:
+        groups_per_user_total.update(_baseGroupsPerUser())
+
+    return {
+        "users": user_count,
+        "members": [(name, member_counts[name]) for name in group_order],
+        "groups_per_user": sorted((count, users) for count, users in groups_per_user_total.items() if users)
+    }
+
+# How many users in the base snapshot were in each number of groups when
+# it was taken.  groups_per_user counts the changes since then.  Worked
+# out from the snapshot the first time it's needed.
+def _baseGroupsPerUser():
+    global base_groups_per_user
+
+    if base_groups_per_user is None:
+        with loading_lock:
+            if base_groups_per_user is None:
+                base_groups_per_user = base.groupsPerUser()
+
+    return base_groups_per_user
 
 # Pass in a group and a list of userid strings
+@_locked(catalog = READ, shards = WRITE)
 def updateGroupMembership(group, userids):
     if not groupNameExists(group.name):
-        raise LookupError("group '{}' does not exist".format(group_name))
+        raise LookupError("group '{}' does not exist".format(group.name))
 
     # Turn the list of userids into a list of users.  This'll throw
     # an exception for any userid that doesn't match an actual user.
     found_users = [getUserByUserid(userid) for userid in userids]
+    found_userids = set(user.userid for user in found_users)
 
-    # Iterate through ALL users
-    for user in users:
-        if user in found_users:
-            addGroupToUser(user, group)
-        else:
-            removeGroupFromUser(user, group)
+    # Drop current members that aren't on the new list, then add
+    # the new ones.  Users outside the group are never touched.
+    for userid in list(_groupMembers(group.name)):
+        if userid not in found_userids:
+            _removeGroupFromUser(_user(userid), group)
+
+    for user in found_users:
+        _addGroupToUser(user, group)
+
+    _logged("updateGroupMembership", group, [user.userid for user in found_users])
+
+# Apply a membership delta to a group: add it to the users in
+# add_userids and remove it from the users in remove_userids.  Every
+# userid is resolved before anything changes, so an unknown userid
+# raises a LookupError and leaves the group untouched.  The cost is
+# proportional to the size of the delta, not the size of the group.
+@_locked(catalog = READ, shards = WRITE)
+def changeGroupMembership(group, add_userids, remove_userids):
+    if not groupNameExists(group.name):
+        raise LookupError("group '{}' does not exist".format(group.name))
+
+    both = set(add_userids) & set(remove_userids)
+    if both:
+        raise ValueError("userids {} are both added to and removed from group '{}'".format(sorted(both), group.name))
+
+    users_to_add = [getUserByUserid(userid) for userid in add_userids]
+    users_to_remove = [getUserByUserid(userid) for userid in remove_userids]
+
+    for user in users_to_remove:
+        _removeGroupFromUser(user, group)
+
+    for user in users_to_add:
+        _addGroupToUser(user, group)
+
+    _logged("changeGroupMembership", group, list(add_userids), list(remove_userids))
+
+# Return the small integer id for this group's name, handing out the
+# next free id the first time a name is seen.  Ids are never reused,
+# and a removed group's name is forgotten (see _retireGroup), so ids
+# go in group creation order.
+def _internGroup(group):
+    group_id = group_ids.get(group.name)
+
+    if group_id is None:
+        # Detached users and groups get built without the database lock
+        with loading_lock:
+            group_id = group_ids.get(group.name)
+
+            if group_id is None:
+                group_id = len(interned_groups)
+                interned_groups.append(group)
+                group_ids[group.name] = group_id
+
+    return group_id
+
+# Make a newly added group the object a GroupSet hands out for its name
+# from now on, and return its id
+def _adoptGroup(group):
+    group_id = _internGroup(group)
+    interned_groups[group_id] = group
+    return group_id
+
+# The Group object a GroupSet hands out for this name
+def _internedGroup(name):
+    return interned_groups[_internGroup(Group(name))]
+
+# Forget the id of a group that has been removed, so that a group
+# created again with the same name gets a new id and comes after the
+# groups created before it, just as it does after recovery or in the
+# SQLite database.  Users that still have the old id are brought up to
+# date by _checkGroupsExist when they're stored.
+def _retireGroup(group):
+    with loading_lock:
+        group_ids.pop(group.name, None)
 
 #  _                 _       _                         _       _
 # | |               | |     | |                       | |     | |
@@ -156,24 +1374,111 @@ def updateGroupMembership(group, userids):
 #                                        | |
 #                                        |_|
 
-groups = [
-    Group("users"),
-    Group("admins"),
-    Group("execs"),
-    Group("pirates")
-]
-
-users = [
-    User("jsmith", "Joe", "Smith", [
-        getGroupByName("admins"),
-        getGroupByName("users")
-    ]),
-    User("jjones", "Jane", "Jones", [
-        getGroupByName("users"),
-        getGroupByName("execs")
-    ]),
-    User("jsparrow", "Jack", "Sparrow", [
-        getGroupByName("users"),
-        getGroupByName("pirates")
-    ])
-]
+# The user shards (FAKE_DB_SHARDS of them), the lock for the groups,
+# and how many with blocks each thread is inside
+all_shards = tuple(_Shard() for _ in range(int(os.environ.get("FAKE_DB_SHARDS", 8))))
+catalog_lock = ReadWriteLock()
+held = threading.local()
+
+# Primary index: group name -> Group, and
+# the group names kept in sorted order.
+groups = {}
+group_order = SortedSet()
+
+change_listeners = []
+
+# The change counter, the count at each user's and group's last change
+# (see tableVersion) and this process's token for them, plus the last
+# so many changes for changesSince and a condition to wait for more on
+version = 0
+versions = {"user": {}, "group": {}}
+version_epoch = os.urandom(4).hex()
+change_log = deque(maxlen = int(os.environ.get("FAKE_DB_CHANGE_LOG_SIZE", 100000)))
+change_condition = threading.Condition()
+
+# Group interning: group name -> id, id -> Group, plus a
+# mask with the bits of every group currently in the index.
+group_ids = {}
+interned_groups = []
+existing_groups_mask = 0
+
+# Set by enablePersistence, and the (log, lsn) of the last record each
+# thread logged that it hasn't waited on yet
+persistence = None
+
+# For each snapshot being written out, the users whose groups have
+# changed since it was captured, with the groups they had then
+captured_groups = ()
+unsynced = threading.local()
+
+# User ordinals for the group bitmaps: userid -> ordinal for users that
+# aren't in the base snapshot, and the userid of each of those ordinals
+# from first_ordinal (the base snapshot's user count) on.  Then a bitmap
+# of the ordinals of every user and group name -> a bitmap of the
+# ordinals of its members, and the lock writers change them under.
+user_ordinals = {}
+ordinal_userids = []
+first_ordinal = 0
+user_bits = Bitmap()
+group_bits = {}
+bitmap_lock = threading.Lock()
+
+# For groupStats, also changed under bitmap_lock: how many users there
+# are, group name -> how many members it has, and how many users are in
+# each number of groups (only counting changes since the base snapshot,
+# which has its own count, worked out when it's first asked for)
+user_count = 0
+member_counts = {}
+groups_per_user = Counter()
+base_groups_per_user = None
+
+# Guards filling in things that readers load on demand: users and member
+# lists from the base snapshot, and group ids
+loading_lock = threading.RLock()
+
+# Set by _attachSnapshot: the base snapshot, the GroupSet bit for each
+# of its group ordinals, and the ordinals of groups whose member index
+# hasn't been loaded yet.  (Each shard keeps track of its own users
+# that have been deleted since.)
+base = None
+base_group_bits = []
+base_groups = {}
+
+for group_name in ["users", "admins", "execs", "pirates"]:
+    addGroupByName(group_name)
+
+addUser(User("jsmith", "Joe", "Smith", [
+    getGroupByName("admins"),
+    getGroupByName("users")
+]))
+
+addUser(User("jjones", "Jane", "Jones", [
+    getGroupByName("users"),
+    getGroupByName("execs")
+]))
+
+addUser(User("jsparrow", "Jack", "Sparrow", [
+    getGroupByName("users"),
+    getGroupByName("pirates")
+]))
+
+# Which storage engine the functions above are talking to.  With
+# FAKE_DB_BACKEND=sqlite they're swapped for the ones in sqlite_db,
+# which keep everything in the database file FAKE_DB_SQLITE_PATH, and
+# with FAKE_DB_BACKEND=remote for the ones in remote_db, which talk to
+# the store server listening on FAKE_DB_ADDRESS.
+backend = "memory"
+
+if os.environ.get("FAKE_DB_BACKEND", "memory") == "sqlite":
+    from database.sqlite_db import *
+    openDatabase(os.environ.get("FAKE_DB_SQLITE_PATH", "fake_db.sqlite3"))
+elif os.environ.get("FAKE_DB_BACKEND", "memory") == "remote":
+    if not os.environ.get("FAKE_DB_AUTHKEY"):
+        raise ValueError("FAKE_DB_BACKEND=remote needs the store server's key in FAKE_DB_AUTHKEY")
+
+    from database.remote_db import *
+    openDatabase(os.environ.get("FAKE_DB_ADDRESS", "fake_db.sock"), os.environ["FAKE_DB_AUTHKEY"])
+elif os.environ.get("FAKE_DB_BACKEND", "memory") != "memory":
+    raise ValueError("unknown FAKE_DB_BACKEND '{}'".format(os.environ["FAKE_DB_BACKEND"]))
+elif os.environ.get("FAKE_DB_DATA_DIR"):
+    enablePersistence(os.environ["FAKE_DB_DATA_DIR"])
@@ -0,0 +1,122 @@
+import re
+
+# Boolean expressions over group names, for picking out users by the
+# groups they're in, e.g. "admins AND execs AND NOT pirates".
+#
+#     expression := term (OR term)*
+#     term       := factor (AND factor)*
+#     factor     := NOT factor | "(" expression ")" | group name
+#
+# AND, OR and NOT can be written in any case.  A group name is anything
+# up to the next space or parenthesis, or anything between double quotes
+# for a name with spaces or parentheses in it, or one that's a keyword.
+#
+# parseGroupQuery turns an expression into a tree of tuples that each
+# backend evaluates in its own way: ("group", name), ("not", operand),
+# ("and", [operands]) or ("or", [operands]).
+
+TOKENS = re.compile(r'\s*(?:(\()|(\))|"([^"]*)"|([^\s()"]+))')
+
+KEYWORDS = frozenset(['and', 'or', 'not'])
+
+# How deeply NOTs and parentheses can nest.  The parser and the
+# backends' evaluators recurse once per level (or a few times), and
+# SQLite's parser has a small stack of its own, so this keeps a hostile
+# query from running any of them out of stack.
+MAX_NESTING = 20
+
+# Parse an expression into a tree, raising a ValueError if it isn't one
+def parseGroupQuery(expression):
+    tokens = _tokenize(expression)
+
+    if not tokens:
+        raise ValueError("the group query is empty")
+
+    tree, position = _expression(tokens, 0, 0)
+
+    if position < len(tokens):
+        raise ValueError("unexpected '{}' in the group query".format(tokens[position][1]))
+
+    return tree
+
+# The names of the groups an expression tree mentions, in order
+def queryGroupNames(tree):
+    if tree[0] == 'group':
+        return [tree[1]]
+
+    if tree[0] == 'not':
+        return queryGroupNames(tree[1])
+
+    return [name for operand in tree[1] for name in queryGroupNames(operand)]
+
+# (kind, text) pairs, where kind is "(", ")", a keyword or "name"
+def _tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+
+    while position < len(expression):
+        match = TOKENS.match(expression, position)
+
+        if match is None:
+            raise ValueError("unterminated quote in the group query")
+
+        opening, closing, quoted, word = match.groups()
+
+        if opening or closing:
+            tokens.append((opening or closing, opening or closing))
+        elif quoted is not None:
+            tokens.append(('name', quoted))
+        else:
+            tokens.append((word.lower() if word.lower() in KEYWORDS else 'name', word))
+
+        position = match.end()
+
+    return tokens
+
+# depth is how many NOTs and parentheses the expression is inside
+def _expression(tokens, position, depth):
+    return _chain(tokens, position, depth, 'or', _term)
+
+def _term(tokens, position, depth):
+    return _chain(tokens, position, depth, 'and', _factor)
+
+# One or more operands with the keyword between each pair
+def _chain(tokens, position, depth, keyword, operand):
+    tree, position = operand(tokens, position, depth)
+    operands = [tree]
+
+    while position < len(tokens) and tokens[position][0] == keyword:
+        tree, position = operand(tokens, position + 1, depth)
+        operands.append(tree)
+
+    if len(operands) == 1:
+        return operands[0], position
+
+    return (keyword, operands), position
+
+def _factor(tokens, position, depth):
+    if position == len(tokens):
+        raise ValueError("the group query ends too soon")
+
+    kind, text = tokens[position]
+
+    if kind in ('not', '(') and depth == MAX_NESTING:
+        raise ValueError("the group query nests more than {} deep".format(MAX_NESTING))
+
+    if kind == 'not':
+        tree, position = _factor(tokens, position + 1, depth + 1)
+        return ('not', tree), position
+
+    if kind == '(':
+        tree, position = _expression(tokens, position + 1, depth + 1)
+
+        if position == len(tokens) or tokens[position][0] != ')':
+            raise ValueError("missing ')' in the group query")
+
+        return tree, position + 1
+
+    if kind == 'name':
+        return ('group', text), position + 1
+
+    raise ValueError("unexpected '{}' in the group query".format(text))
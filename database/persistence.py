@@ -0,0 +1,316 @@
+import glob
+import json
+import os
+import threading
+
+from database.snapshot import Snapshot, writeSnapshot
+
+# Durable storage for fake_db: an append-only write-ahead log plus
+# periodic snapshots, all kept in one data directory.
+#
+#   snapshot-<lsn>.bin   the whole database as of log record <lsn>, in
+#                        the binary format from database.snapshot
+#   wal-<lsn>.log        log records from <lsn> onwards, one JSON
+#                        document per line: {"op": ..., "args": [...]}
+#
+# Recovery memory maps the newest snapshot, hands it to fake_db to
+# serve users from, and replays every log segment that starts at or
+# after it.  A snapshot is written to a temporary
+# file and renamed into place, so a snapshot that exists is complete;
+# a torn record at the end of the last log segment (from a crash in
+# the middle of a write) is ignored.
+#
+# Log writes are group committed: each mutation appends its record and
+# then (once it has let go of the database lock) waits for it to be
+# fsync'd, and whichever waiter gets there first writes and fsyncs
+# every record pending at that point, so under concurrent writers one
+# fsync covers a whole batch of records.
+
+SNAPSHOT_PATTERN = 'snapshot-{:012d}.bin'
+LOG_PATTERN = 'wal-{:012d}.log'
+
+
+class WriteAheadLog:
+
+    # A new segment always starts out empty.  If a file by that name is
+    # already there it can only hold a torn record that recovery skipped.
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.condition = threading.Condition()
+        self.pending = []
+        self.appended = 0
+        self.durable = 0
+        self.flushing = False
+
+    # Add a record to the log, returning its number for sync()
+    def append(self, record):
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+
+        with self.condition:
+            self.pending.append(line)
+            self.appended += 1
+            return self.appended
+
+    # Wait until record number lsn is on disk
+    def sync(self, lsn):
+        with self.condition:
+            while self.durable < lsn:
+                if self.flushing:
+                    self.condition.wait()
+                else:
+                    self._flush()
+
+    # Write and fsync everything pending.  Called with the condition
+    # held; releases it for the duration of the write itself.
+    def _flush(self):
+        batch = self.pending
+        target = self.appended
+
+        self.pending = []
+        self.flushing = True
+        self.condition.release()
+
+        try:
+            self.file.write(b''.join(batch))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+        except:
+            self.condition.acquire()
+            self.pending = batch + self.pending
+            self.flushing = False
+            self.condition.notify_all()
+            raise
+
+        self.condition.acquire()
+        self.durable = target
+        self.flushing = False
+        self.condition.notify_all()
+
+    # Flush whatever is still pending, then close the file
+    def close(self):
+        self.sync(self.appended)
+        self.file.close()
+
+
+class Persistence:
+
+    def __init__(self, db, data_dir, snapshot_every):
+        self.db = db
+        self.data_dir = data_dir
+        self.snapshot_every = snapshot_every
+        self.lsn = 0
+        self.log_start = 0
+        self.wal = None
+        self.replaying = False
+
+        # Writers to different shards log at the same time, whoever
+        # notices a snapshot is due first takes it, and snapshots are
+        # written out one at a time, in order
+        self.lock = threading.Lock()
+        self.snapshot_lock = threading.Lock()
+        self.write_lock = threading.Lock()
+
+    # Recover whatever is in the data directory, or start it off with
+    # a snapshot of the database as it stands.
+    def open(self):
+        if not os.path.isdir(self.data_dir):
+            os.makedirs(self.data_dir)
+
+        if self._files('snapshot-*.bin') or self._files('wal-*.log'):
+            self.recover()
+        else:
+            self.snapshot()
+
+        if self.wal is None:
+            self._startLog()
+
+    def close(self):
+        if self.wal is not None:
+            self.wal.close()
+            self.wal = None
+
+    # Called by fake_db after every successful mutation.  Returns the
+    # (log, lsn) to wait on for the record to be durable.
+    def log(self, op, args):
+        if self.replaying:
+            return None
+
+        record = {'op': op, 'args': [self._encode(arg) for arg in args]}
+
+        with self.lock:
+            wal = self.wal
+            self.lsn += 1
+            return wal, wal.append(record)
+
+    def snapshotDue(self):
+        return self.lsn - self.log_start >= self.snapshot_every
+
+    # Called by fake_db with nothing able to change the database.  If a
+    # snapshot is due, returns a function that writes it out, for
+    # fake_db to call once it has let go of the database.
+    def snapshotIfDue(self):
+        with self.snapshot_lock:
+            if self.snapshotDue():
+                return self._capture()
+
+        return None
+
+    # Write the whole database to a new snapshot, start a new log
+    # segment and then delete the snapshots and segments it replaces.
+    # The database mustn't change while this is going on.
+    def snapshot(self):
+        self._capture()()
+
+    # Capture the whole database and start a new log segment for the
+    # changes after it, returning a function that writes the capture
+    # out as a snapshot and then deletes the snapshots and segments it
+    # replaces.  Only the capture needs the database to hold still, and
+    # that copies no more than the user index (see
+    # fake_db._captureUserRecords); until the snapshot is in place the
+    # old snapshot and segments still recover everything.
+    def _capture(self):
+        db = self.db
+        lsn = self.lsn
+        group_names = [group.name for group in db.interned_groups if db.groups.get(group.name) is group]
+        records = db._captureUserRecords()
+
+        self.close()
+        self._startLog()
+
+        return lambda: self._writeSnapshot(lsn, group_names, records)
+
+    def _writeSnapshot(self, lsn, group_names, records):
+        path = os.path.join(self.data_dir, SNAPSHOT_PATTERN.format(lsn))
+        temp_path = path + '.tmp'
+
+        with self.write_lock:
+            writeSnapshot(temp_path, lsn, group_names, records)
+
+            os.rename(temp_path, path)
+            self._syncDirectory()
+
+            base = self.db.base
+
+            for old_path in self._files('snapshot-*.bin') + self._files('wal-*.log'):
+                if self._lsnOf(old_path) < lsn:
+                    # Deleting the snapshot the database is serving users
+                    # from wouldn't free its space while it's mapped, so
+                    # that one goes once it's closed
+                    if base is not None and old_path == base.path:
+                        base.remove_on_close = True
+                    else:
+                        os.remove(old_path)
+
+    def recover(self):
+        db = self.db
+        db._reset()
+
+        snapshots = self._files('snapshot-*.bin')
+
+        if snapshots:
+            snapshot = Snapshot(snapshots[-1])
+            db._attachSnapshot(snapshot)
+            self.lsn = snapshot.lsn
+
+        self.log_start = self.lsn
+        self.replaying = True
+
+        try:
+            for log_path in self._files('wal-*.log'):
+                if self._lsnOf(log_path) >= self.log_start:
+                    self._replay(log_path)
+
+        finally:
+            self.replaying = False
+
+    def _replay(self, log_path):
+        with open(log_path, 'rb') as log_file:
+            for line in log_file:
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    # A torn write at the end of the log
+                    break
+
+                self._apply(record['op'], record['args'])
+                self.lsn += 1
+
+    def _apply(self, op, args):
+        db = self.db
+
+        if op == 'addUser':
+            db.addUser(self._decodeUser(args[0]))
+        elif op == 'addUsers':
+            db.addUsers([self._decodeUser(record) for record in args[0]])
+        elif op == 'updateUser':
+            db.updateUser(self._decodeUser(args[0]))
+        elif op == 'deleteUserByUserId':
+            db.deleteUserByUserId(args[0])
+        elif op == 'addGroupToUser':
+            db.addGroupToUser(db.getUserByUserid(args[0]), db.getGroupByName(args[1]))
+        elif op == 'removeGroupFromUser':
+            db.removeGroupFromUser(db.getUserByUserid(args[0]), db.getGroupByName(args[1]))
+        elif op == 'addGroup':
+            db.addGroupByName(args[0])
+        elif op == 'addGroups':
+            db.addGroups([db.Group(name) for name in args[0]])
+        elif op == 'removeGroup':
+            db.removeGroupByName(args[0])
+        elif op == 'updateGroupMembership':
+            db.updateGroupMembership(db.getGroupByName(args[0]), args[1])
+        elif op == 'changeGroupMembership':
+            db.changeGroupMembership(db.getGroupByName(args[0]), args[1], args[2])
+        else:
+            raise ValueError("unknown log record '{}'".format(op))
+
+    def _startLog(self):
+        self.log_start = self.lsn
+        self.wal = WriteAheadLog(os.path.join(self.data_dir, LOG_PATTERN.format(self.lsn)))
+        self._syncDirectory()
+
+    # Users are logged as plain records and groups by name
+    def _encode(self, value):
+        if isinstance(value, list):
+            return [self._encode(item) for item in value]
+
+        if isinstance(value, self.db.User):
+            return {
+                'userid': value.userid,
+                'first_name': value.first_name,
+                'last_name': value.last_name,
+                'groups': [group.name for group in value.groups]
+            }
+
+        if isinstance(value, self.db.Group):
+            return value.name
+
+        return value
+
+    def _decodeUser(self, record):
+        db = self.db
+
+        return db.User(
+            record['userid'],
+            record['first_name'],
+            record['last_name'],
+            [db.getGroupByName(group_name) for group_name in record['groups']]
+        )
+
+    # Matching files in the data directory, oldest first
+    def _files(self, pattern):
+        return sorted(glob.glob(os.path.join(self.data_dir, pattern)), key=self._lsnOf)
+
+    @staticmethod
+    def _lsnOf(path):
+        return int(os.path.basename(path).split('-')[1].split('.')[0])
+
+    # Make renames and new files in the data directory durable
+    def _syncDirectory(self):
+        if hasattr(os, 'O_DIRECTORY'):
+            fd = os.open(self.data_dir, os.O_RDONLY | os.O_DIRECTORY)
+
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
@@ -0,0 +1,328 @@
+from multiprocessing.connection import Client
+import threading
+
+from database import common
+from database.fake_db import User, Group, BatchError, _adoptGroup, _internedGroup, _retireGroup
+
+# The fake_db API as a client of a store server (database.store_server),
+# so that every worker process of the web service sees the one
+# in-memory database the server holds.  fake_db switches over to these
+# functions when FAKE_DB_BACKEND=remote.
+#
+# Each call is one round trip over a Unix socket (or TCP), sending the
+# operation and plain arguments (userids, group names, user records)
+# and getting plain results back.  Connections are authenticated once,
+# when they're opened, and then kept in a pool and reused, so the cost
+# of a call is little more than pickling its arguments and result.
+#
+# As with the SQLite backend, User objects are remembered in an
+# identity map for as long as anybody holds on to them, and change
+# listeners only hear about changes made by this process.
+
+__all__ = [
+    'backend', 'openDatabase', 'closeDatabase', 'change_listeners', 'addChangeListener',
+    'allUsers', 'userExistsByUserid', 'getUserByUserid', 'addUser', 'addUsers', 'updateUser', 'deleteUserByUserId',
+    'userHasGroup', 'addGroupToUser', 'removeGroupFromUser', 'pageUsers', 'iterUserBatches', 'iterUsers',
+    'allGroups', 'groupNameExists', 'groupExists', 'addGroupByName', 'addGroup', 'addGroups', 'getGroupByName',
+    'pageGroups', 'removeGroupByName', 'removeGroup', 'getUserIdsForGroup', 'updateGroupMembership',
+    'changeGroupMembership', 'countGroupQuery', 'pageGroupQuery', 'groupStats', 'tableVersion', 'userVersion', 'groupVersion',
+    'changesSince'
+]
+
+backend = 'remote'
+
+# How many idle connections to keep around for reuse
+POOL_SIZE = 16
+
+# The exceptions the server can send back; anything
+# else it ran into comes back as a RuntimeError.
+ERRORS = {
+    'BatchError': BatchError,
+    'LookupError': LookupError,
+    'ValueError': ValueError,
+    'RuntimeError': RuntimeError
+}
+
+#                                  _   _
+#                                 | | (_)
+#   ___ ___  _ __  _ __   ___  ___| |_ _  ___  _ __  ___
+#  / __/ _ \| '_ \| '_ \ / _ \/ __| __| |/ _ \| '_ \/ __|
+# | (_| (_) | | | | | | |  __/ (__| |_| | (_) | | | \__ \
+#  \___\___/|_| |_|_| |_|\___|\___|\__|_|\___/|_| |_|___/
+
+# Start talking to the store server at address: "host:port" for TCP,
+# anything else is the path of a Unix socket.  authkey is the shared
+# secret the server was started with.
+def openDatabase(address, authkey):
+    global server_address, server_authkey
+
+    closeDatabase()
+    server_address = _address(address)
+    server_authkey = authkey.encode('utf-8')
+
+    # Intern every group in creation order, so that the groups of a
+    # User come back in the same order they do from the server
+    allGroups()
+
+# Close every pooled connection and forget every user object
+def closeDatabase():
+    global server_address
+
+    with pool_lock:
+        for connection in pool:
+            connection.close()
+
+        del pool[:]
+
+    identity_map.clear()
+    server_address = None
+
+def _address(address):
+    host, _, port = address.rpartition(':')
+
+    if host and port.isdigit():
+        return host, int(port)
+
+    return address
+
+# Run an operation on the server and return its result, re-raising
+# whatever LookupError, ValueError or BatchError it raised.
+def _call(op, *args):
+    with pool_lock:
+        connection = pool.pop() if pool else None
+
+    if connection is None:
+        if server_address is None:
+            raise RuntimeError("no database is open")
+
+        connection = Client(server_address, authkey = server_authkey)
+
+    try:
+        connection.send((op, args))
+        reply = connection.recv()
+
+    # The server went away.  Any other pooled connections
+    # are just as dead, so drop those too.
+    except (EOFError, OSError) as e:
+        connection.close()
+
+        with pool_lock:
+            for idle in pool:
+                idle.close()
+
+            del pool[:]
+
+        raise ConnectionError("lost the connection to the store server: {}".format(e))
+
+    with pool_lock:
+        if len(pool) < POOL_SIZE:
+            pool.append(connection)
+            connection = None
+
+    if connection is not None:
+        connection.close()
+
+    if reply[0] == 'error':
+        raise ERRORS[reply[1]](reply[2])
+
+    return reply[1]
+
+def addChangeListener(listener):
+    identity_map.addChangeListener(listener)
+
+# The server's version tags, see fake_db.tableVersion
+def tableVersion():
+    return _call('tableVersion')
+
+def userVersion(userid):
+    return _call('userVersion', userid)
+
+def groupVersion(group_name):
+    return _call('groupVersion', group_name)
+
+# The server's change log, see fake_db.changesSince.  The connection
+# is tied up for as long as the server waits.
+def changesSince(since, timeout = None):
+    return _call('changesSince', since, timeout)
+
+#  _   _ ___  ___ _ __ ___
+# | | | / __|/ _ \ '__/ __|
+# | |_| \__ \  __/ |  \__ \
+#  \__,_|___/\___|_|  |___/
+
+# Return a list of all users, in userid order.
+def allUsers():
+    return list(iterUsers())
+
+def userExistsByUserid(userid):
+    return _call('userExistsByUserid', userid)
+
+# Return a particular user that matches the userid
+def getUserByUserid(userid):
+    return _user(_call('getUserByUserid', userid))
+
+# Add a new user
+def addUser(user):
+    _call('addUser', _record(user))
+
+    identity_map.stored(user)
+
+# Add a batch of new users, all or nothing
+def addUsers(new_users):
+    _call('addUsers', [_record(user) for user in new_users])
+
+    for user in new_users:
+        identity_map.stored(user)
+
+# Update an existing user
+def updateUser(new_user):
+    old_group_names = _call('updateUser', _record(new_user))
+
+    identity_map.stored(new_user, old_group_names)
+
+# Delete an existing user
+def deleteUserByUserId(userid):
+    group_names = _call('deleteUserByUserId', userid)
+
+    identity_map.deleted(userid, group_names)
+
+def userHasGroup(user, group):
+    return group in user.groups
+
+# Add a group to a user.  See common.IdentityMap.changeMembership.
+def addGroupToUser(user, group):
+    identity_map.changeMembership(user, group, True, lambda userid, group_name:
+                                  _call('addGroupToUser', userid, group_name))
+
+# Remove a group from a user, the same way
+def removeGroupFromUser(user, group):
+    identity_map.changeMembership(user, group, False, lambda userid, group_name:
+                                  _call('removeGroupFromUser', userid, group_name))
+
+# Users go over the wire as (userid, first_name, last_name, group names)
+def _record(user):
+    return user.userid, user.first_name, user.last_name, [group.name for group in user.groups]
+
+# The User for a record from the server, see common.IdentityMap.user
+def _user(record):
+    return identity_map.user(*record)
+
+# Return a page of up to `limit` users (all of them if limit is None)
+# along with the key to pass back as `after` to get the next page, or
+# None if there are no more.  The server pages through its own indexes
+# exactly as fake_db.pageUsers does.
+def pageUsers(limit = None, after = None, group = None, last_name_prefix = None):
+    records, next_key = _call('pageUsers', limit, after, None if group is None else group.name, last_name_prefix)
+    return [_user(record) for record in records], next_key
+
+# Lazily iterate over every user in userid order, in lists of up to
+# batch_size users.  See common.iterUserBatches.
+def iterUserBatches(batch_size = 1000):
+    return common.iterUserBatches(pageUsers, batch_size)
+
+# Lazily iterate over every user in userid order
+def iterUsers(batch_size = 1000):
+    return common.iterUsers(pageUsers, batch_size)
+
+#   __ _ _ __ ___  _   _ _ __  ___
+#  / _` | '__/ _ \| | | | '_ \/ __|
+# | (_| | | | (_) | |_| | |_) \__ \
+#  \__, |_|  \___/ \__,_| .__/|___/
+#   __/ |               | |
+#  |___/                |_|
+
+def allGroups():
+    return [_internedGroup(name) for name in _call('allGroups')]
+
+# Return true if a group already exists with this group name
+def groupNameExists(group_name):
+    return _call('groupNameExists', group_name)
+
+def groupExists(group):
+    return groupNameExists(group.name)
+
+def addGroupByName(new_group_name):
+    new_group = Group(new_group_name)
+    addGroup(new_group)
+
+def addGroup(new_group):
+    _call('addGroup', new_group.name)
+
+    _adoptGroup(new_group)
+    identity_map.changed("group", new_group.name)
+
+# Add a batch of new groups, all or nothing
+def addGroups(new_groups):
+    _call('addGroups', [group.name for group in new_groups])
+
+    for group in new_groups:
+        _adoptGroup(group)
+        identity_map.changed("group", group.name)
+
+def getGroupByName(group_name):
+    if not groupNameExists(group_name):
+        raise LookupError("group '{}' does not exist".format(group_name))
+    else:
+        return _internedGroup(group_name)
+
+# Return a page of up to `limit` groups in group name order, along
+# with the key for the next page.  See pageUsers.
+def pageGroups(limit = None, after = None):
+    names, next_key = _call('pageGroups', limit, after)
+    return [_internedGroup(name) for name in names], next_key
+
+def removeGroupByName(group_name):
+    removeGroup(getGroupByName(group_name))
+
+# Remove group from group list and from users that are members
+# of that group.
+def removeGroup(group):
+    userids = _call('removeGroup', group.name)
+    identity_map.membershipChanged(group, userids, [])
+    _retireGroup(group)
+
+# Return a list of userids for all users
+# that are members of this group.
+def getUserIdsForGroup(group):
+    return _call('getUserIdsForGroup', group.name)
+
+def countGroupQuery(expression):
+    return _call('countGroupQuery', expression)
+
+def pageGroupQuery(expression, limit = None, after = None):
+    return _call('pageGroupQuery', expression, limit, after)
+
+def groupStats():
+    return _call('groupStats')
+
+# Pass in a group and a list of userid strings
+def updateGroupMembership(group, userids):
+    removed_userids, added_userids = _call('updateGroupMembership', group.name, list(userids))
+    identity_map.membershipChanged(group, removed_userids, added_userids)
+
+# Apply a membership delta to a group: add it to the users in
+# add_userids and remove it from the users in remove_userids.  Every
+# userid is checked before anything changes, so an unknown userid
+# raises a LookupError and leaves the group untouched.
+def changeGroupMembership(group, add_userids, remove_userids):
+    removed_userids, added_userids = _call('changeGroupMembership', group.name, list(add_userids), list(remove_userids))
+    identity_map.membershipChanged(group, removed_userids, added_userids)
+
+#      _       _
+#     | |     | |
+#   __| | __ _| |_ __ _
+#  / _` |/ _` | __/ _` |
+# | (_| | (_| | || (_| |
+#  \__,_|\__,_|\__\__,_|
+
+server_address = None
+server_authkey = None
+
+# Idle connections to the server, ready to be reused
+pool = []
+pool_lock = threading.Lock()
+
+# userid -> the User object last stored or handed out for it, and
+# the listeners to tell about this process's changes
+identity_map = common.IdentityMap()
+change_listeners = identity_map.change_listeners
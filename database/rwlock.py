@@ -0,0 +1,93 @@
+import threading
+
+# A readers/writer lock: any number of threads can hold it for reading
+# at once, or a single thread can hold it for writing.  Waiting writers
+# go ahead of readers that haven't got in yet, so a steady stream of
+# readers can't starve a writer.
+#
+# Both sides are reentrant, and the thread holding it for writing can
+# take it for reading too, so locked functions can call each other.
+# Taking it for writing while only holding it for reading would
+# deadlock against any other reader, so that raises a RuntimeError.
+
+class ReadWriteLock:
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.condition = threading.Condition(self.mutex)
+        self.readers = 0
+        self.writer = None
+        self.writes = 0
+        self.waiting_writers = 0
+        self.local = threading.local()
+
+    def acquireRead(self):
+        if self.writer == threading.get_ident():
+            return
+
+        reads = getattr(self.local, 'reads', 0)
+
+        if reads == 0:
+            # The mutex on its own is enough when nobody is writing
+            self.mutex.acquire()
+
+            try:
+                while self.writer is not None or self.waiting_writers:
+                    self.condition.wait()
+
+                self.readers += 1
+
+            finally:
+                self.mutex.release()
+
+        self.local.reads = reads + 1
+
+    def releaseRead(self):
+        if self.writer == threading.get_ident():
+            return
+
+        reads = self.local.reads - 1
+        self.local.reads = reads
+
+        if reads == 0:
+            self.mutex.acquire()
+            self.readers -= 1
+
+            if self.readers == 0 and self.waiting_writers:
+                self.condition.notify_all()
+
+            self.mutex.release()
+
+    def acquireWrite(self):
+        me = threading.get_ident()
+
+        if self.writer == me:
+            self.writes += 1
+            return
+
+        if getattr(self.local, 'reads', 0):
+            raise RuntimeError("can't take a lock held for reading for writing")
+
+        with self.condition:
+            self.waiting_writers += 1
+
+            try:
+                while self.writer is not None or self.readers:
+                    self.condition.wait()
+            finally:
+                self.waiting_writers -= 1
+
+            self.writer = me
+            self.writes = 1
+
+    def releaseWrite(self):
+        self.writes -= 1
+
+        if self.writes == 0:
+            with self.condition:
+                self.writer = None
+                self.condition.notify_all()
+
+    # True if the calling thread holds the lock for writing
+    def isWriting(self):
+        return self.writer == threading.get_ident()
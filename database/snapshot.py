@@ -0,0 +1,246 @@
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from itertools import islice
+from operator import sub
+import mmap
+import os
+import struct
+
+# A compact binary snapshot of the user directory that can be memory
+# mapped and queried in place, so that loading one doesn't mean
+# building millions of Python objects up front.
+#
+# The file is a fixed size header followed by these sections, each
+# starting on an 8 byte boundary:
+#
+#   string offsets   u64[strings + 1]   offsets into the string blob
+#   string blob      utf-8 bytes        every distinct string, once
+#   groups           u32[groups]        group name string ids, in
+#                                       group creation order
+#   userids          u32[users]         \
+#   first names      u32[users]          | string ids, one per user,
+#   last names       u32[users]         /  users sorted by userid
+#   group starts     u32[users + 1]     each user's slice of...
+#   memberships      u32[memberships]   ...group ordinals
+#   last name order  u32[users]         user ordinals sorted by
+#                                       (last_name, userid)
+#   member starts    u32[groups + 1]    each group's slice of...
+#   members          u32[memberships]   ...user ordinals, ascending
+#
+# Integers are in native byte order; the header records which one so
+# that a snapshot from a machine with the other one is rejected.
+
+MAGIC = b'FKDBSNAP'
+VERSION = 1
+BYTE_ORDER_MARK = 0x01020304
+
+# magic, version, byte order mark, lsn, strings, blob bytes, groups, users, memberships
+HEADER = struct.Struct('=8sIIQQQQQQ')
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+class _StringTable:
+
+    def __init__(self):
+        self.ids = {}
+        self.offsets = array('Q', [0])
+        self.blob = bytearray()
+
+    def id(self, string):
+        string_id = self.ids.get(string)
+
+        if string_id is None:
+            string_id = self.ids[string] = len(self.offsets) - 1
+            self.blob += string.encode('utf-8')
+            self.offsets.append(len(self.blob))
+
+        return string_id
+
+
+# Write a snapshot to path.  group_names are the groups in creation
+# order and records yields (userid, first_name, last_name, group_names)
+# for every user, in userid order.
+def writeSnapshot(path, lsn, group_names, records):
+    strings = _StringTable()
+    group_ordinals = dict((name, ordinal) for ordinal, name in enumerate(group_names))
+
+    groups = array('I', [strings.id(name) for name in group_names])
+    userids = array('I')
+    first_names = array('I')
+    last_names = array('I')
+    group_starts = array('I', [0])
+    memberships = array('I')
+    members = [array('I') for _ in group_names]
+    last_name_keys = []
+
+    for userid, first_name, last_name, user_groups in records:
+        ordinal = len(userids)
+
+        userids.append(strings.id(userid))
+        first_names.append(strings.id(first_name))
+        last_names.append(strings.id(last_name))
+        last_name_keys.append((last_name, userid))
+
+        for group_name in user_groups:
+            group_ordinal = group_ordinals[group_name]
+            memberships.append(group_ordinal)
+            members[group_ordinal].append(ordinal)
+
+        group_starts.append(len(memberships))
+
+    last_name_order = array('I', sorted(range(len(userids)), key=last_name_keys.__getitem__))
+    del last_name_keys
+
+    member_starts = array('I', [0])
+    all_members = array('I')
+
+    for group_members in members:
+        all_members.extend(group_members)
+        member_starts.append(len(all_members))
+
+    header = HEADER.pack(MAGIC, VERSION, BYTE_ORDER_MARK, lsn, len(strings.offsets) - 1,
+                         len(strings.blob), len(groups), len(userids), len(memberships))
+
+    with open(path, 'wb') as snapshot_file:
+        for section in [header, strings.offsets, strings.blob, groups, userids, first_names,
+                        last_names, group_starts, memberships, last_name_order, member_starts, all_members]:
+            snapshot_file.write(section)
+            snapshot_file.write(b'\0' * (_align(snapshot_file.tell()) - snapshot_file.tell()))
+
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+
+
+# A snapshot file, memory mapped.  Strings are only decoded, and users
+# only looked at, when somebody asks for them.
+class Snapshot:
+
+    def __init__(self, path):
+        with open(path, 'rb') as snapshot_file:
+            self.map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Set once a newer snapshot replaces this one, to delete the
+        # file when it's closed
+        self.path = path
+        self.remove_on_close = False
+
+        magic, version, byte_order, self.lsn, string_count, blob_size, group_count, user_count, membership_count = \
+            HEADER.unpack_from(self.map)
+
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("'{}' isn't a version {} snapshot".format(path, VERSION))
+
+        if byte_order != BYTE_ORDER_MARK:
+            raise ValueError("'{}' was written with a different byte order".format(path))
+
+        self.user_count = user_count
+        self.view = memoryview(self.map)
+        self.offset = _align(HEADER.size)
+
+        self.string_offsets = self._section('Q', string_count + 1)
+        self.blob_offset = self.offset
+        self.offset = _align(self.offset + blob_size)
+
+        self.groups = self._section('I', group_count)
+        self.userids = self._section('I', user_count)
+        self.first_names = self._section('I', user_count)
+        self.last_names = self._section('I', user_count)
+        self.group_starts = self._section('I', user_count + 1)
+        self.memberships = self._section('I', membership_count)
+        self.last_name_order = self._section('I', user_count)
+        self.member_starts = self._section('I', group_count + 1)
+        self.members = self._section('I', membership_count)
+
+        # Group names are few and needed straight away
+        self.group_names = [self.string(string_id) for string_id in self.groups]
+
+    def _section(self, type_code, count):
+        size = struct.calcsize(type_code) * count
+        section = self.view[self.offset:self.offset + size].cast(type_code)
+        self.offset = _align(self.offset + size)
+        return section
+
+    def string(self, string_id):
+        start = self.blob_offset + self.string_offsets[string_id]
+        end = self.blob_offset + self.string_offsets[string_id + 1]
+        return self.map[start:end].decode('utf-8')
+
+    def userid(self, ordinal):
+        return self.string(self.userids[ordinal])
+
+    def lastName(self, ordinal):
+        return self.string(self.last_names[ordinal])
+
+    # (userid, first_name, last_name, group ordinals) for a user
+    def record(self, ordinal):
+        return (
+            self.string(self.userids[ordinal]),
+            self.string(self.first_names[ordinal]),
+            self.string(self.last_names[ordinal]),
+            self.memberships[self.group_starts[ordinal]:self.group_starts[ordinal + 1]].tolist()
+        )
+
+    # The ordinal of the first user whose userid is >= userid
+    def userPosition(self, userid):
+        return bisect_left(_Keys(self.user_count, self.userid), userid)
+
+    # Return the ordinal of the user with this userid, or -1
+    def find(self, userid):
+        ordinal = self.userPosition(userid)
+
+        if ordinal < self.user_count and self.userid(ordinal) == userid:
+            return ordinal
+
+        return -1
+
+    # The position in last name order of the first
+    # (last_name, userid) key that is >= key
+    def lastNamePosition(self, key):
+        return bisect_left(_Keys(self.user_count, self.lastNameKey), key)
+
+    # The (last_name, userid) key at a position in last name order
+    def lastNameKey(self, position):
+        ordinal = self.last_name_order[position]
+        return (self.lastName(ordinal), self.userid(ordinal))
+
+    # Ordinals of the members of a group, in userid order
+    def groupMembers(self, group_ordinal):
+        return self.members[self.member_starts[group_ordinal]:self.member_starts[group_ordinal + 1]].tolist()
+
+    def groupMemberCount(self, group_ordinal):
+        return self.member_starts[group_ordinal + 1] - self.member_starts[group_ordinal]
+
+    # A Counter of how many users are in each number of groups
+    def groupsPerUser(self):
+        starts = self.group_starts
+        return Counter(map(sub, islice(starts, 1, None), islice(starts, 0, self.user_count)))
+
+    def close(self):
+        for section in [self.string_offsets, self.groups, self.userids, self.first_names, self.last_names,
+                        self.group_starts, self.memberships, self.last_name_order, self.member_starts, self.members]:
+            section.release()
+
+        self.view.release()
+        self.map.close()
+
+        if self.remove_on_close:
+            os.remove(self.path)
+
+
+# A sequence view over sorted keys that are only computed when
+# bisect asks for them
+class _Keys:
+
+    def __init__(self, length, key):
+        self.length = length
+        self.key = key
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, position):
+        return self.key(position)
@@ -0,0 +1,161 @@
+from bisect import bisect_left, bisect_right
+
+# A set of mutually comparable keys kept in sorted order.  Keys live in
+# a list of chunks of at most 2 * LOAD keys each, alongside a list of
+# each chunk's largest key, so adds and removes only shift one chunk
+# and iteration can start from any key after a couple of bisects.
+
+class SortedSet:
+    __slots__ = ('_chunks', '_maxes', '_len')
+
+    LOAD = 500
+
+    def __init__(self, keys = ()):
+        self._chunks = []
+        self._maxes = []
+        self._len = 0
+
+        for key in sorted(set(keys)):
+            if not self._chunks or len(self._chunks[-1]) == self.LOAD:
+                self._chunks.append([])
+                self._maxes.append(key)
+
+            self._chunks[-1].append(key)
+            self._maxes[-1] = key
+            self._len += 1
+
+    # Add a key.  Adding a key that's already present does nothing.
+    def add(self, key):
+        if not self._maxes:
+            self._chunks.append([key])
+            self._maxes.append(key)
+            self._len += 1
+            return
+
+        pos = bisect_left(self._maxes, key)
+
+        # Bigger than everything: tack it on to the last chunk
+        if pos == len(self._maxes):
+            pos -= 1
+            self._chunks[pos].append(key)
+            self._maxes[pos] = key
+        else:
+            chunk = self._chunks[pos]
+            idx = bisect_left(chunk, key)
+
+            if chunk[idx] == key:
+                return
+
+            chunk.insert(idx, key)
+
+        self._len += 1
+        self._split(pos)
+
+    # Remove a key if it's present
+    def discard(self, key):
+        pos = bisect_left(self._maxes, key)
+
+        if pos == len(self._maxes):
+            return
+
+        chunk = self._chunks[pos]
+        idx = bisect_left(chunk, key)
+
+        if chunk[idx] != key:
+            return
+
+        del chunk[idx]
+        self._len -= 1
+
+        if not chunk:
+            del self._chunks[pos]
+            del self._maxes[pos]
+        elif idx == len(chunk):
+            self._maxes[pos] = chunk[-1]
+
+    def clear(self):
+        del self._chunks[:]
+        del self._maxes[:]
+        self._len = 0
+
+    # Iterate over keys in order, starting with the first key that
+    # is >= start (or > start if inclusive is False).  With no start
+    # key, iteration starts from the smallest key.
+    def iterFrom(self, start = None, inclusive = True):
+        pos = 0
+        idx = 0
+
+        if start is not None:
+            find = bisect_left if inclusive else bisect_right
+            pos = find(self._maxes, start)
+
+            if pos == len(self._maxes):
+                return
+
+            idx = find(self._chunks[pos], start)
+
+        while pos < len(self._chunks):
+            chunk = self._chunks[pos]
+
+            while idx < len(chunk):
+                yield chunk[idx]
+                idx += 1
+
+            pos += 1
+            idx = 0
+
+    # Like iterFrom, but return a list of at most count keys, which is
+    # a lot quicker than pulling them out of iterFrom one at a time.
+    def sliceFrom(self, start = None, inclusive = True, count = None):
+        pos = 0
+        idx = 0
+
+        if start is not None:
+            find = bisect_left if inclusive else bisect_right
+            pos = find(self._maxes, start)
+
+            if pos == len(self._maxes):
+                return []
+
+            idx = find(self._chunks[pos], start)
+
+            # Usually they all come out of the one chunk
+            if count is not None and idx + count <= len(self._chunks[pos]):
+                return self._chunks[pos][idx:idx + count]
+
+        keys = []
+
+        while pos < len(self._chunks) and (count is None or len(keys) < count):
+            end = None if count is None else idx + count - len(keys)
+            keys.extend(self._chunks[pos][idx:end])
+            pos += 1
+            idx = 0
+
+        return keys
+
+    def __contains__(self, key):
+        pos = bisect_left(self._maxes, key)
+
+        if pos == len(self._maxes):
+            return False
+
+        chunk = self._chunks[pos]
+        return chunk[bisect_left(chunk, key)] == key
+
+    def __iter__(self):
+        return self.iterFrom()
+
+    def __len__(self):
+        return self._len
+
+    # Split a chunk in two once it has grown past twice the load
+    def _split(self, pos):
+        chunk = self._chunks[pos]
+
+        if len(chunk) > 2 * self.LOAD:
+            tail = chunk[self.LOAD:]
+            del chunk[self.LOAD:]
+
+            self._maxes[pos] = chunk[-1]
+            self._chunks.insert(pos + 1, tail)
+            self._maxes.insert(pos + 1, tail[-1])
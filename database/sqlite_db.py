@@ -0,0 +1,779 @@
+from itertools import takewhile
+import sqlite3
+import threading
+
+from database import common
+from database.fake_db import User, Group, BatchError, _adoptGroup, _checkPageKey, _internedGroup, _page, _retireGroup
+from database.group_query import parseGroupQuery
+
+# The fake_db API on top of a SQLite database file, so that a directory
+# bigger than memory can be served, and shared by several worker
+# processes.  fake_db switches over to these functions when
+# FAKE_DB_BACKEND=sqlite.
+#
+# Each thread gets its own connection, since sqlite3 connections can't
+# be used by two threads at once.  Servers may start a thread for every
+# request, so once a thread has finished its connection goes back to a
+# pool for the next new thread to pick up, and there are never more
+# connections than there have been threads using them at once.  Every
+# statement is a constant (or built the same way each time), so
+# sqlite3's per-connection statement cache means each one is only
+# prepared once per connection.
+#
+# User objects are remembered in an identity map for as long as anybody
+# holds on to them.  As with the in-memory database, getUserByUserid
+# hands back the object that was stored (as long as the database still
+# agrees with it), and changing the groups of that object, rather than
+# of a detached copy with the same userid, changes the database.
+#
+# Change listeners only hear about changes made by this process.
+
+__all__ = [
+    'backend', 'openDatabase', 'closeDatabase', 'change_listeners', 'addChangeListener',
+    'allUsers', 'userExistsByUserid', 'getUserByUserid', 'addUser', 'addUsers', 'updateUser', 'deleteUserByUserId',
+    'userHasGroup', 'addGroupToUser', 'removeGroupFromUser', 'pageUsers', 'iterUserBatches', 'iterUsers',
+    'allGroups', 'groupNameExists', 'groupExists', 'addGroupByName', 'addGroup', 'addGroups', 'getGroupByName',
+    'pageGroups', 'removeGroupByName', 'removeGroup', 'getUserIdsForGroup', 'updateGroupMembership',
+    'changeGroupMembership', 'countGroupQuery', 'pageGroupQuery', 'groupStats', 'tableVersion', 'userVersion', 'groupVersion',
+    'changesSince'
+]
+
+backend = 'sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS groups (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS users (
+    userid TEXT PRIMARY KEY,
+    first_name TEXT NOT NULL,
+    last_name TEXT NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS users_by_last_name ON users (last_name, userid);
+
+CREATE TABLE IF NOT EXISTS memberships (
+    group_id INTEGER NOT NULL,
+    userid TEXT NOT NULL,
+    PRIMARY KEY (group_id, userid)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS memberships_by_userid ON memberships (userid, group_id);
+'''
+
+# The counts groupStats reports, kept up to date by triggers in the same
+# transaction as every change, so that it doesn't have to count every
+# membership of every user: each group's member count, each user's
+# group count, and how many users are in each number of groups.  A
+# database made before these existed has them filled in when it's
+# opened (see _addCounts).
+COUNT_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS group_sizes (group_id INTEGER PRIMARY KEY, members INTEGER NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS user_group_counts (userid TEXT PRIMARY KEY, group_count INTEGER NOT NULL) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS groups_per_user (group_count INTEGER PRIMARY KEY, users INTEGER NOT NULL)',
+    '''CREATE TRIGGER IF NOT EXISTS count_added_group AFTER INSERT ON groups BEGIN
+        INSERT INTO group_sizes (group_id, members) VALUES (NEW.id, 0);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS count_removed_group AFTER DELETE ON groups BEGIN
+        DELETE FROM group_sizes WHERE group_id = OLD.id;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS count_added_user AFTER INSERT ON users BEGIN
+        INSERT INTO user_group_counts (userid, group_count) VALUES (NEW.userid, 0);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS count_removed_user AFTER DELETE ON users BEGIN
+        DELETE FROM user_group_counts WHERE userid = OLD.userid;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS count_added_membership AFTER INSERT ON memberships BEGIN
+        UPDATE group_sizes SET members = members + 1 WHERE group_id = NEW.group_id;
+        UPDATE user_group_counts SET group_count = group_count + 1 WHERE userid = NEW.userid;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS count_removed_membership AFTER DELETE ON memberships BEGIN
+        UPDATE group_sizes SET members = members - 1 WHERE group_id = OLD.group_id;
+        UPDATE user_group_counts SET group_count = group_count - 1 WHERE userid = OLD.userid;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS count_added_user_count AFTER INSERT ON user_group_counts BEGIN
+        INSERT OR IGNORE INTO groups_per_user (group_count, users) VALUES (NEW.group_count, 0);
+        UPDATE groups_per_user SET users = users + 1 WHERE group_count = NEW.group_count;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS count_changed_user_count AFTER UPDATE OF group_count ON user_group_counts BEGIN
+        UPDATE groups_per_user SET users = users - 1 WHERE group_count = OLD.group_count;
+        INSERT OR IGNORE INTO groups_per_user (group_count, users) VALUES (NEW.group_count, 0);
+        UPDATE groups_per_user SET users = users + 1 WHERE group_count = NEW.group_count;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS count_removed_user_count AFTER DELETE ON user_group_counts BEGIN
+        UPDATE groups_per_user SET users = users - 1 WHERE group_count = OLD.group_count;
+    END'''
+]
+
+HAS_COUNTS = "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'groups_per_user'"
+FILL_GROUP_SIZES = 'INSERT INTO group_sizes (group_id, members) ' \
+                   'SELECT groups.id, COUNT(memberships.userid) FROM groups ' \
+                   'LEFT JOIN memberships ON memberships.group_id = groups.id GROUP BY groups.id'
+FILL_USER_GROUP_COUNTS = 'INSERT INTO user_group_counts (userid, group_count) ' \
+                         'SELECT users.userid, COUNT(memberships.group_id) FROM users ' \
+                         'LEFT JOIN memberships ON memberships.userid = users.userid GROUP BY users.userid'
+
+# How many userids go into one "IN (...)" lookup.  Short lookups are
+# padded out with NULLs so there's only ever one statement to prepare.
+LOOKUP_SIZE = 500
+
+SELECT_GROUP_ID = 'SELECT id FROM groups WHERE name = ?'
+SELECT_GROUP_NAMES = 'SELECT name FROM groups ORDER BY id'
+SELECT_GROUP_PAGE = 'SELECT name FROM groups WHERE name > ? ORDER BY name LIMIT ?'
+SELECT_FIRST_GROUP_PAGE = 'SELECT name FROM groups ORDER BY name LIMIT ?'
+INSERT_GROUP = 'INSERT INTO groups (name) VALUES (?)'
+DELETE_GROUP = 'DELETE FROM groups WHERE id = ?'
+
+SELECT_USER = 'SELECT userid, first_name, last_name FROM users WHERE userid = ?'
+INSERT_USER = 'INSERT INTO users (userid, first_name, last_name) VALUES (?, ?, ?)'
+UPDATE_USER = 'UPDATE users SET first_name = ?, last_name = ? WHERE userid = ?'
+DELETE_USER = 'DELETE FROM users WHERE userid = ?'
+
+SELECT_MEMBERS = 'SELECT userid FROM memberships WHERE group_id = ? ORDER BY userid'
+SELECT_USER_GROUPS = 'SELECT groups.name FROM memberships JOIN groups ON groups.id = memberships.group_id ' \
+                     'WHERE memberships.userid = ? ORDER BY groups.id'
+SELECT_USERS_GROUPS = 'SELECT memberships.userid, groups.name FROM memberships ' \
+                      'JOIN groups ON groups.id = memberships.group_id ' \
+                      'WHERE memberships.userid IN ({}) ORDER BY groups.id'.format(', '.join(['?'] * LOOKUP_SIZE))
+INSERT_MEMBERSHIP = 'INSERT OR IGNORE INTO memberships (group_id, userid) VALUES (?, ?)'
+INSERT_MEMBERSHIP_BY_NAME = 'INSERT OR IGNORE INTO memberships (group_id, userid) ' \
+                            'SELECT groups.id, users.userid FROM groups, users WHERE groups.name = ? AND users.userid = ?'
+DELETE_MEMBERSHIP = 'DELETE FROM memberships WHERE group_id = ? AND userid = ?'
+DELETE_MEMBERSHIP_BY_NAME = 'DELETE FROM memberships WHERE userid = ? AND group_id = (SELECT id FROM groups WHERE name = ?)'
+DELETE_USER_MEMBERSHIPS = 'DELETE FROM memberships WHERE userid = ?'
+DELETE_GROUP_MEMBERSHIPS = 'DELETE FROM memberships WHERE group_id = ?'
+
+COUNT_USERS = 'SELECT COALESCE(SUM(users), 0) FROM groups_per_user'
+COUNT_MEMBERS = 'SELECT groups.name, group_sizes.members FROM groups ' \
+                'JOIN group_sizes ON group_sizes.group_id = groups.id ORDER BY groups.name'
+COUNT_GROUPS_PER_USER = 'SELECT group_count, users FROM groups_per_user WHERE users > 0 ORDER BY group_count'
+
+#                                  _   _
+#                                 | | (_)
+#   ___ ___  _ __  _ __   ___  ___| |_ _  ___  _ __  ___
+#  / __/ _ \| '_ \| '_ \ / _ \/ __| __| |/ _ \| '_ \/ __|
+# | (_| (_) | | | | | | |  __/ (__| |_| | (_) | | | \__ \
+#  \___\___/|_| |_|_| |_|\___|\___|\__|_|\___/|_| |_|___/
+
+# Open (creating it if need be) the database file at path.  A brand new
+# database starts out with the same users and groups as the in-memory
+# one does.
+def openDatabase(path):
+    global database_path
+
+    closeDatabase()
+    database_path = path
+
+    _connection().executescript(SCHEMA)
+    _addCounts()
+
+    with _transaction() as connection:
+        if connection.execute('SELECT COUNT(*) FROM groups').fetchone()[0] == 0:
+            _bootstrap(connection)
+
+    # Intern every group in creation order, so that the groups of a
+    # User come back in the same order they do from the database
+    for name, in _connection().execute(SELECT_GROUP_NAMES):
+        _internedGroup(name)
+
+# Close every thread's connection and forget every user object
+def closeDatabase():
+    global database_path, generation
+
+    with connections_lock:
+        for thread, connection in connections:
+            connection.close()
+
+        for connection in idle_connections:
+            connection.close()
+
+        del connections[:]
+        del idle_connections[:]
+        generation += 1
+
+    identity_map.clear()
+    database_path = None
+
+# This thread's connection, the first time it's needed taken from a
+# thread that has finished or else newly opened
+def _connection():
+    connection = getattr(local, 'connection', None)
+
+    if connection is None or local.generation != generation:
+        if database_path is None:
+            raise RuntimeError("no database is open")
+
+        with connections_lock:
+            _reclaimConnections()
+            connection = idle_connections.pop() if idle_connections else None
+            opened_generation = generation
+
+        if connection is None:
+            connection = sqlite3.connect(database_path, timeout = 30, isolation_level = None,
+                                         check_same_thread = False, cached_statements = 256)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+
+        with connections_lock:
+            # closeDatabase ran while this one was being opened
+            if opened_generation != generation:
+                connection.close()
+                raise RuntimeError("the database was closed")
+
+            connections.append((threading.current_thread(), connection))
+            local.connection = connection
+            local.generation = generation
+
+    return connection
+
+# Move the connections of threads that have finished to the idle pool.
+# Only call this with connections_lock held.
+def _reclaimConnections():
+    running = []
+
+    for thread, connection in connections:
+        if thread.is_alive():
+            running.append((thread, connection))
+        else:
+            if connection.in_transaction:
+                connection.rollback()
+
+            idle_connections.append(connection)
+
+    connections[:] = running
+
+# A write transaction on this thread's connection, taking the write
+# lock up front so that two processes can't deadlock upgrading to it.
+class _transaction:
+
+    def __enter__(self):
+        self.connection = _connection()
+        self.connection.execute('BEGIN IMMEDIATE')
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+
+# Create the count tables and their triggers, counting what's already
+# there if they're new.  All in one transaction, so that no change
+# gets counted twice, or not at all, while they're being filled in.
+def _addCounts():
+    with _transaction() as connection:
+        new = connection.execute(HAS_COUNTS).fetchone()[0] == 0
+
+        for statement in COUNT_SCHEMA:
+            connection.execute(statement)
+
+        if new:
+            connection.execute(FILL_GROUP_SIZES)
+            connection.execute(FILL_USER_GROUP_COUNTS)
+
+def _bootstrap(connection):
+    for group_name in ["users", "admins", "execs", "pirates"]:
+        connection.execute(INSERT_GROUP, (group_name,))
+
+    for userid, first_name, last_name, group_names in [
+        ("jsmith", "Joe", "Smith", ["admins", "users"]),
+        ("jjones", "Jane", "Jones", ["users", "execs"]),
+        ("jsparrow", "Jack", "Sparrow", ["users", "pirates"])
+    ]:
+        connection.execute(INSERT_USER, (userid, first_name, last_name))
+
+        for group_name in group_names:
+            connection.execute(INSERT_MEMBERSHIP_BY_NAME, (group_name, userid))
+
+def addChangeListener(listener):
+    identity_map.addChangeListener(listener)
+
+# Other processes change the database file without this one hearing
+# about it, so there are no version tags to hand out and no change log
+def tableVersion():
+    return None
+
+def userVersion(userid):
+    return None
+
+def groupVersion(group_name):
+    return None
+
+def changesSince(since, timeout = None):
+    raise NotImplementedError("the SQLite backend doesn't keep a change log")
+
+#  _   _ ___  ___ _ __ ___
+# | | | / __|/ _ \ '__/ __|
+# | |_| \__ \  __/ |  \__ \
+#  \__,_|___/\___|_|  |___/
+
+# Return a list of all users, in userid order.
+def allUsers():
+    return list(iterUsers())
+
+def userExistsByUserid(userid):
+    return _connection().execute(SELECT_USER, (userid,)).fetchone() is not None
+
+# Return a particular user that matches the userid
+def getUserByUserid(userid):
+    connection = _connection()
+    row = connection.execute(SELECT_USER, (userid,)).fetchone()
+
+    if row is None:
+        raise LookupError("user with userid '{}' does not exist".format(userid))
+
+    return _user(row, [name for name, in connection.execute(SELECT_USER_GROUPS, (userid,))])
+
+# Add a new user
+def addUser(user):
+    with _transaction() as connection:
+        if connection.execute(SELECT_USER, (user.userid,)).fetchone() is not None:
+            raise ValueError("user with userid '{}' already exists".format(user.userid))
+
+        # this'll raise an exception if group doesn't exist
+        group_ids = _groupIds(connection, user.groups)
+
+        connection.execute(INSERT_USER, (user.userid, user.first_name, user.last_name))
+        connection.executemany(INSERT_MEMBERSHIP, [(group_id, user.userid) for group_id in group_ids])
+
+    identity_map.stored(user)
+
+# Add a batch of new users in one transaction, all or nothing.  See
+# fake_db.addUsers.
+def addUsers(new_users):
+    with _transaction() as connection:
+        errors = []
+        userids = set()
+        group_ids = {}
+
+        for index, user in enumerate(new_users):
+            if user.userid in userids:
+                errors.append((index, "user with userid '{}' is in the batch more than once".format(user.userid)))
+            elif connection.execute(SELECT_USER, (user.userid,)).fetchone() is not None:
+                errors.append((index, "user with userid '{}' already exists".format(user.userid)))
+            else:
+                for group in user.groups:
+                    if group.name not in group_ids:
+                        group_ids[group.name] = _groupId(connection, group.name)
+
+                    if group_ids[group.name] is None:
+                        errors.append((index, "group '{}' does not exist".format(group.name)))
+                        break
+
+            userids.add(user.userid)
+
+        if errors:
+            raise BatchError(errors)
+
+        connection.executemany(INSERT_USER, [(user.userid, user.first_name, user.last_name) for user in new_users])
+        connection.executemany(INSERT_MEMBERSHIP, [(group_ids[group.name], user.userid)
+                                                   for user in new_users for group in user.groups])
+
+    for user in new_users:
+        identity_map.stored(user)
+
+# Update an existing user.  Make sure the user exists and that the new
+# user's groups are legit, then swap the new user's row in.
+def updateUser(new_user):
+    with _transaction() as connection:
+        if connection.execute(SELECT_USER, (new_user.userid,)).fetchone() is None:
+            raise LookupError("user with userid '{}' does not exist".format(new_user.userid))
+
+        # yep, make sure these groups are legit
+        group_ids = _groupIds(connection, new_user.groups)
+
+        old_group_names = [name for name, in connection.execute(SELECT_USER_GROUPS, (new_user.userid,))]
+        connection.execute(UPDATE_USER, (new_user.first_name, new_user.last_name, new_user.userid))
+        connection.execute(DELETE_USER_MEMBERSHIPS, (new_user.userid,))
+        connection.executemany(INSERT_MEMBERSHIP, [(group_id, new_user.userid) for group_id in group_ids])
+
+    identity_map.stored(new_user, old_group_names)
+
+# Delete an existing user
+def deleteUserByUserId(userid):
+    with _transaction() as connection:
+        if connection.execute(SELECT_USER, (userid,)).fetchone() is None:
+            raise LookupError("user with userid '{}' does not exist".format(userid))
+
+        group_names = [name for name, in connection.execute(SELECT_USER_GROUPS, (userid,))]
+        connection.execute(DELETE_USER_MEMBERSHIPS, (userid,))
+        connection.execute(DELETE_USER, (userid,))
+
+    identity_map.deleted(userid, group_names)
+
+def userHasGroup(user, group):
+    return group in user.groups
+
+# Add a group to a user.  See common.IdentityMap.changeMembership.
+def addGroupToUser(user, group):
+    identity_map.changeMembership(user, group, True, lambda userid, group_name:
+                                  _changeMembership(INSERT_MEMBERSHIP_BY_NAME, (group_name, userid)))
+
+# Remove a group from a user, the same way
+def removeGroupFromUser(user, group):
+    identity_map.changeMembership(user, group, False, lambda userid, group_name:
+                                  _changeMembership(DELETE_MEMBERSHIP_BY_NAME, (userid, group_name)))
+
+# Run a statement that adds or removes one membership, and say whether
+# it did
+def _changeMembership(sql, parameters):
+    with _transaction() as connection:
+        return connection.execute(sql, parameters).rowcount > 0
+
+# The User for a (userid, first_name, last_name) row and its group
+# names, see common.IdentityMap.user
+def _user(row, group_names):
+    userid, first_name, last_name = row
+    return identity_map.user(userid, first_name, last_name, group_names)
+
+# Users for a list of rows, looking up their groups LOOKUP_SIZE at a time
+def _users(connection, rows):
+    group_names = dict((row[0], []) for row in rows)
+    userids = list(group_names)
+
+    for start in range(0, len(userids), LOOKUP_SIZE):
+        lookup = userids[start:start + LOOKUP_SIZE]
+        lookup += [None] * (LOOKUP_SIZE - len(lookup))
+
+        for userid, name in connection.execute(SELECT_USERS_GROUPS, lookup):
+            group_names[userid].append(name)
+
+    return [_user(row, group_names[row[0]]) for row in rows]
+
+# Return a page of up to `limit` users (all of them if limit is None)
+# along with the key to pass back as `after` to get the next page, or
+# None if there are no more.  Works just like fake_db.pageUsers, with
+# the users table, its last name index or a group's memberships
+# walked from the `after` key.
+def pageUsers(limit = None, after = None, group = None, last_name_prefix = None):
+    connection = _connection()
+    conditions = []
+    parameters = []
+
+    if group is None:
+        source = 'users'
+        userid_column = 'users.userid'
+    else:
+        group_id = _groupId(connection, group.name)
+
+        if group_id is None:
+            raise LookupError("group '{}' does not exist".format(group.name))
+
+        source = 'memberships JOIN users ON users.userid = memberships.userid'
+        userid_column = 'memberships.userid'
+        conditions.append('memberships.group_id = ?')
+        parameters.append(group_id)
+
+    if group is None and last_name_prefix is not None:
+        _checkPageKey(after, pair = True)
+        order = 'last_name, users.userid'
+
+        if after is None:
+            conditions.append('last_name >= ?')
+            parameters.append(last_name_prefix)
+        else:
+            conditions.append('(last_name, users.userid) > (?, ?)')
+            parameters.extend(after)
+    else:
+        _checkPageKey(after)
+        order = userid_column
+
+        if after is not None:
+            conditions.append('{} > ?'.format(userid_column))
+            parameters.append(after)
+
+        if last_name_prefix is not None:
+            conditions.append('substr(last_name, 1, ?) = ?')
+            parameters.extend([len(last_name_prefix), last_name_prefix])
+
+    query = 'SELECT users.userid, first_name, last_name FROM {} {} ORDER BY {} LIMIT ?'.format(
+        source,
+        'WHERE ' + ' AND '.join(conditions) if conditions else '',
+        order
+    )
+    parameters.append(-1 if limit is None else limit + 1)
+
+    rows = connection.execute(query, parameters)
+
+    if group is None and last_name_prefix is not None:
+        rows = takewhile(lambda row: row[2].startswith(last_name_prefix), rows)
+        rows = list(rows)
+        keys = [(row[2], row[0]) for row in rows]
+    else:
+        rows = list(rows)
+        keys = [row[0] for row in rows]
+
+    return _page(zip(keys, _users(connection, rows)), limit)
+
+# Lazily iterate over every user in userid order, in lists of up to
+# batch_size users.  See common.iterUserBatches.
+def iterUserBatches(batch_size = 1000):
+    return common.iterUserBatches(pageUsers, batch_size)
+
+# Lazily iterate over every user in userid order
+def iterUsers(batch_size = 1000):
+    return common.iterUsers(pageUsers, batch_size)
+
+# Resolve the ids of a user's groups, raising
+# a LookupError for the first one that's missing.
+def _groupIds(connection, group_set):
+    group_ids = []
+
+    for group in group_set:
+        group_id = _groupId(connection, group.name)
+
+        if group_id is None:
+            raise LookupError("group '{}' does not exist".format(group.name))
+
+        group_ids.append(group_id)
+
+    return group_ids
+
+#   __ _ _ __ ___  _   _ _ __  ___
+#  / _` | '__/ _ \| | | | '_ \/ __|
+# | (_| | | | (_) | |_| | |_) \__ \
+#  \__, |_|  \___/ \__,_| .__/|___/
+#   __/ |               | |
+#  |___/                |_|
+
+def allGroups():
+    return [_internedGroup(name) for name, in _connection().execute(SELECT_GROUP_NAMES)]
+
+# Return true if a group already exists with this group name
+def groupNameExists(group_name):
+    return _groupId(_connection(), group_name) is not None
+
+def groupExists(group):
+    return groupNameExists(group.name)
+
+def addGroupByName(new_group_name):
+    new_group = Group(new_group_name)
+    addGroup(new_group)
+
+def addGroup(new_group):
+    try:
+        with _transaction() as connection:
+            connection.execute(INSERT_GROUP, (new_group.name,))
+
+    except sqlite3.IntegrityError:
+        raise ValueError("group with name '{}' already exists".format(new_group.name))
+
+    _adoptGroup(new_group)
+    identity_map.changed("group", new_group.name)
+
+# Add a batch of new groups in one transaction, all or nothing.  See
+# fake_db.addGroups.
+def addGroups(new_groups):
+    with _transaction() as connection:
+        errors = []
+        names = set()
+
+        for index, group in enumerate(new_groups):
+            if group.name in names:
+                errors.append((index, "group with name '{}' is in the batch more than once".format(group.name)))
+            elif _groupId(connection, group.name) is not None:
+                errors.append((index, "group with name '{}' already exists".format(group.name)))
+
+            names.add(group.name)
+
+        if errors:
+            raise BatchError(errors)
+
+        connection.executemany(INSERT_GROUP, [(group.name,) for group in new_groups])
+
+    for group in new_groups:
+        _adoptGroup(group)
+        identity_map.changed("group", group.name)
+
+def getGroupByName(group_name):
+    if not groupNameExists(group_name):
+        raise LookupError("group '{}' does not exist".format(group_name))
+    else:
+        return _internedGroup(group_name)
+
+# Return a page of up to `limit` groups in group name order, along
+# with the key for the next page.  See pageUsers.
+def pageGroups(limit = None, after = None):
+    _checkPageKey(after)
+    sql_limit = -1 if limit is None else limit + 1
+
+    if after is None:
+        names = _connection().execute(SELECT_FIRST_GROUP_PAGE, (sql_limit,))
+    else:
+        names = _connection().execute(SELECT_GROUP_PAGE, (after, sql_limit))
+
+    return _page([(name, _internedGroup(name)) for name, in names], limit)
+
+def removeGroupByName(group_name):
+    removeGroup(getGroupByName(group_name))
+
+# Remove group from group list and from users that are members
+# of that group.
+def removeGroup(group):
+    with _transaction() as connection:
+        group_id = _groupId(connection, group.name)
+
+        if group_id is None:
+            raise LookupError("group '{}' does not exist".format(group.name))
+
+        userids = [userid for userid, in connection.execute(SELECT_MEMBERS, (group_id,))]
+        connection.execute(DELETE_GROUP_MEMBERSHIPS, (group_id,))
+        connection.execute(DELETE_GROUP, (group_id,))
+
+    identity_map.membershipChanged(group, userids, [])
+    _retireGroup(group)
+
+# Return a list of userids for all users
+# that are members of this group.
+def getUserIdsForGroup(group):
+    connection = _connection()
+    group_id = _groupId(connection, group.name)
+
+    if group_id is None:
+        return []
+
+    return [userid for userid, in connection.execute(SELECT_MEMBERS, (group_id,))]
+
+# Count the users matching a group query, like fake_db.countGroupQuery
+def countGroupQuery(expression):
+    connection = _connection()
+    condition, parameters = _groupQueryCondition(connection, parseGroupQuery(expression))
+    return connection.execute('SELECT COUNT(*) FROM users WHERE ' + condition, parameters).fetchone()[0]
+
+# Return a page of up to `limit` userids of users matching a group
+# query, like fake_db.pageGroupQuery, except that they're in userid order
+def pageGroupQuery(expression, limit = None, after = None):
+    _checkPageKey(after)
+    connection = _connection()
+    condition, parameters = _groupQueryCondition(connection, parseGroupQuery(expression))
+
+    if after is not None:
+        condition = 'userid > ? AND ({})'.format(condition)
+        parameters.insert(0, after)
+
+    query = 'SELECT userid FROM users WHERE {} ORDER BY userid LIMIT ?'.format(condition)
+    parameters.append(-1 if limit is None else limit + 1)
+
+    return _page(((userid, userid) for userid, in connection.execute(query, parameters)), limit)
+
+# A WHERE condition on the users table for a group query tree, and its
+# parameters.  Each group is a lookup in the memberships primary key.
+# Only ANDs and ORs under another operator get parentheses, since
+# SQLite's parser runs out of stack at around 30 levels of them.
+def _groupQueryCondition(connection, tree):
+    if tree[0] == 'group':
+        group_id = _groupId(connection, tree[1])
+
+        if group_id is None:
+            raise LookupError("group '{}' does not exist".format(tree[1]))
+
+        return 'EXISTS (SELECT 1 FROM memberships WHERE group_id = ? AND userid = users.userid)', [group_id]
+
+    if tree[0] == 'not':
+        condition, parameters = _groupQueryCondition(connection, tree[1])
+        return ('NOT ({})' if tree[1][0] in ('and', 'or') else 'NOT {}').format(condition), parameters
+
+    conditions = []
+    parameters = []
+
+    for operand in tree[1]:
+        condition, operand_parameters = _groupQueryCondition(connection, operand)
+        conditions.append('({})'.format(condition) if operand[0] in ('and', 'or') else condition)
+        parameters.extend(operand_parameters)
+
+    return ' {} '.format(tree[0].upper()).join(conditions), parameters
+
+# Return the same statistics as fake_db.groupStats.  Other processes
+# can change the database file, so these are counted afresh each time
+# from the tables' indexes.
+def groupStats():
+    connection = _connection()
+
+    return {
+        "users": connection.execute(COUNT_USERS).fetchone()[0],
+        "members": connection.execute(COUNT_MEMBERS).fetchall(),
+        "groups_per_user": connection.execute(COUNT_GROUPS_PER_USER).fetchall()
+    }
+
+# Pass in a group and a list of userid strings
+def updateGroupMembership(group, userids):
+    with _transaction() as connection:
+        group_id = _groupId(connection, group.name)
+
+        if group_id is None:
+            raise LookupError("group '{}' does not exist".format(group.name))
+
+        # This'll throw an exception for any userid
+        # that doesn't match an actual user.
+        found_userids = set(_checkUsersExist(connection, userids))
+        current_userids = set(userid for userid, in connection.execute(SELECT_MEMBERS, (group_id,)))
+
+        removed_userids = sorted(current_userids - found_userids)
+        added_userids = sorted(found_userids - current_userids)
+
+        connection.executemany(DELETE_MEMBERSHIP, [(group_id, userid) for userid in removed_userids])
+        connection.executemany(INSERT_MEMBERSHIP, [(group_id, userid) for userid in added_userids])
+
+    identity_map.membershipChanged(group, removed_userids, added_userids)
+
+# Apply a membership delta to a group: add it to the users in
+# add_userids and remove it from the users in remove_userids.  Every
+# userid is checked before anything changes, so an unknown userid
+# raises a LookupError and leaves the group untouched.
+def changeGroupMembership(group, add_userids, remove_userids):
+    both = set(add_userids) & set(remove_userids)
+
+    with _transaction() as connection:
+        group_id = _groupId(connection, group.name)
+
+        if group_id is None:
+            raise LookupError("group '{}' does not exist".format(group.name))
+
+        if both:
+            raise ValueError("userids {} are both added to and removed from group '{}'".format(sorted(both), group.name))
+
+        _checkUsersExist(connection, list(add_userids) + list(remove_userids))
+        current_userids = set(userid for userid, in connection.execute(SELECT_MEMBERS, (group_id,)))
+
+        removed_userids = sorted(set(remove_userids) & current_userids)
+        added_userids = sorted(set(add_userids) - current_userids)
+
+        connection.executemany(DELETE_MEMBERSHIP, [(group_id, userid) for userid in removed_userids])
+        connection.executemany(INSERT_MEMBERSHIP, [(group_id, userid) for userid in added_userids])
+
+    identity_map.membershipChanged(group, removed_userids, added_userids)
+
+# Raise a LookupError for the first userid that doesn't belong to a user
+def _checkUsersExist(connection, userids):
+    for userid in userids:
+        if connection.execute(SELECT_USER, (userid,)).fetchone() is None:
+            raise LookupError("user with userid '{}' does not exist".format(userid))
+
+    return userids
+
+def _groupId(connection, group_name):
+    row = connection.execute(SELECT_GROUP_ID, (group_name,)).fetchone()
+    return None if row is None else row[0]
+
+#      _       _
+#     | |     | |
+#   __| | __ _| |_ __ _
+#  / _` |/ _` | __/ _` |
+# | (_| | (_| | || (_| |
+#  \__,_|\__,_|\__\__,_|
+
+database_path = None
+
+# Per-thread connections, the (thread, connection) of every thread that
+# has one and the connections of threads that have finished, so that
+# closeDatabase can close them all, and a counter that closeDatabase
+# bumps so that each thread notices its connection is gone.
+local = threading.local()
+connections = []
+idle_connections = []
+connections_lock = threading.Lock()
+generation = 0
+
+# userid -> the User object last stored or handed out for it, and
+# the listeners to tell about this process's changes
+identity_map = common.IdentityMap()
+change_listeners = identity_map.change_listeners
@@ -0,0 +1,275 @@
+from multiprocessing.connection import AuthenticationError, Listener
+import argparse
+import os
+import signal
+import socket
+import stat
+import sys
+import threading
+
+# The server always holds the database in memory, whatever backend
+# the workers sharing its environment are told to use
+os.environ["FAKE_DB_BACKEND"] = "memory"
+
+import database.fake_db as db
+from database.remote_db import _address
+
+# A process that holds the one in-memory fake_db and serves it to the
+# web service's worker processes (see database.remote_db), so that
+# several workers, under gunicorn say, all see the same users and groups.
+#
+#     FAKE_DB_AUTHKEY=... python -m database.store_server [--address fake_db.sock]
+#
+# Requests and replies are pickled, so anyone who can connect and knows
+# the key can run code in the server.  It won't start without a key in
+# FAKE_DB_AUTHKEY, and its Unix socket is only open to its own user.
+#
+# Each client connection gets a thread of its own, and fake_db's own
+# locks keep the threads out of each other's way.  The settings that
+# apply to the in-memory database (FAKE_DB_DATA_DIR, FAKE_DB_SHARDS)
+# apply to the server.
+#
+# Arguments and results are plain values: userids, group names, page
+# keys and (userid, first_name, last_name, group names) user records.
+# Errors go back as the name of the exception and its message, or for
+# a BatchError, its list of errors.
+
+#                                 _   _
+#                                | | (_)
+#   ___  _ __   ___ _ __ __ _ ___| |_ _  ___  _ __  ___
+#  / _ \| '_ \ / _ \ '__/ _` / __| __| |/ _ \| '_ \/ __|
+# | (_) | |_) |  __/ | | (_| \__ \ |_| | (_) | | | \__ \
+#  \___/| .__/ \___|_|  \__,_|___/\__|_|\___/|_| |_|___/
+#       | |
+#       |_|
+
+def _record(user):
+    return user.userid, user.first_name, user.last_name, [group.name for group in user.groups]
+
+def _user(record):
+    userid, first_name, last_name, group_names = record
+    return db.User(userid, first_name, last_name, [db.Group(name) for name in group_names])
+
+def _groupNames(user):
+    return [group.name for group in user.groups]
+
+def userExistsByUserid(userid):
+    return db.userExistsByUserid(userid)
+
+def getUserByUserid(userid):
+    return _record(db.getUserByUserid(userid))
+
+def addUser(record):
+    db.addUser(_user(record))
+
+def addUsers(records):
+    db.addUsers([_user(record) for record in records])
+
+# The operations that tell the client what they changed look and
+# change while holding the locks the change itself takes, so nothing
+# can get in between.
+
+# Returns the groups the user was in before, for the client's
+# change listeners
+@db._locked(catalog = db.READ, shards = db.WRITE, user_key = lambda record: record[0])
+def updateUser(record):
+    group_names = _groupNames(db.getUserByUserid(record[0]))
+    db.updateUser(_user(record))
+    return group_names
+
+@db._locked(catalog = db.READ, shards = db.WRITE, user_key = db._userid)
+def deleteUserByUserId(userid):
+    group_names = _groupNames(db.getUserByUserid(userid))
+    db.deleteUserByUserId(userid)
+    return group_names
+
+# Return whether the user wasn't already in the group
+@db._locked(catalog = db.READ, shards = db.WRITE, user_key = db._userid)
+def addGroupToUser(userid, group_name):
+    user = db.getUserByUserid(userid)
+    group = db.getGroupByName(group_name)
+
+    if db.userHasGroup(user, group):
+        return False
+
+    db.addGroupToUser(user, group)
+    return True
+
+# Return whether the user was in the group
+@db._locked(catalog = db.READ, shards = db.WRITE, user_key = db._userid)
+def removeGroupFromUser(userid, group_name):
+    user = db.getUserByUserid(userid)
+    group = db.getGroupByName(group_name)
+
+    if not db.userHasGroup(user, group):
+        return False
+
+    db.removeGroupFromUser(user, group)
+    return True
+
+def pageUsers(limit, after, group_name, last_name_prefix):
+    group = None if group_name is None else db.Group(group_name)
+    users, next_key = db.pageUsers(limit, after, group, last_name_prefix)
+    return [_record(user) for user in users], next_key
+
+def allGroups():
+    return [group.name for group in db.allGroups()]
+
+def groupNameExists(group_name):
+    return db.groupNameExists(group_name)
+
+def addGroup(group_name):
+    db.addGroupByName(group_name)
+
+def addGroups(group_names):
+    db.addGroups([db.Group(name) for name in group_names])
+
+def pageGroups(limit, after):
+    groups, next_key = db.pageGroups(limit, after)
+    return [group.name for group in groups], next_key
+
+# Returns the userids of the group's members
+@db._locked(catalog = db.WRITE, shards = db.WRITE)
+def removeGroup(group_name):
+    group = db.Group(group_name)
+    userids = db.getUserIdsForGroup(group)
+    db.removeGroup(group)
+    return userids
+
+def getUserIdsForGroup(group_name):
+    return db.getUserIdsForGroup(db.Group(group_name))
+
+def countGroupQuery(expression):
+    return db.countGroupQuery(expression)
+
+def pageGroupQuery(expression, limit, after):
+    return db.pageGroupQuery(expression, limit, after)
+
+def groupStats():
+    return db.groupStats()
+
+# The membership changes return the (removed, added) userids
+@db._locked(catalog = db.READ, shards = db.WRITE)
+def updateGroupMembership(group_name, userids):
+    group = db.Group(group_name)
+    before = set(db.getUserIdsForGroup(group))
+    db.updateGroupMembership(group, userids)
+    return sorted(before - set(userids)), sorted(set(userids) - before)
+
+@db._locked(catalog = db.READ, shards = db.WRITE)
+def changeGroupMembership(group_name, add_userids, remove_userids):
+    group = db.Group(group_name)
+    before = set(db.getUserIdsForGroup(group))
+    db.changeGroupMembership(group, add_userids, remove_userids)
+    return sorted(before & set(remove_userids)), sorted(set(add_userids) - before)
+
+def tableVersion():
+    return db.tableVersion()
+
+def userVersion(userid):
+    return db.userVersion(userid)
+
+def groupVersion(group_name):
+    return db.groupVersion(group_name)
+
+def changesSince(since, timeout):
+    return db.changesSince(since, timeout)
+
+OPERATIONS = dict((operation.__name__, operation) for operation in [
+    userExistsByUserid, getUserByUserid, addUser, addUsers, updateUser, deleteUserByUserId, addGroupToUser,
+    removeGroupFromUser, pageUsers, allGroups, groupNameExists, addGroup, addGroups, pageGroups, removeGroup,
+    getUserIdsForGroup, countGroupQuery, pageGroupQuery, groupStats, updateGroupMembership, changeGroupMembership,
+    tableVersion, userVersion, groupVersion, changesSince
+])
+
+#  ___  ___ _ ____   _____ _ __
+# / __|/ _ \ '__\ \ / / _ \ '__|
+# \__ \  __/ |   \ V /  __/ |
+# |___/\___|_|    \_/ \___|_|
+
+# Serve the database at address until the process is killed
+def serve(address, authkey):
+    address = _address(address)
+
+    if isinstance(address, str):
+        _removeStaleSocket(address)
+
+    # Created with the umask set so that it's never anyone else's for a moment
+    old_umask = os.umask(0o177)
+
+    try:
+        listener = Listener(address, authkey = authkey.encode('utf-8'))
+    finally:
+        os.umask(old_umask)
+
+    # Closing the listener removes its socket file
+    try:
+        while True:
+            try:
+                connection = listener.accept()
+
+            # A client with the wrong key, or one that hung up
+            except (AuthenticationError, EOFError, OSError) as e:
+                print( str(e) )
+                continue
+
+            threading.Thread(target = _serveConnection, args = (connection,), daemon = True).start()
+
+    finally:
+        listener.close()
+
+def _serveConnection(connection):
+    with connection:
+        while True:
+            try:
+                op, args = connection.recv()
+            except (EOFError, OSError):
+                return
+
+            try:
+                reply = ('ok', OPERATIONS[op](*args))
+            except db.BatchError as be:
+                reply = ('error', 'BatchError', be.errors)
+            except LookupError as le:
+                reply = ('error', 'LookupError', str(le))
+            except ValueError as ve:
+                reply = ('error', 'ValueError', str(ve))
+            except Exception as e:
+                print( str(e) )
+                reply = ('error', 'RuntimeError', str(e))
+
+            try:
+                connection.send(reply)
+            except OSError:
+                return
+
+# A socket file left behind by a server that's no longer running
+# would stop this one from listening
+def _removeStaleSocket(path):
+    if not os.path.exists(path) or not stat.S_ISSOCK(os.stat(path).st_mode):
+        return
+
+    probe = socket.socket(socket.AF_UNIX)
+
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.remove(path)
+    finally:
+        probe.close()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--address', default = os.environ.get("FAKE_DB_ADDRESS", "fake_db.sock"))
+    args = parser.parse_args()
+
+    if not os.environ.get("FAKE_DB_AUTHKEY"):
+        sys.exit("set FAKE_DB_AUTHKEY to the key clients have to authenticate with")
+
+    # Shut down cleanly when told to stop
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    serve(args.address, os.environ["FAKE_DB_AUTHKEY"])
+
+if __name__ == '__main__':
+    main()
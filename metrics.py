@@ -0,0 +1,338 @@
+from bisect import bisect_left
+import threading
+import time
+import types
+
+# Request and store instrumentation, rendered in Prometheus' text
+# exposition format.
+#
+# Everything is a counter or a histogram kept in plain Python numbers.
+# Each thread records into its own set of them, which nothing else
+# writes to, so recording takes no lock; rendering adds every thread's
+# up.  A histogram counts observations per bucket and only adds the
+# counts up into Prometheus' cumulative buckets when it's rendered, so
+# recording one is a bisect and two additions.
+
+# Upper bounds, in seconds, of the latency buckets: from a dict lookup
+# in the store up to a slow export
+BUCKETS = (0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+           0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+REQUEST = 'request'
+STORE = 'store'
+SERIALIZER = 'serializer'
+
+class Histogram:
+    def __init__(self, bounds = BUCKETS):
+        self.bounds = bounds
+
+        # counts[i] is the number of observations in bucket i on its own,
+        # with the last one for those over the largest bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def add(self, other):
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, list(other.counts))]
+        self.sum += other.sum
+
+    # (upper bound, cumulative count) pairs, ending with "+Inf"
+    def buckets(self):
+        total = 0
+        buckets = []
+
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            total += count
+            buckets.append((bound, total))
+
+        return buckets
+
+    def count(self):
+        return sum(self.counts)
+
+# What one thread has recorded
+class _Recorder:
+    def __init__(self, bounds):
+        self.bounds = bounds
+
+        # (route, method, status) -> count
+        self.requests = {}
+
+        # (REQUEST, (route, method)), (STORE, function name) or
+        # (SERIALIZER, serializer name) -> Histogram of latencies
+        self.histograms = {}
+
+    def histogram(self, key):
+        histogram = self.histograms.get(key)
+
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.bounds)
+
+        return histogram
+
+    # Add another recorder's counts to this one's
+    def add(self, other):
+        for key, count in list(other.requests.items()):
+            self.requests[key] = self.requests.get(key, 0) + count
+
+        for key, histogram in list(other.histograms.items()):
+            self.histogram(key).add(histogram)
+
+class Metrics:
+    def __init__(self, bounds = BUCKETS):
+        self.bounds = bounds
+        self.local = threading.local()
+
+        # (thread, recorder) for the threads that have recorded anything,
+        # and what the threads that have since finished recorded
+        self.lock = threading.Lock()
+        self.recorders = []
+        self.finished = _Recorder(bounds)
+
+        # Functions that return {name: (type, help, value)} for metrics
+        # kept elsewhere, e.g. the fragment cache's stats
+        self.collectors = []
+
+    # This thread's recorder.  A server may start a thread for every
+    # request, so the recorders of threads that have finished are
+    # folded into one whenever a new thread starts recording.
+    def _recorder(self):
+        recorder = getattr(self.local, 'recorder', None)
+
+        if recorder is None:
+            recorder = self.local.recorder = _Recorder(self.bounds)
+
+            with self.lock:
+                running = []
+
+                for thread, other in self.recorders:
+                    if thread.is_alive():
+                        running.append((thread, other))
+                    else:
+                        self.finished.add(other)
+
+                running.append((threading.current_thread(), recorder))
+                self.recorders = running
+
+        return recorder
+
+    # Count a request and record how long it took
+    def observeRequest(self, route, method, status, seconds):
+        recorder = self._recorder()
+        key = (route, method, status)
+
+        recorder.requests[key] = recorder.requests.get(key, 0) + 1
+        recorder.histogram((REQUEST, (route, method))).observe(seconds)
+
+    # Wrap a function so that every call records its latency under this
+    # name, in the STORE or SERIALIZER histograms.  A call that returns
+    # a generator (e.g. iterUsers) isn't over until the generator is, so
+    # its latency is the time spent in the call plus the time spent in
+    # the generator, recorded once it's exhausted or closed.
+    def timed(self, kind, name, function):
+        key = (kind, name)
+        bounds = self.bounds
+        local = self.local
+        clock = time.perf_counter
+
+        def record(elapsed):
+            # _recorder, histogram and Histogram.observe, inlined,
+            # since this is on every call
+            recorder = getattr(local, 'recorder', None) or self._recorder()
+            histogram = recorder.histograms.get(key) or recorder.histogram(key)
+            histogram.counts[bisect_left(bounds, elapsed)] += 1
+            histogram.sum += elapsed
+
+        def timedGenerator(generator, elapsed):
+            try:
+                while True:
+                    start = clock()
+
+                    try:
+                        item = next(generator)
+                    except StopIteration:
+                        return
+                    finally:
+                        elapsed += clock() - start
+
+                    yield item
+            finally:
+                generator.close()
+                record(elapsed)
+
+        def timedFunction(*args, **kwargs):
+            start = clock()
+            result = None
+
+            try:
+                result = function(*args, **kwargs)
+                return result if result.__class__ is not types.GeneratorType else \
+                    timedGenerator(result, clock() - start)
+            finally:
+                if result.__class__ is not types.GeneratorType:
+                    record(clock() - start)
+
+        timedFunction.__name__ = function.__name__
+        timedFunction.__wrapped__ = function
+        return timedFunction
+
+    # Wrap a Flask app's WSGI callable so that every request is counted
+    # and timed, from before it's routed to when the last of its
+    # response has been sent, so that a streamed body is timed in full.
+    # Requests are labelled with their route's rule rather than their
+    # path, so that there's one series per route and not one per user;
+    # anything that matched no route is "unmatched".  Working below
+    # Flask keeps this to plain dict lookups, where before_request and
+    # after_request hooks would go through its context-local proxies.
+    def wsgiMiddleware(self, wsgi_app):
+        bounds = self.bounds
+        local = self.local
+        clock = time.perf_counter
+
+        def middleware(environ, start_response):
+            start = clock()
+            started = []
+
+            # Flask drops the request from the environment once it's done
+            # with it, so pick up the route it matched while it's starting
+            # the response
+            def startResponse(status, headers, exc_info = None):
+                started.append((status, getattr(environ.get('werkzeug.request'), 'url_rule', None)))
+                return start_response(status, headers, exc_info)
+
+            def record():
+                elapsed = clock() - start
+
+                if started:
+                    status, rule = started[0]
+                    route = rule.rule if rule is not None else 'unmatched'
+                    method = environ['REQUEST_METHOD']
+                    key = (route, method, int(status[:3]))
+
+                    # observeRequest, inlined
+                    recorder = getattr(local, 'recorder', None) or self._recorder()
+                    recorder.requests[key] = recorder.requests.get(key, 0) + 1
+                    histogram = recorder.histogram((REQUEST, (route, method)))
+                    histogram.counts[bisect_left(bounds, elapsed)] += 1
+                    histogram.sum += elapsed
+
+            return _ClosingBody(wsgi_app(environ, startResponse), record)
+
+        return middleware
+
+    def addCollector(self, collector):
+        self.collectors.append(collector)
+
+    # Everything every thread has recorded, in one recorder
+    def total(self):
+        total = _Recorder(self.bounds)
+
+        with self.lock:
+            total.add(self.finished)
+
+            for thread, recorder in self.recorders:
+                total.add(recorder)
+
+        return total
+
+    # Everything, in the text exposition format
+    def render(self):
+        total = self.total()
+        histograms = dict((kind, []) for kind in (REQUEST, STORE, SERIALIZER))
+
+        for (kind, key), histogram in sorted(total.histograms.items()):
+            histograms[kind].append((key, histogram))
+
+        lines = [
+            '# HELP http_requests_total Requests handled, by route, method and status.',
+            '# TYPE http_requests_total counter'
+        ]
+
+        for (route, method, status), count in sorted(total.requests.items()):
+            lines.append('http_requests_total{} {}'.format(
+                _labels([('route', route), ('method', method), ('status', str(status))]), count))
+
+        _histogramLines(lines, 'http_request_duration_seconds', 'Time spent handling requests, by route and method.',
+                        [([('route', route), ('method', method)], histogram)
+                         for (route, method), histogram in histograms[REQUEST]])
+        _histogramLines(lines, 'store_operation_duration_seconds', 'Time spent in database calls, by function.',
+                        [([('operation', name)], histogram) for name, histogram in histograms[STORE]])
+        _histogramLines(lines, 'serializer_duration_seconds',
+                        'Time spent rendering the records of a response, by serializer.',
+                        [([('serializer', name)], histogram) for name, histogram in histograms[SERIALIZER]])
+
+        for collector in self.collectors:
+            for name, (kind, help, value) in sorted(collector().items()):
+                lines.append('# HELP {} {}'.format(name, help))
+                lines.append('# TYPE {} {}'.format(name, kind))
+                lines.append('{} {}'.format(name, value))
+
+        return '\n'.join(lines) + '\n'
+
+# A WSGI response body that calls `finished` once, when the last of it
+# has been handed to the server or the server closes it, whichever
+# comes first
+class _ClosingBody:
+    def __init__(self, body, finished):
+        self.body = body
+        self.finished = finished
+
+    def __iter__(self):
+        for chunk in self.body:
+            yield chunk
+
+        self._finish()
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self._finish()
+
+    def _finish(self):
+        finished, self.finished = self.finished, None
+
+        if finished is not None:
+            finished()
+
+# The database module with every public function wrapped by
+# Metrics.timed, and everything else (its classes, exceptions and
+# `backend`) passed through untouched
+class TimedStore:
+    def __init__(self, store, metrics):
+        self._store = store
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        value = getattr(self._store, name)
+
+        if name.startswith('_') or not isinstance(value, types.FunctionType):
+            return value
+
+        # Keep the wrapper, so that this is only called once per function
+        timed = self._metrics.timed(STORE, name, value)
+        setattr(self, name, timed)
+        return timed
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(pairs):
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+def _histogramLines(lines, name, help, histograms):
+    lines.append('# HELP {} {}'.format(name, help))
+    lines.append('# TYPE {} histogram'.format(name))
+
+    for labels, histogram in histograms:
+        for bound, count in histogram.buckets():
+            lines.append('{}_bucket{} {}'.format(name, _labels(labels + [('le', str(bound))]), count))
+
+        lines.append('{}_sum{} {}'.format(name, _labels(labels), repr(histogram.sum)))
+        lines.append('{}_count{} {}'.format(name, _labels(labels), histogram.count()))
@@ -0,0 +1,178 @@
+from collections import Counter
+import cProfile
+import hmac
+import itertools
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+# Profiling of individual requests, on demand.
+#
+# profilingMiddleware wraps a WSGI app so that a request is profiled
+# when it carries an X-Profile header with the right token, or at
+# random, for a given fraction of requests.  A profiled request runs
+# under cProfile, which sees every call the resource method makes into
+# the database and the serializers, while a thread samples its stack
+# every millisecond.  For streamed responses both keep going while the
+# response is sent.  Each profile is written to the profile directory
+# as NAME.prof, cProfile's stats for pstats or snakeviz, and
+# NAME.collapsed, the sampled stacks in the collapsed format that
+# flamegraph.pl and speedscope read, and the response carries NAME in
+# an X-Profile-Id header.
+#
+# The middleware is only installed when there's a profile directory,
+# so without one requests don't go through any of this.
+
+SAMPLE_INTERVAL = 0.001
+
+# Samples one thread's stack every interval, counting each distinct
+# stack, outermost frame first
+class StackSampler:
+    def __init__(self, thread_id, interval = SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _sample(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+
+            if frame is not None:
+                self.stacks[_stack(frame)] += 1
+
+    # "outer;...;inner count" lines
+    def collapsed(self):
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in sorted(self.stacks.items()))
+
+class _Profile:
+    def __init__(self, directory, name, interval):
+        self.directory = directory
+        self.name = name
+        self.profiler = cProfile.Profile()
+        self.sampler = StackSampler(threading.get_ident(), interval)
+
+    def start(self):
+        self.sampler.start()
+        self.profiler.enable()
+
+    def resume(self):
+        self.profiler.enable()
+
+    def pause(self):
+        self.profiler.disable()
+
+    # Stop profiling and write the profile out.  A profile that can't
+    # be written is reported but doesn't fail the request.
+    def finish(self):
+        self.profiler.disable()
+        self.sampler.stop()
+        path = os.path.join(self.directory, self.name)
+
+        try:
+            self.profiler.dump_stats(path + '.prof')
+
+            with open(path + '.collapsed', 'w') as collapsed:
+                collapsed.write(self.sampler.collapsed())
+        except OSError as e:
+            print( str(e) )
+
+# A streamed response's chunks, each produced with the profiler running,
+# and the profile finished when the server closes the response
+class _ProfiledResponse:
+    def __init__(self, response, profile):
+        self.response = response
+        self.chunks = iter(response)
+        self.profile = profile
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self.profile.resume()
+
+        try:
+            return next(self.chunks)
+        finally:
+            self.profile.pause()
+
+    def close(self):
+        try:
+            if hasattr(self.response, 'close'):
+                self.response.close()
+        finally:
+            self.profile.finish()
+
+# Wrap a WSGI app so that requests with an X-Profile header matching
+# token, and a sample_rate fraction of all the others, are profiled
+# into directory.  With no token, the header is ignored.
+def profilingMiddleware(wsgi_app, directory, token = None, sample_rate = 0.0, interval = SAMPLE_INTERVAL):
+    os.makedirs(directory, exist_ok=True)
+    sequence = itertools.count()
+    expected = token.encode('utf-8') if token is not None else None
+
+    # WSGI header values are latin-1 strings, and compare_digest only
+    # takes ASCII ones, so compare the bytes
+    def profiled(environ):
+        if expected is not None and hmac.compare_digest(environ.get('HTTP_X_PROFILE', '').encode('latin-1'), expected):
+            return True
+
+        return sample_rate > 0 and random.random() < sample_rate
+
+    def middleware(environ, start_response):
+        if not profiled(environ):
+            return wsgi_app(environ, start_response)
+
+        number = next(sequence)
+        profile = _Profile(directory, _profileName(environ['REQUEST_METHOD'], environ.get('PATH_INFO', ''), number),
+                           interval)
+
+        # Renamed for the route Flask matched, if it matched one, once
+        # it's starting the response and knows which
+        def startResponse(status, headers, exc_info = None):
+            rule = getattr(environ.get('werkzeug.request'), 'url_rule', None)
+
+            if rule is not None:
+                profile.name = _profileName(environ['REQUEST_METHOD'], rule.rule, number)
+
+            return start_response(status, list(headers) + [('X-Profile-Id', profile.name)], exc_info)
+
+        profile.start()
+
+        try:
+            response = wsgi_app(environ, startResponse)
+        except BaseException:
+            profile.finish()
+            raise
+
+        profile.pause()
+        return _ProfiledResponse(response, profile)
+
+    return middleware
+
+# e.g. 20240102T030405-1234-7-GET-users_userid
+def _profileName(method, route, number):
+    return '{}-{}-{}-{}-{}'.format(time.strftime('%Y%m%dT%H%M%S'), os.getpid(), number, method,
+                                   re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_')[:60] or 'root')
+
+# A frame's stack as "function (file:line)" entries, outermost first
+def _stack(frame):
+    entries = []
+
+    while frame is not None:
+        code = frame.f_code
+        entries.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+
+    return ';'.join(reversed(entries))
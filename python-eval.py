@@ -1,11 +1,34 @@
-from flask import Flask, jsonify
-from flask_restful import Resource, Api, fields, marshal, reqparse, abort
-import database.fake_db as db
-import ast
+from flask import Flask, Response, jsonify, request
+from flask_restful import Resource, Api, fields, abort
+import database.fake_db as fake_db
+from metrics import CONTENT_TYPE, SERIALIZER, Metrics, TimedStore
+from profiling import profilingMiddleware
+from recording import recordingMiddleware
+from serializers import serializer
+from validation import Argument, INTEGER, STRING_LIST, parser
+import base64
+import csv
+import io
+import json
+import os
+import threading
+from collections import OrderedDict
 
 app = Flask(__name__)
 api = Api(app)
 
+# Request counts and latencies, and the time spent in the database and
+# the serializers, all served at /metrics.  Set the METRICS environment
+# variable to 0 to leave the timers out; /metrics then only has the
+# fragment cache's counts.
+metrics = Metrics()
+instrumented = os.environ.get('METRICS', '1') != '0'
+db = TimedStore(fake_db, metrics) if instrumented else fake_db
+
+# Always render compact JSON, even in debug mode, so that cached JSON
+# fragments can be spliced into responses verbatim.
+app.config['RESTFUL_JSON'] = {'indent': None, 'sort_keys': False}
+
 link_fields = {
     'rel': fields.String,
     'href': fields.String
@@ -21,6 +44,11 @@ user_list_fields = {
     'userids': fields.List(fields.String)
 }
 
+membership_delta_fields = {
+    'add': fields.List(fields.String),
+    'remove': fields.List(fields.String)
+}
+
 group_field = {
     'name': fields.String
 }
@@ -29,9 +57,293 @@ user_fields = {
     'userid': fields.String,
     'first_name': fields.String,
     'last_name': fields.String,
-    'groups': fields.Nested(group_field)
+    # user.groups is a GroupSet rather than a list, so hand marshal
+    # a list of its groups to get them rendered as a nested list.
+    'groups': fields.Nested(group_field, attribute=lambda user: list(user.groups))
 }
 
+# Build the serializers for the field specs above.  By default each spec
+# is compiled once into a function that renders records directly instead
+# of walking the spec through marshal() for every object; set the
+# COMPILED_SERIALIZERS environment variable to 0 to go through marshal().
+def useSerializers(compiled):
+    global serialize_greeting, serialize_user_list, serialize_membership_delta, serialize_group, serialize_user
+
+    serialize_greeting = timedSerializer('greeting', serializer(greeting_fields, from_mapping=True, compiled=compiled))
+    serialize_user_list = timedSerializer('user_list', serializer(user_list_fields, from_mapping=True, compiled=compiled))
+    serialize_membership_delta = timedSerializer('membership_delta',
+                                                 serializer(membership_delta_fields, from_mapping=True, compiled=compiled))
+    serialize_group = serializer(group_field, compiled=compiled)
+    serialize_user = serializer(user_fields, compiled=compiled)
+
+# Time a serializer, or a function rendering a whole response's worth
+# of records with one, under the serializer's name.  Users and groups
+# go many to a response, so they're timed by renderUsers and
+# renderGroups below rather than per record.
+def timedSerializer(name, serialize):
+    return metrics.timed(SERIALIZER, name, serialize) if instrumented else serialize
+
+useSerializers(os.environ.get('COMPILED_SERIALIZERS', '1') != '0')
+
+
+# Paging cursors are the store's page keys, JSON encoded and then
+# base64'd so that clients treat them as opaque tokens.
+def encodeCursor(key):
+    if key is None:
+        return None
+
+    return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii')
+
+# Turn a cursor back into a page key.  Raises a ValueError for garbage.
+def decodeCursor(cursor):
+    if cursor is None:
+        return None
+
+    key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    return tuple(key) if isinstance(key, list) else key
+
+# Return a JSON response whose body has already been rendered.  Matches
+# what flask_restful would send for the equivalent dict.  With a
+# version tag from the database, the response carries it as its ETag.
+def jsonResponse(body, status=200, version=None):
+    response = Response(body + '\n', status=status, mimetype='application/json')
+
+    if version is not None:
+        response.set_etag(version)
+
+    return response
+
+# A 304 if the client already has the representation with this
+# version tag (going by its If-None-Match header), otherwise None.
+# Read the tag before the data it covers; see fake_db.tableVersion.
+# Only the tags themselves count, not "*", which would match the tag
+# of a user or group that doesn't exist and turn its 404 into a 304.
+def notModified(version):
+    tags = request.if_none_match
+
+    if version is None or not (tags.is_strong(version) or tags.is_weak(version)):
+        return None
+
+    response = Response(status=304)
+    response.set_etag(version)
+    return response
+
+
+# A bounded LRU cache of rendered JSON fragments, keyed by ("user", userid)
+# or ("group", group_name).  The database tells the cache whenever a user
+# or group changes and the matching entry is dropped.  Every invalidation
+# also bumps a generation counter; a fragment rendered on a miss is only
+# stored if no invalidation happened while it was being rendered, so a
+# racing write can't leave a stale fragment behind.
+class FragmentCache:
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Return the cached fragment for this key, or call render() to make
+    # it.  generation is the cache's generation from before the object
+    # being rendered was read from the database; if anything has been
+    # invalidated since, the object may be stale and a miss isn't
+    # cached.  With no generation a miss is rendered but not cached,
+    # which keeps one-off bulk reads from flushing out the hot entries.
+    def fragment(self, key, render, generation=None):
+        with self.lock:
+            fragment = self.entries.get(key)
+
+            if fragment is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return fragment
+
+            self.misses += 1
+
+        fragment = render()
+
+        if generation is not None:
+            with self.lock:
+                if generation == self.generation:
+                    self.entries[key] = fragment
+
+                    if len(self.entries) > self.max_size:
+                        self.entries.popitem(last=False)
+                        self.evictions += 1
+
+        return fragment
+
+    def invalidate(self, kind, key):
+        with self.lock:
+            self.entries.pop((kind, key), None)
+            self.generation += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+# Other processes can change a shared database behind this one's back
+# without the change listeners hearing about it, so only the in-memory
+# database gets a cache.  Without one (or with FRAGMENT_CACHE_SIZE=0)
+# fragment_cache is None and every fragment is rendered as it's needed.
+fragment_cache_size = int(os.environ.get('FRAGMENT_CACHE_SIZE', 100000)) if db.backend == 'memory' else 0
+fragment_cache = FragmentCache(fragment_cache_size) if fragment_cache_size > 0 else None
+
+def fragmentCacheMetrics():
+    stats = fragment_cache.stats()
+
+    return {
+        'fragment_cache_hits_total': ('counter', 'Fragment cache lookups that found the fragment.', stats['hits']),
+        'fragment_cache_misses_total': ('counter', 'Fragment cache lookups that had to render it.', stats['misses']),
+        'fragment_cache_evictions_total': ('counter', 'Fragments dropped to make room.', stats['evictions']),
+        'fragment_cache_size': ('gauge', 'Fragments in the cache.', stats['size']),
+        'fragment_cache_max_size': ('gauge', 'Most fragments the cache holds.', stats['max_size'])
+    }
+
+if fragment_cache is not None:
+    db.addChangeListener(fragment_cache.invalidate)
+    metrics.addCollector(fragmentCacheMetrics)
+
+if instrumented:
+    app.wsgi_app = metrics.wsgiMiddleware(app.wsgi_app)
+
+# Profile requests on demand into PROFILE_DIR: those with an X-Profile
+# header matching PROFILE_TOKEN and a PROFILE_SAMPLE_RATE fraction of
+# the rest.  Without PROFILE_DIR requests aren't touched at all.
+if os.environ.get('PROFILE_DIR'):
+    app.wsgi_app = profilingMiddleware(app.wsgi_app, os.environ['PROFILE_DIR'], os.environ.get('PROFILE_TOKEN'),
+                                       float(os.environ.get('PROFILE_SAMPLE_RATE', 0)))
+
+# Append every request to RECORD_REQUESTS, a line of JSON each, for
+# bench/loadtest.py to replay
+if os.environ.get('RECORD_REQUESTS'):
+    app.wsgi_app = recordingMiddleware(app.wsgi_app, os.environ['RECORD_REQUESTS'])
+
+# Take cacheGeneration() before reading the user or group from the
+# database and pass it in, so a fragment rendered from an object that
+# changed in between isn't cached
+def cacheGeneration():
+    return fragment_cache.generation if fragment_cache is not None else None
+
+def cachedFragment(key, render, generation):
+    return fragment_cache.fragment(key, render, generation) if fragment_cache is not None else render()
+
+def userFragment(user, generation=None):
+    return cachedFragment(('user', user.userid), lambda: json.dumps(serialize_user(user)), generation)
+
+# Render users (as their fragments, cached or not) and groups, timed
+# once per response or export batch
+renderUsers = timedSerializer('user', lambda users, generation=None: [userFragment(user, generation) for user in users])
+renderUser = timedSerializer('user', lambda user: serialize_user(user))
+renderGroups = timedSerializer('group', lambda groups: [serialize_group(group) for group in groups])
+renderGroup = timedSerializer('group', lambda group: serialize_group(group))
+
+def groupMembersFragment(group, generation):
+    return cachedFragment(
+        ('group', group.name),
+        lambda: json.dumps(serialize_user_list({'userids': db.getUserIdsForGroup(group)})),
+        generation
+    )
+
+# The items of a bulk request: a JSON array, or for an
+# application/x-ndjson body, one JSON document per (non-blank) line.
+# Returns the items along with (index, message) errors for the lines
+# that aren't JSON, whose items are None.
+def bulkItems():
+    if request.mimetype == 'application/x-ndjson':
+        items = []
+        errors = []
+
+        for line in request.stream:
+            if not line.strip():
+                continue
+
+            try:
+                items.append(json.loads(line.decode('utf-8')))
+            except ValueError as ve:
+                errors.append((len(items), str(ve)))
+                items.append(None)
+
+        return items, errors
+
+    items = request.get_json(silent=True)
+
+    if not isinstance(items, list):
+        abort(400, message='Expected a JSON array or an NDJSON body')
+
+    return items, []
+
+# Fail a bulk request, listing what was wrong with which items
+def abortBulk(status, errors):
+    abort(status, errors=[{'index': index, 'error': message} for index, message in sorted(errors)])
+
+def isString(value):
+    return isinstance(value, str)
+
+# Request arguments, checked by parsers built once, here, rather than
+# by a RequestParser built for every request
+paging_arguments = [
+    Argument('limit', type=INTEGER),
+    Argument('cursor')
+]
+
+parse_users_query = parser(paging_arguments + [
+    Argument('group'),
+    Argument('last_name_prefix')
+], 'args')
+
+parse_groups_query = parser(paging_arguments, 'args')
+
+parse_group_query = parser(paging_arguments + [
+    Argument('q', required=True, help='No group query provided'),
+    Argument('result', default='userids', choices=('userids', 'count'))
+], 'args')
+
+parse_export_query = parser([
+    Argument('format', default='ndjson', choices=('ndjson', 'csv'))
+], 'args')
+
+parse_new_user = parser([
+    Argument('userid', required=True, help='No userid provided'),
+    Argument('first_name', required=True, help='No first name provided'),
+    Argument('last_name', required=True, help='No last name provided'),
+    Argument('groups', type=STRING_LIST, required=True, help='No groups defined')
+], 'json')
+
+parse_user = parser([
+    Argument('first_name', required=True, help='No first name provided'),
+    Argument('last_name', required=True, help='No last name provided'),
+    Argument('groups', type=STRING_LIST, required=True, help='No groups defined')
+], 'json')
+
+parse_new_group = parser([
+    Argument('name', required=True, help='No group name provided')
+], 'json')
+
+parse_members = parser([
+    Argument('userids', type=STRING_LIST, required=True, help='No member list provided')
+], 'json')
+
+parse_changes_query = parser([
+    Argument('since'),
+    Argument('wait', type=INTEGER, default=0)
+], 'args')
+
+parse_membership_delta = parser([
+    Argument('add', type=STRING_LIST, default=()),
+    Argument('remove', type=STRING_LIST, default=())
+], 'json')
+
 
 class RootEndpoint(Resource):
 
@@ -54,30 +366,58 @@ class RootEndpoint(Resource):
             "groups": group_link
         }
 
-        return marshal(greeting, greeting_fields), 200
+        return serialize_greeting(greeting), 200
 
 
 class UsersEndpoint(Resource):
 
-    def __init__(self):
-        self.reqparse = reqparse.RequestParser()
-        self.reqparse.add_argument('userid', type=str, required=True, help='No userid provided', location='json')
-        self.reqparse.add_argument('first_name', type=str, required=True, help='No first name provided', location='json')
-        self.reqparse.add_argument('last_name', type=str, required=True, help='No last name provided', location='json')
-        self.reqparse.add_argument('groups', type=str, required=True, help='No groups defined', location='json')
-        super(UsersEndpoint, self).__init__()
-
-    # Return all users
+    # Return users, optionally a page at a time and optionally only
+    # those in a particular group and/or with a particular last name
+    # prefix.  next_cursor is null once there are no more pages.
     def get(self):
-        return {'users': [marshal(user, user_fields) for user in db.allUsers()]}
+        args = parse_users_query()
+
+        if args['limit'] is not None and args['limit'] < 1:
+            abort(400)
+
+        version = db.tableVersion()
+        not_modified = notModified(version)
+
+        if not_modified is not None:
+            return not_modified
+
+        try:
+            generation = cacheGeneration()
+            group = db.getGroupByName(args['group']) if args['group'] is not None else None
+
+            users, next_key = db.pageUsers(
+                args['limit'],
+                decodeCursor(args['cursor']),
+                group,
+                args['last_name_prefix']
+            )
+
+            return jsonResponse('{{"users": [{}], "next_cursor": {}}}'.format(
+                ', '.join(renderUsers(users, generation)),
+                json.dumps(encodeCursor(next_key))
+            ), version=version)
+
+        # Filtering on a group that doesn't exist
+        except LookupError as le:
+            print( str(le) )
+            abort(400)
+
+        # The cursor is garbage or belongs to a differently ordered listing
+        except ValueError as ve:
+            print( str(ve) )
+            abort(400)
 
     # Create a new user
     def post(self):
-        args = self.reqparse.parse_args()
+        args = parse_new_user()
 
         try:
-            group_names = ast.literal_eval(args['groups'])
-            groups = [db.getGroupByName(group_name) for group_name in group_names]
+            groups = [db.getGroupByName(group_name) for group_name in args['groups']]
 
             user = db.User(
                 args["userid"],
@@ -87,7 +427,7 @@ class UsersEndpoint(Resource):
             )
 
             db.addUser(user)
-            return {'user': marshal(user, user_fields)}, 201
+            return {'user': renderUser(user)}, 201
 
         # User already exists with this userid
         except ValueError as ve:
@@ -100,21 +440,120 @@ class UsersEndpoint(Resource):
             abort(400)
 
 
-class UserEndpoint(Resource):
+class UsersBulkEndpoint(Resource):
+
+    # Create a batch of users, all or nothing.  Each item is a user
+    # record like the ones POST /users/ takes, except that groups is a
+    # JSON list of group names.  Every item is checked in one pass, with
+    # the group names looked up in a single listing of the groups; if
+    # any item is malformed or names a group that doesn't exist the
+    # response is a 400, and if any userid is taken, a 409, listing
+    # the index of each bad item and what's wrong with it.
+    def post(self):
+        items, errors = bulkItems()
+        groups = dict((group.name, group) for group in db.allGroups())
+        users = []
 
-    def __init__(self):
-        self.reqparse = reqparse.RequestParser()
-        self.reqparse.add_argument('first_name', type=str, required=True, help='No first name provided', location='json')
-        self.reqparse.add_argument('last_name', type=str, required=True, help='No last name provided', location='json')
-        self.reqparse.add_argument('groups', type=str, required=True, help='No groups defined', location='json')
-        super(UserEndpoint, self).__init__()
+        for index, item in enumerate(items):
+            if item is None:
+                continue
+
+            if not isinstance(item, dict) or not all(isString(item.get(field)) for field in ['userid', 'first_name', 'last_name']):
+                errors.append((index, 'Expected an object with userid, first_name and last_name strings'))
+                continue
+
+            group_names = item.get('groups')
+
+            if not isinstance(group_names, list) or not all(isString(group_name) for group_name in group_names):
+                errors.append((index, 'Expected groups to be a list of group names'))
+                continue
+
+            unknown = [group_name for group_name in group_names if group_name not in groups]
+
+            if unknown:
+                errors.append((index, "group '{}' does not exist".format(unknown[0])))
+                continue
+
+            users.append(db.User(item['userid'], item['first_name'], item['last_name'],
+                                 [groups[group_name] for group_name in group_names]))
+
+        if errors:
+            abortBulk(400, errors)
+
+        try:
+            db.addUsers(users)
+            return {'created': len(users)}, 201
+
+        # Userids that are taken, or groups removed since they were checked
+        except db.BatchError as be:
+            print( str(be) )
+            abortBulk(409, be.errors)
+
+
+class UsersExportEndpoint(Resource):
+
+    content_types = {
+        'ndjson': 'application/x-ndjson',
+        'csv': 'text/csv'
+    }
+
+    # Stream every user as NDJSON (one user record per line) or CSV.
+    # Users are pulled from the database a batch at a time and each
+    # batch is sent as its own chunk, so memory use stays flat no
+    # matter how many users there are.
+    def get(self):
+        args = parse_export_query()
+
+        if args['format'] == 'csv':
+            chunks = self.csvChunks()
+        else:
+            chunks = self.ndjsonChunks()
+
+        return Response(chunks, mimetype=self.content_types[args['format']])
+
+    def ndjsonChunks(self):
+        for batch in db.iterUserBatches(500):
+            yield ''.join(fragment + '\n' for fragment in renderUsers(batch))
+
+    # Groups are written as a single space separated column
+    def csvChunks(self):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+
+        writer.writerow(['userid', 'first_name', 'last_name', 'groups'])
+
+        for batch in db.iterUserBatches(500):
+            for user in batch:
+                writer.writerow([
+                    user.userid,
+                    user.first_name,
+                    user.last_name,
+                    ' '.join(group.name for group in user.groups)
+                ])
+
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+        # Header only, for an empty directory
+        if buffer.tell():
+            yield buffer.getvalue()
+
+
+class UserEndpoint(Resource):
 
     # Return a particular user
     def get(self, userid):
+        version = db.userVersion(userid)
+        not_modified = notModified(version)
+
+        if not_modified is not None:
+            return not_modified
 
         try:
+            generation = cacheGeneration()
             user = db.getUserByUserid(userid)
-            return {'user': marshal(user, user_fields)}
+            return jsonResponse('{{"user": {}}}'.format(renderUsers([user], generation)[0]), version=version)
 
         # Can't find a user with this userid
         except LookupError as le:
@@ -123,13 +562,12 @@ class UserEndpoint(Resource):
 
     # Update a particular user
     def put(self, userid):
-        args = self.reqparse.parse_args()
+        args = parse_user()
 
         groups = []
 
         try:
-            group_names = ast.literal_eval(args['groups'])
-            groups = [db.getGroupByName(group_name) for group_name in group_names]
+            groups = [db.getGroupByName(group_name) for group_name in args['groups']]
 
         # One of the groups is invalid.
         except LookupError as le:
@@ -145,7 +583,7 @@ class UserEndpoint(Resource):
             )
 
             db.updateUser(new_user)
-            return {'user': marshal(new_user, user_fields)}, 200
+            return {'user': renderUser(new_user)}, 200
 
         # Can't find a user for this userid
         except LookupError as le:
@@ -167,23 +605,34 @@ class UserEndpoint(Resource):
 
 class GroupsEndpoint(Resource):
 
-    def __init__(self):
-        self.reqparse = reqparse.RequestParser()
-        self.reqparse.add_argument('name', type=str, required=True, help='No group name provided', location='json')
-        super(GroupsEndpoint, self).__init__()
-
-    # Return a list of all groups
+    # Return a list of groups, optionally a page at a time
     def get(self):
-        return {'groups': [marshal(group, group_field) for group in db.allGroups()]}
+        args = parse_groups_query()
+
+        if args['limit'] is not None and args['limit'] < 1:
+            abort(400)
+
+        try:
+            groups, next_key = db.pageGroups(args['limit'], decodeCursor(args['cursor']))
+
+            return {
+                'groups': renderGroups(groups),
+                'next_cursor': encodeCursor(next_key)
+            }
+
+        # The cursor is garbage
+        except ValueError as ve:
+            print( str(ve) )
+            abort(400)
 
     # Create a new, empty group
     def post(self):
-        args = self.reqparse.parse_args()
+        args = parse_new_group()
 
         try:
             new_group = db.Group(args['name'])
             db.addGroup(new_group)
-            return marshal(new_group, group_field)
+            return renderGroup(new_group)
 
         # This group already exists
         except ValueError as ve:
@@ -191,18 +640,81 @@ class GroupsEndpoint(Resource):
             abort(409)
 
 
-class GroupEndpoint(Resource):
+class GroupsBulkEndpoint(Resource):
+
+    # Create a batch of new, empty groups, all or nothing.  Each item is
+    # a group like the ones POST /groups/ takes.  Malformed items get a
+    # 400 and names that are taken a 409, listing the bad items.
+    def post(self):
+        items, errors = bulkItems()
+        groups = []
+
+        for index, item in enumerate(items):
+            if item is None:
+                continue
+
+            if not isinstance(item, dict) or not isString(item.get('name')):
+                errors.append((index, 'Expected an object with a name string'))
+                continue
+
+            groups.append(db.Group(item['name']))
+
+        if errors:
+            abortBulk(400, errors)
+
+        try:
+            db.addGroups(groups)
+            return {'created': len(groups)}, 201
+
+        # These groups already exist
+        except db.BatchError as be:
+            print( str(be) )
+            abortBulk(409, be.errors)
+
+
+class GroupQueryEndpoint(Resource):
+
+    # Return the users matching a boolean expression over group names,
+    # e.g. ?q=admins AND execs AND NOT pirates: a page of their userids,
+    # or with result=count just how many there are
+    def get(self):
+        args = parse_group_query()
+
+        if args['limit'] is not None and args['limit'] < 1:
+            abort(400)
+
+        try:
+            if args['result'] == 'count':
+                return {'count': db.countGroupQuery(args['q'])}
+
+            userids, next_key = db.pageGroupQuery(args['q'], args['limit'], decodeCursor(args['cursor']))
 
-    def __init__(self):
-        self.reqparse = reqparse.RequestParser()
-        self.reqparse.add_argument('userids', type=str, required=True, help='No member list provided', location='json')
-        super(GroupEndpoint, self).__init__()
+            return {
+                'userids': userids,
+                'next_cursor': encodeCursor(next_key)
+            }
+
+        # The query doesn't parse, names a group that doesn't exist,
+        # or the cursor is garbage
+        except (LookupError, ValueError) as e:
+            print( str(e) )
+            abort(400)
+
+
+class GroupEndpoint(Resource):
 
     # Return a list containing userids of all users in a particular group
     def get(self, groupname):
+        version = db.groupVersion(groupname)
+        not_modified = notModified(version)
+
+        if not_modified is not None:
+            return not_modified
+
         try:
+            generation = cacheGeneration()
             group = db.getGroupByName(groupname)
-            return marshal({'userids': db.getUserIdsForGroup(group)}, user_list_fields)
+            return jsonResponse(groupMembersFragment(group, generation), version=version)
 
         # Group dosn't exist.
         except LookupError as le:
@@ -213,14 +725,14 @@ class GroupEndpoint(Resource):
     # user id's.  This method will add this group to each user's group list
     # and remove this group for any user not on the list.
     def put(self, groupname):
-        args = self.reqparse.parse_args()
+        args = parse_members()
 
         try:
             group = db.getGroupByName(groupname)
-            userids = ast.literal_eval(args['userids'])
+            userids = args['userids']
             db.updateGroupMembership(group, userids)
 
-            return marshal({'userids': userids}, user_list_fields), 200
+            return serialize_user_list({'userids': userids}), 200
 
         # Group doesn't exist or one of the
         # userids doesn't match an existing user.
@@ -228,6 +740,31 @@ class GroupEndpoint(Resource):
             print( str(le) )
             abort(404)
 
+    # Update group membership incrementally.  The request body holds
+    # a list of userids to add to this group and/or a list of userids
+    # to remove from it.  Members not mentioned are left alone.
+    def patch(self, groupname):
+        args = parse_membership_delta()
+
+        try:
+            group = db.getGroupByName(groupname)
+            add_userids = args['add']
+            remove_userids = args['remove']
+            db.changeGroupMembership(group, add_userids, remove_userids)
+
+            return serialize_membership_delta({'add': add_userids, 'remove': remove_userids}), 200
+
+        # Group doesn't exist or one of the
+        # userids doesn't match an existing user.
+        except LookupError as le:
+            print( str(le) )
+            abort(404)
+
+        # The same userid is on both lists
+        except ValueError as ve:
+            print( str(ve) )
+            abort(400)
+
     # Delete a group.  This will remove the group from the group list
     # as well as remove the group from each user's group list.
     def delete(self, groupname):
@@ -242,11 +779,120 @@ class GroupEndpoint(Resource):
             abort(404)
 
 
+class StatsEndpoint(Resource):
+
+    # Return how many users there are, how many members each group has
+    # and how many users are in each number of groups.  The database
+    # keeps these counts up to date as it goes, so nothing is scanned.
+    def get(self):
+        version = db.tableVersion()
+        not_modified = notModified(version)
+
+        if not_modified is not None:
+            return not_modified
+
+        stats = db.groupStats()
+
+        return jsonResponse(json.dumps(OrderedDict([
+            ('users', stats['users']),
+            ('groups', OrderedDict(stats['members'])),
+            ('groups_per_user', OrderedDict((str(count), users) for count, users in stats['groups_per_user']))
+        ])), version=version)
+
+
+class ChangesEndpoint(Resource):
+
+    # The longest a long poll waits, and how often a quiet event
+    # stream sends a comment to keep the connection open
+    MAX_WAIT = 60
+    KEEPALIVE = 15
+
+    # Return what has changed since the `since` version: a list of
+    # {"version", "kind", "key"} changes, where kind is "user" or "group"
+    # and key is the userid or group name, and the version to pass as
+    # `since` next time.  Without `since` there are no changes, just
+    # the version to start from.  With `wait`, wait up to that many
+    # seconds for something to change first.  Clients that accept
+    # text/event-stream get a Server-Sent Events stream instead, which
+    # picks up from the Last-Event-ID header when they reconnect.
+    #
+    # Only so many changes are kept, so if some of those asked for are
+    # gone, the response is a 410 with resync set: fetch everything
+    # again and carry on from the version it gives.
+    def get(self):
+        args = parse_changes_query()
+
+        if args['wait'] < 0:
+            abort(400)
+
+        since = args['since'] if args['since'] is not None else request.headers.get('Last-Event-ID')
+        stream = request.accept_mimetypes.best == 'text/event-stream'
+
+        try:
+            if since is None:
+                changes, next_since = [], db.tableVersion()
+            else:
+                changes, next_since = db.changesSince(since, None if stream else min(args['wait'], self.MAX_WAIT))
+
+        # since isn't a version
+        except ValueError as ve:
+            print( str(ve) )
+            abort(400)
+
+        # The backend doesn't keep a change log
+        except NotImplementedError as nie:
+            print( str(nie) )
+            abort(501)
+
+        if stream:
+            return Response(self.events(changes, next_since), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache'})
+
+        if changes is None:
+            abort(410, message='Changes since {} are no longer available'.format(since), resync=True,
+                  next_since=next_since)
+
+        return {
+            'changes': [{'version': version, 'kind': kind, 'key': key} for version, kind, key in changes],
+            'next_since': next_since
+        }
+
+    # Send changes as they happen, one "change" event each, or a
+    # "resync" event if the stream falls too far behind
+    def events(self, changes, since):
+        while True:
+            if changes is None:
+                yield 'id: {0}\nevent: resync\ndata: {{"next_since": "{0}"}}\n\n'.format(since)
+            elif not changes:
+                yield ': keepalive\n\n'
+
+            for version, kind, key in changes or []:
+                yield 'id: {}\nevent: change\ndata: {}\n\n'.format(version, json.dumps({'kind': kind, 'key': key}))
+
+            changes, since = db.changesSince(since, self.KEEPALIVE)
+
+
+class MetricsEndpoint(Resource):
+
+    # Return request counts and latency histograms by route, latency
+    # histograms for database calls and serializers, and the fragment
+    # cache's counts, in Prometheus' text exposition format
+    def get(self):
+        return Response(metrics.render(), content_type=CONTENT_TYPE)
+
+
 api.add_resource(RootEndpoint, '/', endpoint='root')
 api.add_resource(UsersEndpoint, '/users/', endpoint ='users')
+api.add_resource(UsersBulkEndpoint, '/users/:bulk', endpoint ='users_bulk')
+api.add_resource(UsersExportEndpoint, '/users/export', endpoint ='users_export')
 api.add_resource(UserEndpoint, '/users/<userid>', endpoint ='user')
 api.add_resource(GroupsEndpoint, '/groups/', endpoint ='groups')
+api.add_resource(GroupsBulkEndpoint, '/groups/:bulk', endpoint ='groups_bulk')
+api.add_resource(GroupQueryEndpoint, '/groups/:query', endpoint ='group_query')
 api.add_resource(GroupEndpoint, '/groups/<groupname>', endpoint ='group')
+api.add_resource(StatsEndpoint, '/stats', endpoint ='stats')
+api.add_resource(ChangesEndpoint, '/changes', endpoint ='changes')
+api.add_resource(MetricsEndpoint, '/metrics', endpoint ='metrics')
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', debug=True)
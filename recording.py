@@ -0,0 +1,73 @@
+import io
+import json
+import threading
+from urllib.parse import quote
+
+# Recording of live traffic, for bench/loadtest.py to replay.
+#
+# recordingMiddleware wraps a WSGI app so that every request is
+# appended to a file as a line of JSON: its method, path, query string,
+# body and the headers that change what it does, along with the route
+# Flask matched and the status it got.
+#
+#     {"method": "PUT", "path": "/groups/admins", "query": "",
+#      "headers": {"Content-Type": "application/json"},
+#      "body": "{\"userids\": [\"jsmith\"]}",
+#      "route": "/groups/<groupname>", "status": 200}
+#
+# Event streams never finish, so they aren't recorded, and neither is
+# anything in headers other than those below (an X-Profile token, say).
+# If-None-Match is recorded so conditional requests are replayed as
+# such, though the ETags in it won't match a restarted service (they
+# carry an epoch picked at startup); loadtest.py doesn't count the 200
+# a recorded 304 then gets as an error.
+
+RECORDED_HEADERS = ['Content-Type', 'Accept', 'If-None-Match']
+
+def recordingMiddleware(wsgi_app, path):
+    log = open(path, 'a')
+    lock = threading.Lock()
+
+    def middleware(environ, start_response):
+        if 'text/event-stream' in environ.get('HTTP_ACCEPT', ''):
+            return wsgi_app(environ, start_response)
+
+        # Read the body here and hand the app a copy.  A chunked body has
+        # no length; the server marks its end instead.
+        if environ.get('wsgi.input_terminated'):
+            body = environ['wsgi.input'].read()
+        else:
+            body = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+
+        environ['wsgi.input'] = io.BytesIO(body)
+
+        headers = {}
+        for name in RECORDED_HEADERS:
+            value = environ.get('CONTENT_TYPE' if name == 'Content-Type' else 'HTTP_' + name.upper().replace('-', '_'))
+
+            if value:
+                headers[name] = value
+
+        # Written once Flask is starting the response, while it still
+        # knows which route the request matched
+        def startResponse(status, response_headers, exc_info = None):
+            rule = getattr(environ.get('werkzeug.request'), 'url_rule', None)
+            line = json.dumps({
+                'method': environ['REQUEST_METHOD'],
+                'path': quote(environ.get('PATH_INFO', '').encode('latin-1'), safe='/:'),
+                'query': environ.get('QUERY_STRING', ''),
+                'headers': headers,
+                'body': body.decode('utf-8', 'surrogateescape'),
+                'route': rule.rule if rule is not None else None,
+                'status': int(status[:3])
+            })
+
+            with lock:
+                log.write(line + '\n')
+                log.flush()
+
+            return start_response(status, response_headers, exc_info)
+
+        return wsgi_app(environ, startResponse)
+
+    return middleware
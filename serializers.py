@@ -0,0 +1,130 @@
+from flask_restful import fields, marshal
+
+# Compile flask_restful field specs into plain Python functions.
+#
+# marshal() re-walks the field spec for every object it renders: it
+# instantiates each field class, splits every key on '.', probes the
+# object for __getitem__ and dispatches through Nested/List on each
+# call.  For a given spec all of that is known up front, so compile()
+# generates a function that reads each value directly and builds the
+# same dict marshal would have built.  Supported fields are String,
+# Nested (with an optional attribute or callable attribute), List of
+# String and nested dicts of fields; compile() raises a TypeError for
+# anything else.
+
+# six.text_type, as used by fields.String
+def _text(value):
+    return None if value is None else str(value)
+
+def _textList(values):
+    if values is None:
+        return None
+
+    return [None if value is None else str(value) for value in values]
+
+# What fields.Nested does with a list, a single object or None
+def _nested(value, serialize, spec):
+    if isinstance(value, (list, tuple)):
+        return [serialize(item) for item in value]
+
+    if value is None:
+        return marshal(None, spec)
+
+    return serialize(value)
+
+
+class _Compiler:
+
+    def __init__(self, from_mapping):
+        self.from_mapping = from_mapping
+        self.namespace = {
+            '_text': _text,
+            '_textList': _textList,
+            '_nested': _nested
+        }
+        self.source = []
+        self.functions = 0
+
+    # Add a name to the generated code's namespace
+    def constant(self, value):
+        name = '_c{}'.format(len(self.namespace))
+        self.namespace[name] = value
+        return name
+
+    def getter(self, key, obj):
+        if callable(key):
+            return '{}({})'.format(self.constant(key), obj)
+
+        if self.from_mapping:
+            return '{}.get({!r})'.format(obj, key)
+
+        if not key.isidentifier():
+            raise TypeError("can't compile attribute '{}'".format(key))
+
+        return '{}.{}'.format(obj, key)
+
+    # Generate a function that renders one record, returning its name.
+    # Each value is read into a local once and the record is built with
+    # a single dict display, with the common cases (a str for a String
+    # field, a list for a Nested one) handled inline.
+    def function(self, spec):
+        name = '_s{}'.format(self.functions)
+        self.functions += 1
+
+        statements = []
+        record = self.record(spec, 'obj', statements)
+
+        self.source.append('def {}(obj):\n{}    return {}\n'.format(
+            name,
+            ''.join('    {}\n'.format(statement) for statement in statements),
+            record
+        ))
+
+        return name
+
+    # A dict display building one record from the object named obj
+    def record(self, spec, obj, statements):
+        items = ['{!r}: {}'.format(key, self.value(key, field, obj, statements)) for key, field in spec.items()]
+        return '{' + ', '.join(items) + '}'
+
+    def value(self, key, field, obj, statements):
+        if isinstance(field, dict):
+            return self.record(field, obj, statements)
+
+        if isinstance(field, type):
+            field = field()
+
+        attribute = key if field.attribute is None else field.attribute
+
+        local = 'v{}'.format(len(statements))
+        statements.append('{} = {}'.format(local, self.getter(attribute, obj)))
+
+        if type(field) is fields.String:
+            return '({0} if {0}.__class__ is str else _text({0}))'.format(local)
+
+        if type(field) is fields.List and type(field.container) is fields.String:
+            return '_textList({})'.format(local)
+
+        if type(field) is fields.Nested:
+            return '([{1}(item) for item in {0}] if {0}.__class__ is list else _nested({0}, {1}, {2}))'.format(
+                local,
+                self.function(field.nested),
+                self.constant(field.nested)
+            )
+
+        raise TypeError("can't compile a {} field".format(type(field).__name__))
+
+    def compile(self, spec):
+        name = self.function(spec)
+        exec('\n'.join(self.source), self.namespace)
+        return self.namespace[name]
+
+
+# Return a function that renders an object (or, with from_mapping, a dict)
+# exactly as marshal(obj, spec) would.  With compiled=False it simply calls
+# marshal, which is handy for checking the two against each other.
+def serializer(spec, from_mapping=False, compiled=True):
+    if not compiled:
+        return lambda obj: marshal(obj, spec)
+
+    return _Compiler(from_mapping).compile(spec)
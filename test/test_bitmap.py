@@ -0,0 +1,45 @@
+from database.bitmap import Bitmap
+import random
+
+class TestBitmap():
+
+    # Verify adding, removing and testing numbers, in one block and across several
+    def test_add_discard(self):
+        numbers = Bitmap([3, 5000, 70000])
+
+        numbers.add(4)
+        numbers.discard(5000)
+        numbers.discard(123456)
+
+        assert list(numbers) == [3, 4, 70000]
+        assert len(numbers) == 3
+        assert 4 in numbers
+        assert 5000 not in numbers
+        assert 999999 not in numbers
+
+    # Verify the set algebra against Python's sets
+    def test_algebra(self):
+        chooser = random.Random(7)
+        left = set(chooser.randrange(20000) for _ in range(3000))
+        right = set(chooser.randrange(20000) for _ in range(3000))
+
+        assert list(Bitmap(left) & Bitmap(right)) == sorted(left & right)
+        assert list(Bitmap(left) | Bitmap(right)) == sorted(left | right)
+        assert list(Bitmap(left) - Bitmap(right)) == sorted(left - right)
+        assert len(Bitmap(left) - Bitmap(left)) == 0
+
+    # Verify iterating from a starting point
+    def test_iterFrom(self):
+        numbers = Bitmap([1, 4095, 4096, 9000])
+
+        assert list(numbers.iterFrom(1)) == [4095, 4096, 9000]
+        assert list(numbers.iterFrom(4095)) == [4096, 9000]
+        assert list(numbers.iterFrom(5000)) == [9000]
+        assert list(numbers.iterFrom(9000)) == []
+
+    # Verify a bitmap of every number up to a bound
+    def test_upTo(self):
+        assert list(Bitmap.upTo(5)) == [0, 1, 2, 3, 4]
+        assert len(Bitmap.upTo(10000)) == 10000
+        assert len(Bitmap.upTo(8192)) == 8192
+        assert 10000 not in Bitmap.upTo(10000)
@@ -1,5 +1,9 @@
+from collections import Counter
 import database.fake_db as db
 import pytest
+import sys
+import threading
+import time
 
 #                        _            _
 #                       | |          | |
@@ -9,6 +13,17 @@ import pytest
 #  \__,_|___/\___|_|     \__\___||___/\__|___/
 #
 
+# The group statistics, worked out the slow way
+def scannedStats():
+    users = db.allUsers()
+
+    return {
+        "users": len(users),
+        "members": [(group.name, len(db.getUserIdsForGroup(group)))
+                    for group in sorted(db.allGroups(), key = lambda group: group.name)],
+        "groups_per_user": sorted(Counter(len(user.groups) for user in users).items())
+    }
+
 class TestFakeDbUsers():
 
     # Verify that allUsers returns our list of our three expected users.
@@ -102,6 +117,26 @@ class TestFakeDbUsers():
         for group in user.groups:
             assert group.name in ["admins", "pirates"]
 
+    # Verify that updating a user replaces the indexed user
+    # object rather than adding a second copy of it.
+    def test_updateUser_replaces_indexed_user(self):
+        db.addUser(db.User("u011", "bob", "loblaw"))
+        user_count = len(db.allUsers())
+
+        new_user = db.User("u011", "robert", "loblaw")
+        db.updateUser(new_user)
+
+        assert len(db.allUsers()) == user_count
+        assert db.getUserByUserid("u011") is new_user
+
+    # Verify that addUser swaps equivalent group objects
+    # for the ones that are actually in the group index.
+    def test_addUser_uses_indexed_groups(self):
+        user = db.User("u012", "lucille", "bluth", [db.Group("execs")])
+        db.addUser(user)
+
+        assert list(user.groups)[0] is db.getGroupByName("execs")
+
     # Can we delete a user?
     def test_deleteUser(self):
         user = db.User("u008", "trad", "miller")
@@ -145,6 +180,72 @@ class TestFakeDbUsers():
         assert len(user.groups) == 1
         assert "admins" not in [group.name for group in user.groups]
 
+    # Verify that users are compact records whose groups are a view
+    # that changes the user, and that assigning one user's groups to
+    # another copies them rather than sharing them
+    def test_user_record(self):
+        user = db.User("u013", "gob", "bluth", [db.getGroupByName("users")])
+        assert not hasattr(user, "__dict__")
+        assert not hasattr(db.Group("magicians"), "__dict__")
+
+        groups = user.groups
+        groups.add(db.getGroupByName("pirates"))
+        assert [group.name for group in user.groups] == ["users", "pirates"]
+
+        other = db.User("u014", "buster", "bluth", user.groups)
+        groups.discard(db.getGroupByName("users"))
+        assert [group.name for group in other.groups] == ["users", "pirates"]
+        assert [group.name for group in user.groups] == ["pirates"]
+
+    # Verify that addUsers adds a whole batch of users
+    def test_addUsers(self):
+        db.addUsers([
+            db.User("u101", "aaa", "aaa", [db.getGroupByName("users")]),
+            db.User("u102", "bbb", "bbb", [db.getGroupByName("users"), db.getGroupByName("pirates")])
+        ])
+
+        assert db.getUserByUserid("u101").first_name == "aaa"
+        assert [group.name for group in db.getUserByUserid("u102").groups] == ["users", "pirates"]
+        assert "u102" in db.getUserIdsForGroup(db.getGroupByName("pirates"))
+
+    # Verify that addUsers adds nothing if any user in the batch is
+    # no good, and that its BatchError lists every one that isn't.
+    def test_addUsers_errors(self):
+        db.addUser(db.User("u103", "ccc", "ccc"))
+
+        with pytest.raises(db.BatchError) as error:
+            db.addUsers([
+                db.User("u104", "ddd", "ddd"),
+                db.User("u103", "ccc", "ccc"),
+                db.User("u105", "eee", "eee", [db.Group("ap-8u9-8aojob")]),
+                db.User("u104", "ddd", "ddd")
+            ])
+
+        assert [index for index, message in error.value.errors] == [1, 2, 3]
+        assert not db.userExistsByUserid("u104")
+        assert not db.userExistsByUserid("u105")
+
+    # Verify that a user in a group with a high id, as ids pile up while
+    # groups come and go, keeps its groups as their ids rather than as
+    # a mask mostly of zeros, and that they still work as a GroupSet.
+    def test_sparse_groups(self):
+        high_groups = [db.Group("sparse_group_{:03}".format(i)) for i in range(600)]
+        db.User("sparse_user", "aaa", "aaa", high_groups)
+        user = db.User("sparse_user", "aaa", "aaa", [db.Group("users"), high_groups[-1]])
+
+        assert list(user.packed_groups) == sorted(user.packed_groups) and len(user.packed_groups) == 2
+        assert [group.name for group in user.groups] == ["users", "sparse_group_599"]
+        assert high_groups[-1] in user.groups and high_groups[0] not in user.groups
+        assert len(user.groups) == 2
+
+        user.groups.add(high_groups[0])
+        user.groups.discard(db.Group("users"))
+        assert [group.name for group in user.groups] == ["sparse_group_000", "sparse_group_599"]
+
+        user.groups.discard(high_groups[0])
+        user.groups.discard(high_groups[-1])
+        assert user.packed_groups == 0 and user.group_mask == 0
+
 #                                _            _
 #                               | |          | |
 #   __ _ _ __ ___  _   _ _ __   | |_ ___  ___| |_ ___
@@ -156,6 +257,20 @@ class TestFakeDbUsers():
 
 class TestFakeDbGroups():
 
+    # Verify that addGroups adds a whole batch of groups, and nothing
+    # at all if any of their names are taken.
+    def test_addGroups(self):
+        db.addGroups([db.Group("bulk_group_001"), db.Group("bulk_group_002")])
+
+        assert db.groupNameExists("bulk_group_001")
+        assert db.groupNameExists("bulk_group_002")
+
+        with pytest.raises(db.BatchError) as error:
+            db.addGroups([db.Group("bulk_group_003"), db.Group("users"), db.Group("bulk_group_003")])
+
+        assert [index for index, message in error.value.errors] == [1, 2]
+        assert not db.groupNameExists("bulk_group_003")
+
     # Verify that groupNameExists works as expected
     def test_groupNameExists(self):
         assert db.groupNameExists("users")
@@ -296,3 +411,515 @@ class TestFakeDbGroups():
 
         for userid in [user.userid for user in db.allUsers() if new_group in user.groups]:
             assert userid in ["u032", "u033"]
+
+    # Verify that the group membership index follows users
+    # as they're updated, deleted and have groups added.
+    def test_getUserIdsForGroup_follows_user_changes(self):
+        new_group = db.Group("indexed_group")
+        db.addGroup(new_group)
+
+        db.addUser(db.User("u040", "aaa", "aaa", [new_group]))
+        db.addUser(db.User("u041", "bbb", "bbb"))
+        db.addUser(db.User("u042", "ccc", "ccc", [new_group]))
+
+        db.updateUser(db.User("u040", "aaa", "aaa", [db.getGroupByName("users")]))
+        db.addGroupToUser(db.getUserByUserid("u041"), new_group)
+        db.deleteUserByUserId("u042")
+
+        assert db.getUserIdsForGroup(new_group) == ["u041"]
+
+    # Verify that changing the groups of a user object that isn't
+    # in the database doesn't leak into the membership index.
+    def test_getUserIdsForGroup_ignores_detached_users(self):
+        new_group = db.Group("detached_group")
+        db.addGroup(new_group)
+
+        db.addGroupToUser(db.User("u043", "aaa", "aaa"), new_group)
+        db.addGroupToUser(db.User("jsmith", "Joe", "Smith"), new_group)
+
+        assert db.getUserIdsForGroup(new_group) == []
+
+    # Verify that updateGroupMembership ignores
+    # duplicate userids in the new member list.
+    def test_updateGroupMembership_duplicates(self):
+        new_group = db.Group("duplicated_group")
+        db.addGroup(new_group)
+
+        db.updateGroupMembership(new_group, ["jsmith", "jjones", "jsmith"])
+
+        assert sorted(db.getUserIdsForGroup(new_group)) == ["jjones", "jsmith"]
+        assert [group.name for group in db.getUserByUserid("jsmith").groups].count("duplicated_group") == 1
+
+    # Verify that a user's groups come back in group creation
+    # order no matter what order they were handed over in.
+    def test_user_groups_order(self):
+        db.addGroupByName("ordered_group_a")
+        db.addGroupByName("ordered_group_b")
+
+        user = db.User("u044", "aaa", "aaa", [
+            db.getGroupByName("ordered_group_b"),
+            db.getGroupByName("users"),
+            db.getGroupByName("ordered_group_a")
+        ])
+
+        assert [group.name for group in user.groups] == ["users", "ordered_group_a", "ordered_group_b"]
+
+    # Verify that a group that has been removed and then recreated
+    # isn't treated as a membership of users created in between.
+    def test_removed_group_rejected(self):
+        db.addGroupByName("short_lived_group")
+        stale_group = db.getGroupByName("short_lived_group")
+        db.removeGroup(stale_group)
+
+        with pytest.raises(LookupError):
+            db.addUser(db.User("u045", "aaa", "aaa", [stale_group]))
+
+        db.addGroupByName("short_lived_group")
+        db.addUser(db.User("u045", "aaa", "aaa", [stale_group]))
+
+        assert list(db.getUserByUserid("u045").groups)[0] is db.getGroupByName("short_lived_group")
+
+    # Verify that a group that has been removed and then recreated comes
+    # after the groups created in between, as it would after recovery.
+    def test_recreated_group_order(self):
+        db.addGroupByName("recreated_group")
+        db.addGroupByName("between_group")
+        db.removeGroupByName("recreated_group")
+        db.addGroupByName("recreated_group")
+
+        db.addUser(db.User("u046", "aaa", "aaa", [db.getGroupByName("recreated_group"), db.getGroupByName("between_group")]))
+
+        assert [group.name for group in db.getUserByUserid("u046").groups] == ["between_group", "recreated_group"]
+
+    # Verify that changeGroupMembership adds and removes
+    # members while leaving everybody else alone.
+    def test_changeGroupMembership(self):
+        new_group = db.Group("delta_group")
+        db.addGroup(new_group)
+        db.updateGroupMembership(new_group, ["jsmith", "jjones"])
+
+        db.changeGroupMembership(new_group, ["jsparrow"], ["jsmith"])
+
+        assert sorted(db.getUserIdsForGroup(new_group)) == ["jjones", "jsparrow"]
+        assert not db.userHasGroup(db.getUserByUserid("jsmith"), new_group)
+
+    # Verify that changeGroupMembership doesn't change anything
+    # if any of the userids don't belong to an actual user.
+    def test_changeGroupMembership_nonexistent_user(self):
+        new_group = db.Group("delta_group_2")
+        db.addGroup(new_group)
+        db.updateGroupMembership(new_group, ["jsmith"])
+
+        with pytest.raises(LookupError):
+            db.changeGroupMembership(new_group, ["jjones", "098ujasdf"], ["jsmith"])
+
+        assert db.getUserIdsForGroup(new_group) == ["jsmith"]
+
+    # Verify that changeGroupMembership refuses to
+    # both add and remove the same user.
+    def test_changeGroupMembership_conflict(self):
+        new_group = db.Group("delta_group_3")
+        db.addGroup(new_group)
+
+        with pytest.raises(ValueError):
+            db.changeGroupMembership(new_group, ["jsmith"], ["jsmith"])
+
+    # Verify that group queries combine memberships, and follow
+    # users as they're updated, deleted and have groups changed.
+    def test_group_queries(self):
+        db.addGroupByName("query_group_a")
+        db.addGroupByName("query_group_b")
+        group_a = db.getGroupByName("query_group_a")
+        group_b = db.getGroupByName("query_group_b")
+
+        db.addUser(db.User("q000", "aaa", "aaa", [group_a]))
+        db.addUser(db.User("q001", "bbb", "bbb", [group_a, group_b]))
+        db.addUser(db.User("q002", "ccc", "ccc", [group_b]))
+        db.addUser(db.User("q003", "ddd", "ddd", [group_a, group_b]))
+
+        assert sorted(db.pageGroupQuery("query_group_a AND query_group_b")[0]) == ["q001", "q003"]
+        assert sorted(db.pageGroupQuery("query_group_a and not query_group_b")[0]) == ["q000"]
+        assert db.countGroupQuery("query_group_a OR query_group_b") == 4
+        assert db.countGroupQuery("NOT (query_group_a OR query_group_b)") == \
+            len(db.allUsers()) - 4
+
+        db.updateUser(db.User("q000", "aaa", "aaa", [group_b]))
+        db.removeGroupFromUser(db.getUserByUserid("q001"), group_b)
+        db.deleteUserByUserId("q003")
+
+        assert sorted(db.pageGroupQuery("query_group_b")[0]) == ["q000", "q002"]
+        assert db.pageGroupQuery("query_group_a AND NOT query_group_b") == (["q001"], None)
+
+        db.removeGroup(group_a)
+        db.addGroupByName("query_group_a")
+        assert db.countGroupQuery("query_group_a") == 0
+
+    # Verify that group query results can be paged through
+    def test_group_query_paging(self):
+        db.addGroupByName("query_paging_group")
+        group = db.getGroupByName("query_paging_group")
+        userids = ["q01{}".format(i) for i in range(5)]
+
+        for userid in userids:
+            db.addUser(db.User(userid, "aaa", "aaa", [group]))
+
+        first, next_key = db.pageGroupQuery("query_paging_group", 3)
+        rest, last_key = db.pageGroupQuery("query_paging_group", 3, next_key)
+
+        assert len(first) == 3 and next_key == first[-1]
+        assert sorted(first + rest) == userids
+        assert last_key is None
+
+    # Verify that bad group queries are rejected
+    def test_group_query_errors(self):
+        with pytest.raises(ValueError):
+            db.countGroupQuery("users AND (admins")
+
+        with pytest.raises(LookupError):
+            db.pageGroupQuery("users AND jklasdf09u")
+
+        with pytest.raises(ValueError):
+            db.pageGroupQuery("users", 10, ("a", "b"))
+
+        with pytest.raises(ValueError):
+            db.countGroupQuery("NOT (" * 1000 + "users" + ")" * 1000)
+
+        # As deep as a query can go
+        assert db.countGroupQuery("NOT (" * 10 + "users AND admins" + ")" * 10) == \
+            db.countGroupQuery("users AND admins")
+
+    # Verify that the group statistics keep up with every kind of
+    # change, by comparing them with what a scan of the users finds
+    def test_groupStats(self):
+        assert db.groupStats() == scannedStats()
+
+        db.addGroupByName("stats_group")
+        stats_group = db.getGroupByName("stats_group")
+        db.addUser(db.User("q020", "aaa", "aaa", [stats_group, db.getGroupByName("users")]))
+        db.addUser(db.User("q021", "bbb", "bbb"))
+        db.addUser(db.User("q022", "ccc", "ccc", [stats_group]))
+        assert db.groupStats() == scannedStats()
+
+        db.updateUser(db.User("q021", "bbb", "bbb", [stats_group]))
+        db.deleteUserByUserId("q022")
+        db.removeGroupFromUser(db.getUserByUserid("q020"), db.getGroupByName("users"))
+        assert db.groupStats() == scannedStats()
+
+        db.updateGroupMembership(stats_group, ["q020", "jsmith"])
+        db.changeGroupMembership(stats_group, ["jjones"], ["jsmith"])
+        assert db.groupStats() == scannedStats()
+
+        db.removeGroup(stats_group)
+        assert db.groupStats() == scannedStats()
+
+    # Verify that change listeners hear about the users and
+    # groups touched by each kind of change.
+    def test_addChangeListener(self):
+        changes = []
+        db.addChangeListener(lambda kind, key: changes.append((kind, key)))
+
+        try:
+            db.addGroupByName("listened_group")
+            assert changes == [("group", "listened_group")]
+
+            del changes[:]
+            db.addUser(db.User("u050", "aaa", "aaa", [db.getGroupByName("listened_group")]))
+            assert set(changes) == {("user", "u050"), ("group", "listened_group")}
+
+            del changes[:]
+            db.updateGroupMembership(db.getGroupByName("listened_group"), ["jsmith"])
+            assert set(changes) == {("user", "u050"), ("user", "jsmith"), ("group", "listened_group")}
+
+            del changes[:]
+            db.updateUser(db.User("u050", "bbb", "bbb", [db.getGroupByName("users")]))
+            assert set(changes) == {("user", "u050"), ("group", "users")}
+
+            del changes[:]
+            db.removeGroupByName("listened_group")
+            assert set(changes) == {("user", "jsmith"), ("group", "listened_group")}
+
+        finally:
+            db.change_listeners.pop()
+
+#                   _                _            _
+#                  (_)              | |          | |
+#  _ __   __ _  __ _ _ _ __   __ _  | |_ ___  ___| |_ ___
+# | '_ \ / _` |/ _` | | '_ \ / _` | | __/ _ \/ __| __/ __|
+# | |_) | (_| | (_| | | | | | (_| | | ||  __/\__ \ |_\__ \
+# | .__/ \__,_|\__, |_|_| |_|\__, |  \__\___||___/\__|___/
+# | |           __/ |         __/ |
+# |_|          |___/         |___/
+
+class TestFakeDbPaging():
+
+    # Verify that paging through all users visits each user
+    # exactly once, in userid order.
+    def test_pageUsers(self):
+        seen = []
+        users, next_key = db.pageUsers(2)
+
+        while True:
+            assert len(users) <= 2
+            seen.extend(user.userid for user in users)
+
+            if next_key is None:
+                break
+
+            users, next_key = db.pageUsers(2, next_key)
+
+        assert seen == sorted(user.userid for user in db.allUsers())
+
+    # Verify that we can page through the members of a group
+    def test_pageUsers_group(self):
+        new_group = db.Group("paged_group")
+        db.addGroup(new_group)
+
+        for userid in ["p003", "p001", "p002"]:
+            db.addUser(db.User(userid, "aaa", "aaa", [new_group]))
+
+        users, next_key = db.pageUsers(2, group = new_group)
+        assert [user.userid for user in users] == ["p001", "p002"]
+
+        users, next_key = db.pageUsers(2, next_key, group = new_group)
+        assert [user.userid for user in users] == ["p003"]
+        assert next_key is None
+
+    # Verify that a last name prefix returns matching
+    # users in (last_name, userid) order.
+    def test_pageUsers_last_name_prefix(self):
+        db.addUser(db.User("p010", "aaa", "Zzyzxb"))
+        db.addUser(db.User("p011", "bbb", "Zzyzxa"))
+        db.addUser(db.User("p012", "ccc", "Zzyzxc"))
+
+        users, next_key = db.pageUsers(2, last_name_prefix = "Zzyzx")
+        assert [user.userid for user in users] == ["p011", "p010"]
+
+        users, next_key = db.pageUsers(2, next_key, last_name_prefix = "Zzyzx")
+        assert [user.userid for user in users] == ["p012"]
+        assert next_key is None
+
+    # Verify that a page key from one ordering is
+    # rejected when paging through another one.
+    def test_pageUsers_bad_key(self):
+        with pytest.raises(ValueError):
+            db.pageUsers(2, ("Smith", "jsmith"))
+
+        with pytest.raises(ValueError):
+            db.pageUsers(2, "jsmith", last_name_prefix = "S")
+
+    # Verify that groups page in name order
+    def test_pageGroups(self):
+        groups, next_key = db.pageGroups(1)
+        assert len(groups) == 1
+
+        rest, next_key = db.pageGroups(None, next_key)
+        assert [group.name for group in groups + rest] == sorted(group.name for group in db.allGroups())
+        assert next_key is None
+
+    # Verify that iterUsers visits every user in userid order
+    def test_iterUsers(self):
+        assert [user.userid for user in db.iterUsers(2)] == sorted(user.userid for user in db.allUsers())
+
+    # Verify that iterUsers copes with users being deleted mid-iteration
+    def test_iterUsers_with_deletes(self):
+        for userid in ["p020", "p021", "p022"]:
+            db.addUser(db.User(userid, "aaa", "aaa"))
+
+        seen = []
+        for user in db.iterUsers(1):
+            seen.append(user.userid)
+
+            if user.userid == "p020":
+                db.deleteUserByUserId("p021")
+
+        assert "p020" in seen
+        assert "p021" not in seen
+        assert "p022" in seen
+
+#                                             _            _
+#                          _                 | |          | |
+# __   __  ___  _ __  ___ (_)  ___   _ __    | |_ ___  ___| |_ ___
+# \ \ / / / _ \| '__|/ __|| | / _ \ | '_ \   | __/ _ \/ __| __/ __|
+#  \ V / |  __/| |   \__ \| || (_) || | | |  | ||  __/\__ \ |_\__ \
+#   \_/   \___||_|   |___/|_| \___/ |_| |_|   \__\___||___/\__|___/
+
+class TestFakeDbVersions():
+
+    # Verify that a change moves on the version tags of the whole
+    # database and of what it was about, and leaves the others be.
+    def test_versions_change(self):
+        db.addGroupByName("version_group")
+        group = db.getGroupByName("version_group")
+        db.addUser(db.User("v001", "aaa", "aaa"))
+
+        table = db.tableVersion()
+        user = db.userVersion("v001")
+        other_user = db.userVersion("jsmith")
+        group_version = db.groupVersion("version_group")
+
+        assert db.tableVersion() == table
+        assert db.userVersion("v001") == user
+
+        db.addGroupToUser(db.getUserByUserid("v001"), group)
+
+        assert db.tableVersion() != table
+        assert db.userVersion("v001") != user
+        assert db.groupVersion("version_group") != group_version
+        assert db.userVersion("jsmith") == other_user
+
+    # Verify that deleting a user or group moves its tag on too
+    def test_versions_delete(self):
+        db.addUser(db.User("v002", "bbb", "bbb"))
+        user = db.userVersion("v002")
+
+        db.deleteUserByUserId("v002")
+        assert db.userVersion("v002") != user
+
+        db.addGroupByName("version_group_2")
+        group = db.groupVersion("version_group_2")
+        db.removeGroupByName("version_group_2")
+        assert db.groupVersion("version_group_2") != group
+
+    # Verify that the changes since a version are listed oldest first
+    # and bring the caller up to the current version
+    def test_changes_since(self):
+        since = db.tableVersion()
+        assert db.changesSince(since) == ([], since)
+
+        db.addUser(db.User("v003", "ccc", "ccc", [db.getGroupByName("users")]))
+        db.deleteUserByUserId("v003")
+
+        changes, next_since = db.changesSince(since)
+        assert next_since == db.tableVersion()
+        assert changes[-1][0] == next_since
+        assert [(kind, key) for _, kind, key in changes] == \
+            [("user", "v003"), ("group", "users"), ("user", "v003"), ("group", "users")]
+
+        assert db.changesSince(changes[1][0]) == (changes[2:], next_since)
+
+    # Verify that a version from another run, or from the future,
+    # calls for a resync, and that something else isn't a version
+    def test_changes_resync(self):
+        assert db.changesSince("elsewhere.0") == (None, db.tableVersion())
+        assert db.changesSince(db.tableVersion() + "0") == (None, db.tableVersion())
+
+        with pytest.raises(ValueError):
+            db.changesSince("latest")
+
+    # Verify that waiting for changes gives up after the timeout, and
+    # returns as soon as there is a change to report
+    def test_changes_wait(self):
+        since = db.tableVersion()
+
+        start = time.time()
+        assert db.changesSince(since, 0.2) == ([], since)
+        assert time.time() - start >= 0.2
+
+        writer = threading.Timer(0.1, db.addGroupByName, ["version_group_3"])
+        writer.start()
+
+        start = time.time()
+        changes, _ = db.changesSince(since, 10)
+        writer.join()
+
+        assert time.time() - start < 5
+        assert [(kind, key) for _, kind, key in changes] == [("group", "version_group_3")]
+
+#                                                              _            _
+#                                                             | |          | |
+#   ___ ___  _ __   ___ _   _ _ __ _ __ ___ _ __   ___ _   _  | |_ ___  ___| |_ ___
+#  / __/ _ \| '_ \ / __| | | | '__| '__/ _ \ '_ \ / __| | | | | __/ _ \/ __| __/ __|
+# | (_| (_) | | | | (__| |_| | |  | | |  __/ | | | (__| |_| | | ||  __/\__ \ |_\__ \
+#  \___\___/|_| |_|\___|\__,_|_|  |_|  \___|_| |_|\___|\__, |  \__\___||___/\__|___/
+#                                                      __/ |
+#                                                     |___/
+
+class TestFakeDbConcurrency():
+
+    # Verify that readers running alongside a writer never see a
+    # group's members or a user halfway through being changed.
+    def test_no_torn_reads(self):
+        new_group = db.Group("torn_group")
+        db.addGroup(new_group)
+
+        userids = ["t{:03d}".format(i) for i in range(21)]
+        for userid in userids:
+            db.addUser(db.User(userid, "aaa", "aaa"))
+
+        first, second = userids[:10], userids[10:20]
+        db.updateGroupMembership(new_group, first)
+
+        stop = threading.Event()
+        torn = []
+
+        def write():
+            flip = False
+
+            while not stop.is_set():
+                db.updateGroupMembership(new_group, second if flip else first)
+                db.updateUser(db.User("t020", "aaa", "bbb" if flip else "aaa"))
+                flip = not flip
+
+        def read():
+            while not stop.is_set():
+                if db.getUserIdsForGroup(new_group) not in (first, second):
+                    torn.append("members")
+
+                users, next_key = db.pageUsers(group = new_group)
+                if [user.userid for user in users] not in (first, second):
+                    torn.append("page")
+
+                if not db.userExistsByUserid("t020"):
+                    torn.append("user")
+
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-5)
+
+        try:
+            threads = [threading.Thread(target = write)] + [threading.Thread(target = read) for _ in range(4)]
+
+            for thread in threads:
+                thread.start()
+
+            time.sleep(0.5)
+            stop.set()
+
+            for thread in threads:
+                thread.join()
+
+        finally:
+            sys.setswitchinterval(switch_interval)
+
+        assert torn == []
+
+    # Verify that a writer holding one shard doesn't hold up
+    # writes to users in other shards, but does hold up its own.
+    def test_shards_lock_separately(self):
+        userids = ["s{:03d}".format(i) for i in range(100)]
+        blocked_shard = db._shardFor(userids[0])
+        same = [userid for userid in userids if db._shardFor(userid) is blocked_shard][1]
+        other = [userid for userid in userids if db._shardFor(userid) is not blocked_shard][0]
+
+        done = []
+        def add(userid):
+            db.addUser(db.User(userid, "aaa", "aaa"))
+            done.append(userid)
+
+        blocked_shard.lock.acquireWrite()
+
+        try:
+            threads = [threading.Thread(target = add, args = (userid,)) for userid in [same, other]]
+
+            for thread in threads:
+                thread.start()
+
+            threads[1].join(5)
+            threads[0].join(0.1)
+
+            assert done == [other]
+
+        finally:
+            blocked_shard.lock.releaseWrite()
+
+        threads[0].join()
+        assert sorted(done) == sorted([same, other])
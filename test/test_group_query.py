@@ -0,0 +1,33 @@
+from database.group_query import parseGroupQuery, queryGroupNames
+import pytest
+
+class TestGroupQuery():
+
+    # Verify that NOT binds tighter than AND, which binds tighter than OR
+    def test_precedence(self):
+        assert parseGroupQuery("a OR b AND NOT c") == \
+            ('or', [('group', 'a'), ('and', [('group', 'b'), ('not', ('group', 'c'))])])
+
+    # Verify parentheses, lower case keywords and quoted names
+    def test_grouping(self):
+        assert parseGroupQuery('(a or "and") and not ("big group")') == \
+            ('and', [('or', [('group', 'a'), ('group', 'and')]), ('not', ('group', 'big group'))])
+
+    # Verify listing the groups a query mentions
+    def test_queryGroupNames(self):
+        assert queryGroupNames(parseGroupQuery("admins AND execs AND NOT pirates")) == ["admins", "execs", "pirates"]
+
+    # Verify that things that aren't expressions are rejected
+    def test_errors(self):
+        for expression in ["", "   ", "a AND", "(a", "a)", "a b", "NOT", '"a', "OR a"]:
+            with pytest.raises(ValueError):
+                parseGroupQuery(expression)
+
+    # Verify that a query nested too deep for the parser is rejected
+    # rather than overflowing the stack
+    def test_nesting(self):
+        assert parseGroupQuery("NOT " * 20 + "a")[0] == 'not'
+
+        for expression in ["NOT " * 21 + "a", "(" * 2000 + "a" + ")" * 2000, "NOT (" * 1000 + "a" + ")" * 1000]:
+            with pytest.raises(ValueError):
+                parseGroupQuery(expression)
@@ -0,0 +1,160 @@
+from flask import Flask, Response
+from metrics import Histogram, Metrics, TimedStore
+import database.fake_db as db
+import threading
+import time
+
+# The lines of a rendering that are about this metric, without the
+# HELP and TYPE comments
+def samples(text, name):
+    return [line for line in text.splitlines() if line.startswith(name) and not line.startswith('#')]
+
+class TestMetrics():
+
+    # Verify that a histogram's buckets count every observation at or
+    # under their bound, ending with +Inf
+    def test_histogram(self):
+        histogram = Histogram((0.1, 1.0))
+
+        for value in [0.05, 0.1, 0.5, 2.0]:
+            histogram.observe(value)
+
+        assert histogram.buckets() == [(0.1, 2), (1.0, 3), ('+Inf', 4)]
+        assert histogram.count() == 4
+        assert histogram.sum == 2.65
+
+    # Verify that a timed function still returns (and raises) what it
+    # did, and that every call is counted either way
+    def test_timed(self):
+        metrics = Metrics()
+
+        def fail():
+            raise LookupError('missing')
+
+        assert metrics.timed('store', 'double', lambda x: 2 * x)(21) == 42
+
+        try:
+            metrics.timed('store', 'fail', fail)()
+            assert False
+        except LookupError:
+            pass
+
+        text = metrics.render()
+        assert 'store_operation_duration_seconds_count{operation="double"} 1' in samples(text, 'store_')
+        assert 'store_operation_duration_seconds_count{operation="fail"} 1' in samples(text, 'store_')
+        assert 'store_operation_duration_seconds_bucket{operation="double",le="+Inf"} 1' in samples(text, 'store_')
+
+    # Verify that requests are counted by route rule, method and status,
+    # with anything that matches no route counted as "unmatched"
+    def test_requests(self):
+        metrics = Metrics()
+        app = Flask(__name__)
+
+        @app.route('/users/<userid>')
+        def user(userid):
+            return '', 404 if userid == 'nobody' else 200
+
+        app.wsgi_app = metrics.wsgiMiddleware(app.wsgi_app)
+        client = app.test_client()
+
+        # As a server does once it has sent the response
+        for path in ['/users/jsmith', '/users/jjones', '/users/nobody', '/nowhere']:
+            client.get(path).close()
+
+        assert samples(metrics.render(), 'http_requests_total') == [
+            'http_requests_total{route="/users/<userid>",method="GET",status="200"} 2',
+            'http_requests_total{route="/users/<userid>",method="GET",status="404"} 1',
+            'http_requests_total{route="unmatched",method="GET",status="404"} 1'
+        ]
+        assert 'http_request_duration_seconds_count{route="/users/<userid>",method="GET"} 3' in \
+            samples(metrics.render(), 'http_request_duration_seconds_count')
+
+    # Verify that a streamed response is timed until all of it has been
+    # sent, not just until the view returned
+    def test_streamed_request(self):
+        metrics = Metrics()
+        app = Flask(__name__)
+
+        @app.route('/export')
+        def export():
+            def lines():
+                for line in ['a\n', 'b\n']:
+                    time.sleep(0.05)
+                    yield line
+
+            return Response(lines())
+
+        app.wsgi_app = metrics.wsgiMiddleware(app.wsgi_app)
+        response = app.test_client().get('/export')
+
+        assert metrics.total().requests == {}
+        assert response.get_data(as_text=True) == 'a\nb\n'
+        response.close()
+
+        assert metrics.total().requests == {('/export', 'GET', 200): 1}
+        assert metrics.total().histograms[('request', ('/export', 'GET'))].sum >= 0.1
+
+    # Verify that a call that returns a generator is timed until the
+    # generator is exhausted or closed, and only counted once
+    def test_timed_generator(self):
+        metrics = Metrics()
+
+        def slow():
+            for item in range(2):
+                time.sleep(0.05)
+                yield item
+
+        timed = metrics.timed('store', 'slow', slow)
+        assert list(timed()) == [0, 1]
+
+        items = timed()
+        next(items)
+        items.close()
+
+        histogram = metrics.total().histograms[('store', 'slow')]
+        assert histogram.count() == 2
+        assert histogram.sum >= 0.15
+
+    # Verify that what threads recorded is added up, including threads
+    # that have finished and been folded together
+    def test_threads(self):
+        metrics = Metrics()
+        count = metrics.timed('store', 'count', lambda: None)
+
+        def calls():
+            for _ in range(10):
+                count()
+
+        for _ in range(3):
+            thread = threading.Thread(target=calls)
+            thread.start()
+            thread.join()
+
+        calls()
+
+        assert 'store_operation_duration_seconds_count{operation="count"} 40' in \
+            samples(metrics.render(), 'store_operation_duration_seconds_count')
+        assert len(metrics.recorders) <= 2
+
+    # Verify that label values are escaped and that collectors' metrics
+    # are rendered with their type
+    def test_render(self):
+        metrics = Metrics()
+        metrics.timed('serializer', 'say "hi"\n', lambda: None)()
+        metrics.addCollector(lambda: {'cache_size': ('gauge', 'Entries in the cache.', 7)})
+
+        text = metrics.render()
+        assert 'serializer_duration_seconds_count{serializer="say \\"hi\\"\\n"} 1' in text
+        assert '# TYPE cache_size gauge\ncache_size 7' in text
+
+    # Verify that a timed store times the database's functions and
+    # passes everything else through
+    def test_timed_store(self):
+        metrics = Metrics()
+        store = TimedStore(db, metrics)
+
+        assert store.getUserByUserid('jsmith').userid == 'jsmith'
+        assert store.User is db.User and store.backend == db.backend
+        assert store.getUserByUserid is store.getUserByUserid
+        assert 'store_operation_duration_seconds_count{operation="getUserByUserid"} 1' in \
+            samples(metrics.render(), 'store_operation_duration_seconds_count')
@@ -0,0 +1,214 @@
+from test.test_fake_db import scannedStats
+import database.fake_db as db
+import database.persistence
+from database.snapshot import Snapshot
+import glob
+import os
+import pytest
+import threading
+
+# Take a picture of everything in the database
+def dump():
+    return (
+        [(user.userid, user.first_name, user.last_name, [group.name for group in user.groups]) for user in db.allUsers()],
+        sorted(group.name for group in db.allGroups()),
+        dict((group.name, db.getUserIdsForGroup(group)) for group in db.allGroups())
+    )
+
+@pytest.fixture
+def data_dir(tmpdir):
+    yield str(tmpdir)
+    db.disablePersistence()
+
+class TestPersistence():
+
+    # Verify that enabling persistence on an empty directory
+    # snapshots the database and doesn't change it.
+    def test_enable_empty(self, data_dir):
+        before = dump()
+        db.enablePersistence(data_dir)
+
+        assert dump() == before
+        assert len(glob.glob(os.path.join(data_dir, "snapshot-*.bin"))) == 1
+
+    # Verify that every kind of mutation survives a restart
+    def test_recover_log(self, data_dir):
+        db.enablePersistence(data_dir)
+
+        db.addGroupByName("durable_group")
+        durable_group = db.getGroupByName("durable_group")
+        db.addUser(db.User("d001", "aaa", "aaa", [durable_group]))
+        db.addUser(db.User("d002", "bbb", "bbb"))
+        db.addUser(db.User("d003", "ccc", "ccc"))
+        db.updateUser(db.User("d002", "bbb", "bbbb", [db.getGroupByName("pirates")]))
+        db.deleteUserByUserId("d003")
+        db.addGroupToUser(db.getUserByUserid("d002"), durable_group)
+        db.removeGroupFromUser(db.getUserByUserid("d001"), durable_group)
+        db.updateGroupMembership(db.getGroupByName("execs"), ["d001", "jsmith"])
+        db.changeGroupMembership(db.getGroupByName("execs"), ["d002"], ["jsmith"])
+        db.addGroupByName("doomed_group")
+        db.removeGroupByName("doomed_group")
+        db.addGroups([db.Group("bulk_durable_group")])
+        db.addUsers([db.User("d004", "ddd", "ddd", [db.getGroupByName("bulk_durable_group")]), db.User("d005", "eee", "eee")])
+
+        before = dump()
+
+        db.enablePersistence(data_dir)
+        assert dump() == before
+
+    # Verify that a group removed before a snapshot and created again
+    # after it is recovered in the order the live database has it in
+    def test_recreated_group_order(self, data_dir):
+        db.addGroupByName("recreated_durable_group")
+        db.addGroupByName("between_durable_group")
+        db.enablePersistence(data_dir)
+
+        db.removeGroupByName("recreated_durable_group")
+        db.persistence.snapshot()
+        db.addGroupByName("recreated_durable_group")
+        db.addUser(db.User("d022", "aaa", "aaa", [db.getGroupByName("recreated_durable_group"),
+                                                 db.getGroupByName("between_durable_group")]))
+
+        before = dump()
+        assert before[0][[user[0] for user in before[0]].index("d022")][3] == ["between_durable_group", "recreated_durable_group"]
+
+        db.enablePersistence(data_dir)
+        assert dump() == before
+
+    # Verify that the log gets compacted into a
+    # snapshot every so many records.
+    def test_snapshot_every(self, data_dir):
+        db.enablePersistence(data_dir, snapshot_every = 3)
+
+        for userid in ["d010", "d011", "d012", "d013"]:
+            db.addUser(db.User(userid, "aaa", "aaa"))
+
+        assert [os.path.basename(path) for path in glob.glob(os.path.join(data_dir, "snapshot-*.bin"))] == ["snapshot-000000000003.bin"]
+
+        before = dump()
+
+        db.enablePersistence(data_dir, snapshot_every = 3)
+        assert dump() == before
+
+    # Verify that a snapshot holds the users as they were when it was
+    # captured, whatever happens to them before it's written out
+    def test_capture(self, data_dir):
+        db.enablePersistence(data_dir)
+        db.addUser(db.User("d023", "aaa", "aaa", [db.getGroupByName("users")]))
+        db.addUser(db.User("d024", "bbb", "bbb"))
+
+        write = db.persistence._capture()
+        db.addGroupToUser(db.getUserByUserid("d023"), db.getGroupByName("pirates"))
+        db.removeGroupFromUser(db.getUserByUserid("d023"), db.getGroupByName("users"))
+        db.deleteUserByUserId("d024")
+        write()
+
+        snapshot = Snapshot(sorted(glob.glob(os.path.join(data_dir, "snapshot-*.bin")))[-1])
+        userid, first_name, last_name, group_ordinals = snapshot.record(snapshot.find("d023"))
+        assert [snapshot.group_names[group_ordinal] for group_ordinal in group_ordinals] == ["users"]
+        assert snapshot.find("d024") >= 0
+        snapshot.close()
+
+        before = dump()
+
+        db.enablePersistence(data_dir)
+        assert dump() == before
+
+    # Verify that the snapshot users are being served from is only
+    # deleted once a newer one has replaced it and it has been closed
+    def test_base_removed_when_closed(self, data_dir):
+        db.enablePersistence(data_dir)
+        db.addUser(db.User("d006", "aaa", "aaa"))
+        db.enablePersistence(data_dir)
+
+        base_path = db.base.path
+        db.persistence.snapshot()
+        assert os.path.exists(base_path)
+
+        db.enablePersistence(data_dir)
+        assert glob.glob(os.path.join(data_dir, "snapshot-*.bin")) == [db.base.path]
+        assert not os.path.exists(base_path)
+
+    # Verify that the database can be changed while a snapshot is being
+    # written out, and that the changes made meanwhile are recovered
+    def test_snapshot_unlocked(self, data_dir, monkeypatch):
+        db.enablePersistence(data_dir, snapshot_every = 3)
+        write_snapshot = database.persistence.writeSnapshot
+        added = []
+
+        def writeSnapshot(*args):
+            writer = threading.Thread(target = lambda: added.append(db.addUser(db.User("d026", "aaa", "aaa"))))
+            writer.start()
+            writer.join(10)
+            assert added
+            write_snapshot(*args)
+
+        monkeypatch.setattr(database.persistence, "writeSnapshot", writeSnapshot)
+
+        for userid in ["d025", "d027", "d028"]:
+            db.addUser(db.User(userid, "aaa", "aaa"))
+
+        assert added
+        before = dump()
+
+        db.enablePersistence(data_dir)
+        assert dump() == before
+
+    # Verify that a torn record at the end of the log is ignored
+    def test_torn_record(self, data_dir):
+        db.enablePersistence(data_dir)
+        db.addUser(db.User("d020", "aaa", "aaa"))
+        before = dump()
+        db.disablePersistence()
+
+        log_path = glob.glob(os.path.join(data_dir, "wal-*.log"))[-1]
+        with open(log_path, "ab") as log_file:
+            log_file.write(b'{"op":"addUser","args":[{"userid":"d0')
+
+        db.enablePersistence(data_dir)
+        assert dump() == before
+
+        db.addUser(db.User("d021", "aaa", "aaa"))
+        before = dump()
+
+        db.enablePersistence(data_dir)
+        assert dump() == before
+
+    # Verify that users served from a recovered snapshot behave like
+    # any other users once they're changed, deleted or re-added.
+    def test_recovered_snapshot_overlay(self, data_dir):
+        db.enablePersistence(data_dir)
+
+        db.addGroupByName("overlay_group")
+        overlay_group = db.getGroupByName("overlay_group")
+        for userid in ["d030", "d041", "d032", "d033"]:
+            db.addUser(db.User(userid, "ooo", "overlay" + userid, [overlay_group]))
+
+        db.persistence.snapshot()
+        db.enablePersistence(data_dir)
+        assert db.base is not None and db.base.find("d030") >= 0
+
+        db.updateUser(db.User("d030", "ooo", "zoverlay", [overlay_group]))
+        db.deleteUserByUserId("d041")
+        db.deleteUserByUserId("d032")
+        db.addUser(db.User("d032", "ppp", "overlayd032"))
+        db.addUser(db.User("d034", "ooo", "overlayd034", [overlay_group]))
+
+        assert db.getUserIdsForGroup(overlay_group) == ["d030", "d033", "d034"]
+        assert not db.userExistsByUserid("d041")
+        assert [user.userid for user in db.pageUsers(after = "d029")[0]][:5] == ["d030", "d032", "d033", "d034", "jjones"]
+
+        users, next_key = db.pageUsers(last_name_prefix = "overlay")
+        assert [user.userid for user in users] == ["d032", "d033", "d034"]
+
+        assert db.pageGroupQuery("overlay_group")[0] == ["d030", "d033", "d034"]
+        assert db.countGroupQuery("NOT overlay_group") == len(db.allUsers()) - 3
+        assert db.groupStats() == scannedStats()
+
+        db.removeGroup(overlay_group)
+        assert db.getUserByUserid("d033").groups.mask == 0
+
+        before = dump()
+
+        db.enablePersistence(data_dir)
+        assert dump() == before
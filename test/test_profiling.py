@@ -0,0 +1,95 @@
+from flask import Flask, Response
+from profiling import StackSampler, profilingMiddleware
+import os
+import pstats
+import threading
+import time
+
+app = Flask(__name__)
+
+@app.route('/users/<userid>')
+def user(userid):
+    return userid
+
+@app.route('/export')
+def export():
+    return Response(str(i) for i in range(3))
+
+# A test client for the app with the profiling middleware around it
+def client(directory, **options):
+    profiled = Flask(__name__)
+    profiled.wsgi_app = profilingMiddleware(app.wsgi_app, directory, **options)
+    return profiled.test_client()
+
+def fetch(client, path, token = None):
+    response = client.get(path, headers={} if token is None else {'X-Profile': token})
+    data = response.get_data(as_text=True)
+    response.close()
+    return response.headers.get('X-Profile-Id'), data
+
+class TestProfiling():
+
+    # Verify that only requests with the right token are profiled, and
+    # that their profiles are written out, named for their route
+    def test_token(self, tmpdir):
+        directory = str(tmpdir)
+        profiling = client(directory, token='s3cret')
+
+        assert fetch(profiling, '/users/jsmith') == (None, 'jsmith')
+        assert fetch(profiling, '/users/jsmith', token='wrong') == (None, 'jsmith')
+
+        name, data = fetch(profiling, '/users/jsmith', token='s3cret')
+        assert data == 'jsmith' and name.endswith('-GET-users_userid')
+        assert sorted(os.listdir(directory)) == [name + '.collapsed', name + '.prof']
+
+        functions = [function for _, _, function in pstats.Stats(os.path.join(directory, name + '.prof')).stats]
+        assert 'user' in functions
+
+    # Verify that a header or token that isn't ASCII is compared rather
+    # than failing the request
+    def test_non_ascii_token(self, tmpdir):
+        profiling = client(str(tmpdir), token='s\u00e9cret')
+
+        assert fetch(profiling, '/users/jsmith', token='s\u00e9cret') == (None, 'jsmith')
+        assert fetch(profiling, '/users/jsmith', token='s\u00e9cret'.encode('utf-8').decode('latin-1'))[0] is not None
+        assert fetch(client(str(tmpdir), token='s3cret'), '/users/jsmith', token='\u00e9') == (None, 'jsmith')
+
+    # Verify that without a token the header is ignored, and that a
+    # sample rate of 1 profiles everything
+    def test_sample_rate(self, tmpdir):
+        assert fetch(client(str(tmpdir)), '/users/jsmith', token='') == (None, 'jsmith')
+
+        name, _ = fetch(client(str(tmpdir), sample_rate=1.0), '/nowhere')
+        assert name.endswith('-GET-nowhere')
+        assert len(os.listdir(str(tmpdir))) == 2
+
+    # Verify that a streamed response is profiled while it's sent
+    def test_streamed(self, tmpdir):
+        name, data = fetch(client(str(tmpdir), token='s3cret'), '/export', token='s3cret')
+        assert data == '012'
+
+        functions = [function for _, _, function in pstats.Stats(os.path.join(str(tmpdir), name + '.prof')).stats]
+        assert '<genexpr>' in functions
+
+    # Verify that the sampler records a thread's stacks, outermost
+    # frame first, in the collapsed format
+    def test_sampler(self):
+        done = threading.Event()
+
+        def waitForIt():
+            done.wait()
+
+        thread = threading.Thread(target=waitForIt)
+        thread.start()
+        sampler = StackSampler(thread.ident, 0.001)
+        sampler.start()
+        time.sleep(0.05)
+        sampler.stop()
+        done.set()
+        thread.join()
+
+        lines = sampler.collapsed().splitlines()
+        assert lines
+        stack, count = lines[0].rsplit(' ', 1)
+        assert stack.split(';')[-1].startswith('wait (') and 'waitForIt (test_profiling.py:' in stack
+        assert int(count) > 0
@@ -0,0 +1,52 @@
+from flask import Flask, request
+from recording import recordingMiddleware
+import json
+
+app = Flask(__name__)
+
+@app.route('/groups/<groupname>', methods=['PUT'])
+def group(groupname):
+    return request.get_data(as_text=True)
+
+# A test client for the app, recording into path
+def client(path):
+    recorded = Flask(__name__)
+    recorded.wsgi_app = recordingMiddleware(app.wsgi_app, path)
+    return recorded.test_client()
+
+def recording(path):
+    with open(path) as lines:
+        return [json.loads(line) for line in lines]
+
+class TestRecording():
+
+    # Verify that a request is recorded with its body and route, and
+    # that the app still gets the body
+    def test_record(self, tmpdir):
+        path = str(tmpdir.join('traffic.jsonl'))
+        response = client(path).put('/groups/admins?dry_run=1', data='{"userids": ["jsmith"]}',
+                                    headers={'Content-Type': 'application/json', 'X-Profile': 's3cret'})
+
+        assert response.get_data(as_text=True) == '{"userids": ["jsmith"]}'
+        assert recording(path) == [{
+            'method': 'PUT',
+            'path': '/groups/admins',
+            'query': 'dry_run=1',
+            'headers': {'Content-Type': 'application/json'},
+            'body': '{"userids": ["jsmith"]}',
+            'route': '/groups/<groupname>',
+            'status': 200
+        }]
+
+    # Verify that paths are recorded as they'd be sent, that requests
+    # that match no route are recorded without one and that event
+    # streams aren't recorded
+    def test_unmatched(self, tmpdir):
+        path = str(tmpdir.join('traffic.jsonl'))
+        recorder = client(path)
+
+        recorder.get('/users/:bulk/j smith')
+        recorder.get('/changes', headers={'Accept': 'text/event-stream'})
+
+        assert [(entry['path'], entry['route'], entry['status']) for entry in recording(path)] == \
+            [('/users/:bulk/j%20smith', None, 404)]
@@ -0,0 +1,160 @@
+from database import remote_db
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+from test import test_fake_db
+import os
+import stat
+import subprocess
+import sys
+import time
+import pytest
+
+# Run the whole fake_db suite against a store server in another
+# process, plus a few tests for things only the remote backend does.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+AUTHKEY = "test_remote_db"
+
+def startServer(address):
+    server = subprocess.Popen([sys.executable, "-m", "database.store_server", "--address", address], cwd = ROOT,
+                              env = dict(os.environ, FAKE_DB_AUTHKEY = AUTHKEY))
+    deadline = time.time() + 10
+
+    # The socket file shows up before the server is listening on it
+    while True:
+        try:
+            Client(address, authkey = AUTHKEY.encode('utf-8')).close()
+            return server
+        except OSError:
+            if time.time() > deadline or server.poll() is not None:
+                server.kill()
+                raise RuntimeError("store server didn't start")
+
+        time.sleep(0.05)
+
+@pytest.fixture(scope = "module", autouse = True)
+def server(tmpdir_factory):
+    address = str(tmpdir_factory.mktemp("remote_db").join("fake_db.sock"))
+    server = startServer(address)
+    remote_db.openDatabase(address, AUTHKEY)
+    yield address
+    remote_db.closeDatabase()
+    server.terminate()
+    server.wait()
+
+@pytest.fixture(autouse = True)
+def remote_backend(monkeypatch):
+    monkeypatch.setattr(test_fake_db, "db", remote_db)
+
+class TestRemoteDbUsers(test_fake_db.TestFakeDbUsers):
+    pass
+
+class TestRemoteDbGroups(test_fake_db.TestFakeDbGroups):
+    pass
+
+class TestRemoteDbPaging(test_fake_db.TestFakeDbPaging):
+    pass
+
+class TestRemoteDbVersions(test_fake_db.TestFakeDbVersions):
+    pass
+
+class TestRemoteDb():
+
+    # Verify that a change made by one process is seen by another
+    def test_processes_share_data(self, server):
+        subprocess.check_call([sys.executable, "-c", "\n".join([
+            "from database import remote_db",
+            "remote_db.openDatabase({!r}, {!r})".format(server, AUTHKEY),
+            "remote_db.addUser(remote_db.User('r001', 'aaa', 'aaa', [remote_db.getGroupByName('users')]))"
+        ])], cwd = ROOT)
+
+        user = remote_db.getUserByUserid("r001")
+        assert [group.name for group in user.groups] == ["users"]
+
+    # Verify that a user object that no longer matches what the
+    # server holds (say another process changed it) isn't handed out again.
+    def test_stale_user_replaced(self):
+        remote_db.addUser(remote_db.User("r002", "bbb", "bbb"))
+        user = remote_db.getUserByUserid("r002")
+
+        remote_db._call("updateUser", ("r002", "ccc", "ccc", []))
+
+        assert remote_db.getUserByUserid("r002") is not user
+        assert remote_db.getUserByUserid("r002").first_name == "ccc"
+
+    # Verify that adding and removing a group goes by what the server
+    # holds when a user object is out of date with it
+    def test_stale_membership(self):
+        group = remote_db.getGroupByName("pirates")
+        remote_db.addUser(remote_db.User("r004", "ddd", "ddd"))
+        user = remote_db.getUserByUserid("r004")
+        changes = []
+        remote_db.addChangeListener(lambda kind, key: changes.append((kind, key)))
+
+        assert remote_db._call("addGroupToUser", "r004", "pirates")
+        remote_db.addGroupToUser(user, group)
+        assert changes == [] and group in user.groups
+
+        # As if it had been read before another client added the group
+        user.groups.discard(group)
+        remote_db.removeGroupFromUser(user, group)
+        remote_db.change_listeners.pop()
+
+        assert "r004" not in remote_db.getUserIdsForGroup(group)
+        assert changes == [("user", "r004"), ("group", "pirates")]
+
+    # Verify that connections are put back in the pool and reused
+    def test_connections_reused(self):
+        remote_db.userExistsByUserid("r003")
+        pooled = list(remote_db.pool)
+
+        remote_db.userExistsByUserid("r003")
+        assert remote_db.pool == pooled
+
+    # Verify that a client with the wrong key is turned away and
+    # the server carries on serving everybody else
+    def test_wrong_authkey(self, server):
+        with pytest.raises(AuthenticationError):
+            remote_db.openDatabase(server, "wrong")
+
+        remote_db.openDatabase(server, AUTHKEY)
+        assert remote_db.userExistsByUserid("jsmith")
+
+    # Verify that the server won't start without a key, and that only
+    # its own user can get at its socket
+    def test_authkey_required(self, server, tmpdir):
+        environment = dict(os.environ)
+        environment.pop("FAKE_DB_AUTHKEY", None)
+        address = str(tmpdir.join("no_key.sock"))
+
+        refused = subprocess.run([sys.executable, "-m", "database.store_server", "--address", address], cwd = ROOT,
+                                 env = environment, stderr = subprocess.PIPE, timeout = 30)
+        assert refused.returncode != 0 and b"FAKE_DB_AUTHKEY" in refused.stderr
+        assert not os.path.exists(address)
+
+        assert stat.S_IMODE(os.stat(server).st_mode) == 0o600
+
+    # Verify that losing the server is reported as a ConnectionError
+    # and that a restarted server is picked up again
+    def test_server_restart(self, server, tmpdir):
+        address = str(tmpdir.join("restart.sock"))
+        other = startServer(address)
+
+        try:
+            remote_db.openDatabase(address, AUTHKEY)
+            remote_db.addGroupByName("restart_group")
+        finally:
+            other.terminate()
+            other.wait()
+
+        with pytest.raises(ConnectionError):
+            remote_db.groupNameExists("restart_group")
+
+        other = startServer(address)
+
+        try:
+            assert not remote_db.groupNameExists("restart_group")
+        finally:
+            other.terminate()
+            other.wait()
+            remote_db.openDatabase(server, AUTHKEY)
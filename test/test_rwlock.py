@@ -0,0 +1,66 @@
+from database.rwlock import ReadWriteLock
+import threading
+import pytest
+
+class TestReadWriteLock():
+
+    # Verify that two threads can hold the lock for reading at once
+    def test_shared_readers(self):
+        lock = ReadWriteLock()
+        both_in = threading.Barrier(2, timeout = 5)
+
+        def read():
+            lock.acquireRead()
+            both_in.wait()
+            lock.releaseRead()
+
+        thread = threading.Thread(target = read)
+        thread.start()
+        read()
+        thread.join()
+
+    # Verify that a writer keeps readers out until it's done
+    def test_writer_excludes_readers(self):
+        lock = ReadWriteLock()
+        seen = []
+
+        lock.acquireWrite()
+        thread = threading.Thread(target = lambda: (lock.acquireRead(), seen.append("read"), lock.releaseRead()))
+        thread.start()
+        thread.join(0.1)
+
+        assert seen == []
+
+        lock.releaseWrite()
+        thread.join()
+
+        assert seen == ["read"]
+
+    # Verify that the writing thread can take the lock again either way
+    def test_reentrant(self):
+        lock = ReadWriteLock()
+
+        lock.acquireWrite()
+        lock.acquireWrite()
+        lock.acquireRead()
+        lock.releaseRead()
+        lock.releaseWrite()
+        assert lock.isWriting()
+        lock.releaseWrite()
+        assert not lock.isWriting()
+
+        lock.acquireRead()
+        lock.acquireRead()
+        lock.releaseRead()
+        lock.releaseRead()
+        assert lock.readers == 0
+
+    # Verify that upgrading a read lock is refused rather than deadlocking
+    def test_upgrade_refused(self):
+        lock = ReadWriteLock()
+        lock.acquireRead()
+
+        with pytest.raises(RuntimeError):
+            lock.acquireWrite()
+
+        lock.releaseRead()
@@ -0,0 +1,66 @@
+from flask_restful import fields, marshal
+from serializers import serializer
+import database.fake_db as db
+import json
+import pytest
+
+link_fields = {
+    'rel': fields.String,
+    'href': fields.String
+}
+
+greeting_fields = {
+    'greeting': fields.String,
+    'users': fields.Nested(link_fields),
+    'groups': fields.Nested(link_fields)
+}
+
+user_list_fields = {
+    'userids': fields.List(fields.String)
+}
+
+user_fields = {
+    'userid': fields.String,
+    'first_name': fields.String,
+    'last_name': fields.String,
+    'groups': fields.Nested({'name': fields.String}, attribute=lambda user: list(user.groups))
+}
+
+class TestSerializers():
+
+    # Verify that a compiled serializer renders users exactly as marshal does
+    def test_user(self):
+        serialize = serializer(user_fields)
+
+        for user in db.allUsers():
+            assert json.dumps(serialize(user)) == json.dumps(marshal(user, user_fields))
+
+    # Verify that a compiled serializer renders dicts exactly as marshal does,
+    # including missing keys and nested records that aren't there.
+    def test_mapping(self):
+        serialize = serializer(greeting_fields, from_mapping=True)
+
+        greetings = [
+            {'greeting': 'hi', 'users': {'rel': 'users', 'href': '/users/'}, 'groups': {'rel': 'groups'}},
+            {'greeting': 42},
+        ]
+
+        for greeting in greetings:
+            assert json.dumps(serialize(greeting)) == json.dumps(marshal(greeting, greeting_fields))
+
+    # Verify that lists of strings come through
+    def test_string_list(self):
+        serialize = serializer(user_list_fields, from_mapping=True)
+
+        for userids in [{'userids': ['a', 'b']}, {'userids': []}, {}]:
+            assert json.dumps(serialize(userids)) == json.dumps(marshal(userids, user_list_fields))
+
+    # Verify that fields the compiler doesn't know about are rejected up front
+    def test_unsupported_field(self):
+        with pytest.raises(TypeError):
+            serializer({'count': fields.Integer})
+
+    # Verify that compiled=False falls back on marshal
+    def test_not_compiled(self):
+        user = db.getUserByUserid("jsmith")
+        assert serializer(user_fields, compiled=False)(user) == marshal(user, user_fields)
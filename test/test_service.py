@@ -0,0 +1,28 @@
+import importlib.util
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# python-eval.py isn't a module name, so load it from its path
+def loadApp():
+    spec = importlib.util.spec_from_file_location('python_eval', os.path.join(ROOT, 'python-eval.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+client = loadApp().app.test_client()
+
+class TestService():
+
+    # Verify that a GET with the ETag the last one sent back is a 304
+    def test_not_modified(self):
+        response = client.get('/users/jsmith')
+
+        assert response.status_code == 200
+        assert client.get('/users/jsmith', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+    # Verify that If-None-Match: * doesn't turn the 404 for a user or
+    # group that doesn't exist into a 304
+    def test_star_missing(self):
+        assert client.get('/users/nobody', headers={'If-None-Match': '*'}).status_code == 404
+        assert client.get('/groups/nobody', headers={'If-None-Match': '*'}).status_code == 404
@@ -0,0 +1,61 @@
+from database.snapshot import Snapshot, writeSnapshot
+import os
+import pytest
+
+@pytest.fixture
+def snapshot(tmpdir):
+    path = os.path.join(str(tmpdir), "snapshot.bin")
+    writeSnapshot(path, 42, ["users", "admins", "empty"], [
+        ("abc", "Ann", "Zed", ["users"]),
+        ("bcd", "Bob", "Ames", ["users", "admins"]),
+        ("cde", "Cy", "Ames", []),
+        ("déf", "Dé", "Müller", ["admins"])
+    ])
+
+    snapshot = Snapshot(path)
+    yield snapshot
+    snapshot.close()
+
+class TestSnapshot():
+
+    # Verify that records read back the way they were written
+    def test_records(self, snapshot):
+        assert snapshot.lsn == 42
+        assert snapshot.user_count == 4
+        assert snapshot.group_names == ["users", "admins", "empty"]
+        assert snapshot.record(1) == ("bcd", "Bob", "Ames", [0, 1])
+        assert snapshot.record(3) == ("déf", "Dé", "Müller", [1])
+
+    # Verify looking users up by userid
+    def test_find(self, snapshot):
+        assert snapshot.find("cde") == 2
+        assert snapshot.find("ccc") == -1
+        assert snapshot.find("zzz") == -1
+        assert snapshot.userPosition("ccc") == 2
+
+    # Verify the (last_name, userid) ordering
+    def test_last_name_order(self, snapshot):
+        assert [snapshot.lastNameKey(position) for position in range(4)] == \
+            [("Ames", "bcd"), ("Ames", "cde"), ("Müller", "déf"), ("Zed", "abc")]
+        assert snapshot.lastNamePosition(("Ames", "c")) == 1
+        assert snapshot.lastNamePosition(("N",)) == 3
+
+    # Verify the group member lists
+    def test_group_members(self, snapshot):
+        assert snapshot.groupMembers(0) == [0, 1]
+        assert snapshot.groupMembers(1) == [1, 3]
+        assert snapshot.groupMembers(2) == []
+        assert [snapshot.groupMemberCount(group_ordinal) for group_ordinal in range(3)] == [2, 2, 0]
+
+    # Verify counting users by the number of groups they're in
+    def test_groupsPerUser(self, snapshot):
+        assert snapshot.groupsPerUser() == {0: 1, 1: 2, 2: 1}
+
+    # Verify that something that isn't a snapshot is rejected
+    def test_bad_magic(self, tmpdir):
+        path = os.path.join(str(tmpdir), "junk.bin")
+        with open(path, "wb") as junk_file:
+            junk_file.write(b"\0" * 128)
+
+        with pytest.raises(ValueError):
+            Snapshot(path)
@@ -0,0 +1,54 @@
+from database.sortedset import SortedSet
+import random
+
+class TestSortedSet():
+
+    # Verify that keys come back sorted and without duplicates
+    def test_add(self):
+        keys = SortedSet()
+
+        for key in ["c", "a", "b", "a"]:
+            keys.add(key)
+
+        assert list(keys) == ["a", "b", "c"]
+        assert len(keys) == 3
+
+    # Verify that discard removes keys and ignores missing ones
+    def test_discard(self):
+        keys = SortedSet(["a", "b", "c"])
+
+        keys.discard("b")
+        keys.discard("zzz")
+
+        assert list(keys) == ["a", "c"]
+        assert "b" not in keys
+        assert "a" in keys
+
+    # Verify that iterFrom starts at the right key
+    def test_iterFrom(self):
+        keys = SortedSet(["a", "c", "e"])
+
+        assert list(keys.iterFrom("c")) == ["c", "e"]
+        assert list(keys.iterFrom("c", inclusive = False)) == ["e"]
+        assert list(keys.iterFrom("b")) == ["c", "e"]
+        assert list(keys.iterFrom("f")) == []
+
+    # Verify that the set stays sorted across many
+    # chunk splits and removals in random order.
+    def test_many_keys(self):
+        numbers = list(range(5000))
+        random.Random(42).shuffle(numbers)
+
+        keys = SortedSet()
+        for number in numbers:
+            keys.add(number)
+
+        for number in numbers[:2500]:
+            keys.discard(number)
+
+        remaining = sorted(numbers[2500:])
+
+        assert list(keys) == remaining
+        assert len(keys) == len(remaining)
+        assert list(keys.iterFrom(remaining[1000], inclusive = False)) == remaining[1001:]
+        assert all(number in keys for number in remaining)
@@ -0,0 +1,125 @@
+from database import sqlite_db
+from test import test_fake_db
+import sqlite3
+import threading
+import pytest
+
+# Run the whole fake_db suite against the SQLite backend, plus a few
+# tests for things only the SQLite backend does.
+
+@pytest.fixture(scope = "module", autouse = True)
+def database_path(tmpdir_factory):
+    path = str(tmpdir_factory.mktemp("sqlite_db").join("fake_db.sqlite3"))
+    sqlite_db.openDatabase(path)
+    yield path
+    sqlite_db.closeDatabase()
+
+@pytest.fixture(autouse = True)
+def sqlite_backend(monkeypatch):
+    monkeypatch.setattr(test_fake_db, "db", sqlite_db)
+
+class TestSqliteDbUsers(test_fake_db.TestFakeDbUsers):
+    pass
+
+class TestSqliteDbGroups(test_fake_db.TestFakeDbGroups):
+    pass
+
+class TestSqliteDbPaging(test_fake_db.TestFakeDbPaging):
+    pass
+
+class TestSqliteDb():
+
+    # Verify that everything is still there after reopening the file
+    def test_reopen(self, database_path):
+        sqlite_db.addGroupByName("reopened_group")
+        sqlite_db.addUser(sqlite_db.User("s001", "aaa", "aaa", [sqlite_db.getGroupByName("reopened_group")]))
+
+        sqlite_db.openDatabase(database_path)
+
+        user = sqlite_db.getUserByUserid("s001")
+        assert [group.name for group in user.groups] == ["reopened_group"]
+        assert sqlite_db.getUserIdsForGroup(sqlite_db.getGroupByName("reopened_group")) == ["s001"]
+
+    # Verify that a change made on one thread's connection
+    # is seen on another thread's connection.
+    def test_threads_share_data(self):
+        thread = threading.Thread(target = lambda: sqlite_db.addUser(sqlite_db.User("s002", "bbb", "bbb")))
+        thread.start()
+        thread.join()
+
+        assert sqlite_db.getUserByUserid("s002").first_name == "bbb"
+
+    # Verify that a user object that no longer matches its row
+    # (say another process changed it) isn't handed out again.
+    def test_stale_user_replaced(self):
+        sqlite_db.addUser(sqlite_db.User("s003", "ccc", "ccc"))
+        user = sqlite_db.getUserByUserid("s003")
+
+        with sqlite_db._transaction() as connection:
+            connection.execute(sqlite_db.UPDATE_USER, ("ddd", "ddd", "s003"))
+
+        assert sqlite_db.getUserByUserid("s003") is not user
+        assert sqlite_db.getUserByUserid("s003").first_name == "ddd"
+
+    # Verify that adding and removing a group goes by what's in the
+    # database when a user object is out of date with it
+    def test_stale_membership(self):
+        group = sqlite_db.getGroupByName("pirates")
+        sqlite_db.addUser(sqlite_db.User("s005", "fff", "fff"))
+        user = sqlite_db.getUserByUserid("s005")
+        changes = []
+        sqlite_db.addChangeListener(lambda kind, key: changes.append((kind, key)))
+
+        with sqlite_db._transaction() as connection:
+            connection.execute(sqlite_db.INSERT_MEMBERSHIP_BY_NAME, ("pirates", "s005"))
+
+        sqlite_db.addGroupToUser(user, group)
+        assert changes == [] and group in user.groups
+
+        # As if it had been read before another process added the group
+        user.groups.discard(group)
+        sqlite_db.removeGroupFromUser(user, group)
+        sqlite_db.change_listeners.pop()
+
+        assert "s005" not in sqlite_db.getUserIdsForGroup(group)
+        assert changes == [("user", "s005"), ("group", "pirates")]
+
+    # Verify that threads that come and go, one per request say, reuse
+    # the connections of the ones that finished rather than each
+    # leaving one open.
+    def test_finished_threads_connections_reused(self):
+        sqlite_db.addUser(sqlite_db.User("s004", "eee", "eee"))
+
+        for i in range(300):
+            thread = threading.Thread(target = lambda: sqlite_db.getUserByUserid("s004"))
+            thread.start()
+            thread.join()
+
+        with sqlite_db.connections_lock:
+            assert len(sqlite_db.connections) + len(sqlite_db.idle_connections) <= 3
+
+    # Verify that a database made before the count tables existed has
+    # them filled in when it's opened, and that they're kept up to date
+    def test_counts_added(self, database_path, tmpdir):
+        path = str(tmpdir.join("uncounted.sqlite3"))
+        connection = sqlite3.connect(path)
+        connection.executescript(sqlite_db.SCHEMA)
+        connection.executescript("""
+            INSERT INTO groups (name) VALUES ('users'), ('admins');
+            INSERT INTO users VALUES ('c001', 'aaa', 'aaa'), ('c002', 'bbb', 'bbb'), ('c003', 'ccc', 'ccc');
+            INSERT INTO memberships VALUES (1, 'c001'), (2, 'c001'), (1, 'c002');
+        """)
+        connection.close()
+
+        try:
+            sqlite_db.openDatabase(path)
+            assert sqlite_db.groupStats() == {
+                "users": 3,
+                "members": [("admins", 1), ("users", 2)],
+                "groups_per_user": [(0, 1), (1, 1), (2, 1)]
+            }
+
+            sqlite_db.deleteUserByUserId("c001")
+            assert sqlite_db.groupStats() == test_fake_db.scannedStats()
+        finally:
+            sqlite_db.openDatabase(database_path)
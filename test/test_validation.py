@@ -0,0 +1,65 @@
+from flask import Flask
+from validation import Argument, INTEGER, STRING_LIST, parser
+from werkzeug.exceptions import HTTPException
+import pytest
+
+app = Flask(__name__)
+
+parse_user = parser([
+    Argument('userid', required=True, help='No userid provided'),
+    Argument('groups', type=STRING_LIST, required=True, help='No groups defined'),
+    Argument('tags', type=STRING_LIST, default=())
+], 'json')
+
+parse_query = parser([
+    Argument('limit', type=INTEGER),
+    Argument('format', default='ndjson', choices=('ndjson', 'csv'))
+], 'args')
+
+# Parse with a request for this body or query string, returning the
+# arguments or the (status, data) the request was aborted with
+def parse(function, **request):
+    with app.test_request_context(**request):
+        try:
+            return function()
+        except HTTPException as e:
+            return e.code, e.data
+
+class TestValidation():
+
+    # Verify that arguments are read straight out of the JSON body,
+    # with lists taken as they are and defaults filled in
+    def test_json(self):
+        assert parse(parse_user, json={'userid': 'jsmith', 'groups': ['users', 'admins']}) == \
+            {'userid': 'jsmith', 'groups': ['users', 'admins'], 'tags': ()}
+
+    # Verify that a JSON number is taken as a string, as reqparse did
+    def test_number_as_string(self):
+        assert parse(parse_user, json={'userid': 5, 'groups': []})['userid'] == '5'
+
+    # Verify that a missing (or null) required argument is a 400
+    # with reqparse's message
+    def test_missing(self):
+        assert parse(parse_user, json={'groups': []}) == (400, {'message': {'userid': 'No userid provided'}})
+        assert parse(parse_user, json={'userid': None, 'groups': []}) == (400, {'message': {'userid': 'No userid provided'}})
+        assert parse(parse_user, json=[]) == (400, {'message': {'userid': 'No userid provided'}})
+
+    # Verify that a list has to be a JSON array of strings
+    def test_bad_list(self):
+        for groups in ["['users']", [1, 2], {'users': True}]:
+            assert parse(parse_user, json={'userid': 'jsmith', 'groups': groups}) == \
+                (400, {'message': {'groups': 'No groups defined'}})
+
+    # Verify query string conversion, choices and the errors for them
+    def test_args(self):
+        assert parse(parse_query, query_string={'limit': '10'}) == {'limit': 10, 'format': 'ndjson'}
+        assert parse(parse_query, query_string={'format': 'csv'}) == {'limit': None, 'format': 'csv'}
+        assert parse(parse_query, query_string={'limit': 'abc'}) == \
+            (400, {'message': {'limit': "invalid literal for int() with base 10: 'abc'"}})
+        assert parse(parse_query, query_string={'format': 'xml'}) == \
+            (400, {'message': {'format': 'xml is not a valid choice'}})
+
+    # Verify that an unknown location is caught up front
+    def test_unknown_location(self):
+        with pytest.raises(ValueError):
+            parser([Argument('userid')], 'form')
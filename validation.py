@@ -0,0 +1,103 @@
+from flask import request
+from flask_restful import abort
+
+# Request argument parsing without reqparse.
+#
+# flask_restful instantiates a resource for every request, so building
+# a reqparse.RequestParser in a resource's __init__ rebuilds it (and
+# every Argument in it) each time, and parse_args() then copies the
+# request's values through a generic pipeline of type conversion,
+# choices and nullability handling for every argument.  parser()
+# instead builds the checks for a list of Arguments once, up front,
+# and returns a function that pulls the arguments straight out of the
+# JSON body or the query string.
+#
+# Errors are reported the way reqparse reports them: a 400 whose message
+# maps the first bad argument's name to its help text, or to what was
+# wrong with it if it has none.  Lists are read from native JSON arrays.
+
+STRING = 'string'
+INTEGER = 'integer'
+STRING_LIST = 'string list'
+
+class Argument:
+    def __init__(self, name, type = STRING, required = False, help = None, default = None, choices = None):
+        self.name = name
+        self.type = type
+        self.required = required
+        self.help = help
+        self.default = default
+        self.choices = choices
+
+# A JSON number or boolean is taken as its string form, as reqparse's
+# str conversion did, but an array or object isn't a string.
+def _string(value):
+    if value.__class__ is str:
+        return value
+
+    if isinstance(value, (list, dict)):
+        raise ValueError("{} isn't a string".format(value))
+
+    return str(value)
+
+def _stringList(value):
+    if value.__class__ is not list or not all(item.__class__ is str for item in value):
+        raise ValueError("{} isn't a list of strings".format(value))
+
+    return value
+
+CONVERSIONS = {
+    STRING: _string,
+    INTEGER: int,
+    STRING_LIST: _stringList
+}
+
+def _fail(argument, error):
+    abort(400, message = {argument.name: argument.help if argument.help is not None else error})
+
+# The check for one argument: a function that takes the raw value (None
+# if it's missing) and returns the parsed one or aborts the request.
+def _check(argument):
+    convert = CONVERSIONS[argument.type]
+    choices = None if argument.choices is None else frozenset(argument.choices)
+
+    def check(value):
+        if value is None:
+            if argument.required:
+                _fail(argument, "Missing required parameter {}".format(argument.name))
+
+            return argument.default
+
+        try:
+            value = convert(value)
+        except (TypeError, ValueError) as e:
+            _fail(argument, str(e))
+
+        if choices is not None and value not in choices:
+            _fail(argument, "{} is not a valid choice".format(value))
+
+        return value
+
+    return check
+
+# Return a function that parses these arguments out of the current
+# request's JSON body (location 'json') or query string ('args') into
+# a dict.  A body that isn't a JSON object counts as an empty one.
+def parser(arguments, location):
+    checks = [(argument.name, _check(argument)) for argument in arguments]
+
+    if location == 'json':
+        def values():
+            body = request.get_json()
+            return body if isinstance(body, dict) else {}
+    elif location == 'args':
+        def values():
+            return request.args
+    else:
+        raise ValueError("unknown location '{}'".format(location))
+
+    def parse():
+        source = values()
+        return dict((name, check(source.get(name))) for name, check in checks)
+
+    return parse